@@ -2,39 +2,74 @@
 # -*- coding: utf-8 -*-
 
 import os
+import errno
 import json
-import requests
+import argparse
 import time
 import sys
-import concurrent.futures
-from msal import PublicClientApplication, SerializableTokenCache
+import threading
+from urllib.parse import urlparse
 from config import (
-    CLIENT_ID, AUTHORITY, SCOPE, 
-    DOWNLOAD_PATH, TOKEN_CACHE_FILE
+    DOWNLOAD_PATH, DOWNLOAD_PATH_TEMPLATE, SYNC_STATE_FILE, GRAPH_API_BASE,
+    METRICS_PORT, METRICS_LOG_FILE, METRICS_LOG_INTERVAL,
+    RUN_HISTORY_FILE, RUN_RECORDS_DIR, DEDUP_MODE, CONTENT_INDEX_FILE,
+    SHARD_CACHE, SHARD_CACHE_MAX_BYTES, RUN_JOURNAL_FILE, TAR_INDEX_FILE,
+    DISK_RESERVE, DISK_SPACE_POLICY, DISK_PREALLOCATE, DISK_WAIT_POLL, DISK_WAIT_TIMEOUT, CONTROL_ADDRESS
 )
+from rate_limiter import get_global_limiter, parse_rate
+import metrics
+import profiling
+from item_records import FileRecord, FILE_SELECT_FIELDS
+from content_index import ContentIndex, ContentDeduplicator, content_key
+from run_journal import RunJournal
+from disk_space import DiskSpaceGate, DISK_SPACE_POLICIES, plan_space, print_plan
+
+# 访问令牌离过期不足该秒数时提前获取新的令牌 (比令牌代理的提前刷新时间短，代理刷新后客户端再来取)
+TOKEN_REFRESH_MARGIN = 60
+
+# 文件列表缓存的格式，旧格式 (整个列表一个JSON对象) 的缓存视为不存在
+LISTING_FORMAT = "jsonl-1"
 
 class UnbalancedTrainBatchDownloader:
-    def __init__(self):
+    """把SharePoint上一个数据集文件夹分成若干批次并行下载
+    
+    默认下载 techn365.sharepoint.com/sites/clap 上的 a_t5/unbalanced_train，分6批，
+    每批写入 downloads/batch_N。其他数据集可以通过参数(或作业文件，见dataset_jobs.py)指定:
+    site_hostname/site_path/relative_path为远程位置，batch_count为批次数，
+    download_dir为报告等文件的目录，batch_dir为批次目录模板 (可用{batch}和{target})。
+    path_template为每个文件的本地路径模板 (见local_path)，可以直接写入train/test/valid结构，
+    split为模板中{split}的值。
+    shared为另一个下载器时复用它的登录状态、HTTP连接池、去重索引和分片缓存。
+    
+    登录和HTTP连接池在第一次访问Graph时才创建，msal和requests也在那时才导入，
+    所以help、stats和verify --offline等命令不需要登录，启动很快。
+    """
+    
+    def __init__(self, access_token=None, site_hostname="techn365.sharepoint.com", site_path="/sites/clap",
+                 relative_path="/CLAP_audio_dataset/a_t5/unbalanced_train", batch_count=6,
+                 download_dir=DOWNLOAD_PATH, batch_dir=None, path_template=DOWNLOAD_PATH_TEMPLATE, split="train",
+                 shared=None):
         # 创建下载目录
-        os.makedirs(DOWNLOAD_PATH, exist_ok=True)
-        
-        # 初始化令牌缓存
-        self.token_cache = SerializableTokenCache()
-        if os.path.exists(TOKEN_CACHE_FILE):
-            try:
-                self.token_cache.deserialize(open(TOKEN_CACHE_FILE, "r").read())
-            except:
-                print("令牌缓存文件无效，将创建新的缓存")
-        
-        # 初始化MSAL应用 - 使用PublicClientApplication进行设备代码流程
-        self.app = PublicClientApplication(
-            client_id=CLIENT_ID,
-            authority=AUTHORITY,
-            token_cache=self.token_cache
-        )
-        
-        # 获取访问令牌
-        self.access_token = self._get_access_token()
+        self.download_dir = download_dir
+        self.batch_dir_template = batch_dir or os.path.join(download_dir, "batch_{batch}")
+        if path_template and not any(field in path_template for field in ("{name}", "{stem}", "{item_id}")):
+            raise ValueError(f"路径模板必须包含{{name}}、{{stem}}或{{item_id}}，否则不同文件会写到同一个路径: {path_template}")
+        self.path_template = path_template or None
+        self.split = split
+        os.makedirs(download_dir, exist_ok=True)
+        
+        if shared is not None:
+            # 同一进程中下载多个数据集时共用一次登录
+            self._auth_owner = shared._auth_owner
+        else:
+            self._auth_owner = self
+            self._auth_lock = threading.Lock()
+            # 预先获取的访问令牌 (例如基准测试中的模拟服务器) 不经过MSAL，也不会刷新
+            self._static_token = access_token
+            self._access_token = access_token
+            self._token_expires_on = float("inf")
+            # 令牌来源 (本进程登录或令牌代理，见token_broker.py)，第一次需要令牌时才创建
+            self.token_provider = None
         
         # SharePoint站点信息
         self.site_id = None
@@ -44,62 +79,206 @@ class UnbalancedTrainBatchDownloader:
         self.unbalanced_train_id = None
         
         # 站点URL
-        self.site_hostname = "techn365.sharepoint.com"
-        self.site_path = "/sites/clap"
-        self.relative_path = "/CLAP_audio_dataset/a_t5/unbalanced_train"
+        self.site_hostname = site_hostname
+        self.site_path = site_path
+        self.relative_path = relative_path
+        self.target_name = os.path.basename(relative_path.rstrip("/"))
+        self.batch_count = batch_count
+        
+        # 目标文件夹的文件列表缓存 (FileRecord列表)
+        self._all_files = None
+        # 为True时只使用上次保存的文件列表 (verify --offline)，不访问网络
+        self.offline = False
         
         # 并行下载设置
         self.max_workers = 5  # 最大并行下载数量
         
-    def _save_token_cache(self):
-        """保存令牌缓存到文件"""
-        with open(TOKEN_CACHE_FILE, "w") as f:
-            f.write(self.token_cache.serialize())
-    
-    def _get_access_token(self):
-        """获取访问令牌，如果需要则进行交互式登录"""
-        accounts = self.app.get_accounts()
-        result = None
-        
-        if accounts:
-            # 尝试使用缓存的令牌
-            result = self.app.acquire_token_silent(SCOPE, account=accounts[0])
-        
-        if not result:
-            # 需要交互式登录
-            flow = self.app.initiate_device_flow(scopes=SCOPE)
-            if "user_code" not in flow:
-                raise Exception("无法创建设备流: " + json.dumps(flow, indent=4))
-            
-            print(flow["message"])
-            
-            # 等待用户完成登录
-            result = self.app.acquire_token_by_device_flow(flow)
-        
-        if "access_token" not in result:
-            raise Exception("无法获取访问令牌: " + json.dumps(result, indent=4))
-        
-        # 保存令牌缓存
-        self._save_token_cache()
+        # 下载顺序和尾部拆分设置
+        self.order_policy = "largest"  # 下载顺序: largest(大文件优先) / smallest(小文件优先) / listing(列表顺序)
+        self.split_threshold = 64 * 1024 * 1024  # 批次末尾剩余超过该字节数的文件会被拆分给空闲线程
+        
+        # 带宽限制，同一进程中的所有下载器共用
+        self.limiter = get_global_limiter()
+        
+        # Graph API遇到限流(429/503)或网络错误时的最大重试次数
+        self.max_api_retries = 3
+        
+        # 正在运行的调度器 (供控制接口调整) 和控制接口地址 (见download_control.py)
+        self.scheduler = None
+        self.control = None
+        
+        if shared is not None:
+            # 共用连接池、去重索引和分片缓存 (限速器本身就是进程内共享的)
+            self._session_owner = shared._session_owner
+            self.dedup = shared.dedup
+            self.shard_cache = shared.shard_cache
+            self.journal = shared.journal
+            self.resume = shared.resume
+            self.disk_policy = shared.disk_policy
+            self.disk_gate = shared.disk_gate
+            return
         
-        return result["access_token"]
+        # HTTP连接池在第一次使用时创建 (见session)
+        self._session_owner = self
+        self._session = None
+        
+        # 按内容去重，内容相同的文件用硬链接/reflink代替下载
+        self.dedup = ContentDeduplicator(ContentIndex(CONTENT_INDEX_FILE), DEDUP_MODE)
+        
+        # 多个节点共享的分片缓存 (共享目录或局域网缓存服务器)，未配置时为None
+        self.shard_cache = None
+        if SHARD_CACHE:
+            from shard_cache import open_shard_cache
+            self.shard_cache = open_shard_cache(SHARD_CACHE, int(parse_rate(SHARD_CACHE_MAX_BYTES) or 0) or None)
+        
+        # 运行日志: 记录每个文件的状态和断点，中断后重新运行同一个命令时直接从日志继续
+        self.journal = RunJournal(RUN_JOURNAL_FILE)
+        self.resume = True  # False时忽略日志重新规划 (--fresh)
+        
+        # 磁盘空间: 下载前检查，下载中空间不足时暂停开始新的文件 (policy为off时不检查)
+        if DISK_SPACE_POLICY not in DISK_SPACE_POLICIES:
+            raise ValueError(f"无效的 DISK_SPACE_POLICY: {DISK_SPACE_POLICY}，可选: {', '.join(DISK_SPACE_POLICIES)}")
+        self.disk_policy = DISK_SPACE_POLICY
+        self.disk_gate = None
+        if DISK_SPACE_POLICY != "off":
+            self.disk_gate = DiskSpaceGate(int(parse_rate(DISK_RESERVE) or 0), DISK_PREALLOCATE,
+                                           DISK_WAIT_POLL, DISK_WAIT_TIMEOUT)
+    
+    @property
+    def session(self):
+        """复用HTTP连接的会话，连接池大小与最大并行数量匹配，第一次使用时创建"""
+        owner = self._session_owner
+        if owner._session is None:
+            import requests
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=20)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            metrics.track_session_connections(session)
+            owner._session = session
+        return owner._session
+    
+    @session.setter
+    def session(self, session):
+        self._session_owner._session = session
+    
+    @property
+    def access_token(self):
+        """访问令牌，第一次需要时才登录，快过期时提前获取新的令牌，多个线程同时需要时只获取一次"""
+        owner = self._auth_owner
+        if owner._access_token is None or owner._token_expires_on - TOKEN_REFRESH_MARGIN <= time.time():
+            with owner._auth_lock:
+                if owner._access_token is None or owner._token_expires_on - TOKEN_REFRESH_MARGIN <= time.time():
+                    with profiling.phase("auth"):
+                        owner._get_access_token()
+        return owner._access_token
+    
+    def _refresh_access_token(self, expired_token):
+        """访问令牌失效时刷新，其他线程已经刷新过时直接使用新的令牌；预先提供的令牌无法刷新，返回False"""
+        owner = self._auth_owner
+        if owner._static_token is not None:
+            return False
+        with owner._auth_lock:
+            if owner._access_token == expired_token:
+                owner._get_access_token(expired_token)
+        return True
+    
+    def batch_dir(self, batch_number):
+        """批次的本地目录"""
+        return self.batch_dir_template.format(batch=batch_number, target=self.target_name)
+    
+    def local_path(self, batch_number, file_item):
+        """文件的本地路径
+        
+        没有路径模板时为 <批次目录>/<文件名>。模板可以使用 {name} {stem} {ext} {item_id}
+        {batch} {target} {split} {download_dir}，例如 "downloads/a_t5/{split}/{name}"
+        会直接写入step1_unzip.py处理的目录，不需要再移动文件。
+        """
+        if not self.path_template:
+            return os.path.join(self.batch_dir(batch_number), file_item.name)
+        return self._format_path(self.path_template, batch_number, file_item)
+    
+    def _format_path(self, template, batch_number, file_item):
+        stem, ext = os.path.splitext(file_item.name)
+        return os.path.normpath(template.format(
+            name=file_item.name, stem=stem, ext=ext, item_id=file_item.id, batch=batch_number,
+            target=self.target_name, split=self.split, download_dir=self.download_dir
+        ))
+    
+    def _get_access_token(self, expired_token=None):
+        """从令牌来源获取访问令牌，expired_token为服务器拒绝的令牌时强制刷新
+        
+        默认在本进程中登录 (有CLIENT_SECRET时用客户端凭据，否则用令牌缓存，必要时设备代码登录)；
+        设置了TOKEN_BROKER时从令牌代理获取，集群节点不需要登录，也不会同时写令牌缓存。
+        """
+        if self.token_provider is None:
+            from token_broker import make_token_provider
+            self.token_provider = make_token_provider()
+        with metrics.TOKEN_REFRESH_SECONDS.time():
+            token, expires_on = self.token_provider.get_token(
+                force_refresh=expired_token is not None, expired_token=expired_token
+            )
+        self._access_token = token
+        self._token_expires_on = expires_on
+        return token
     
     def _make_api_request(self, endpoint, params=None):
-        """向Microsoft Graph API发送请求"""
-        headers = {
-            "Authorization": f"Bearer {self.access_token}",
-            "Accept": "application/json"
-        }
-        
-        response = requests.get(
-            f"https://graph.microsoft.com/v1.0{endpoint}",
-            headers=headers,
-            params=params
-        )
+        """向Microsoft Graph API发送请求
         
-        if response.status_code == 200:
-            return response.json()
+        遇到限流(429/503)时按Retry-After等待后重试，令牌过期(401)时刷新令牌后重试。
+        每次请求的耗时和状态码按端点模板记录到metrics中。
+        """
+        import requests
+        
+        # 分页链接(@odata.nextLink)是完整URL，直接使用
+        if endpoint.startswith(("https://", "http://")):
+            url = endpoint
         else:
+            url = f"{GRAPH_API_BASE}{endpoint}"
+        label = metrics.endpoint_label(endpoint)
+        
+        for attempt in range(self.max_api_retries + 1):
+            access_token = self.access_token
+            headers = {
+                "Authorization": f"Bearer {access_token}",
+                "Accept": "application/json"
+            }
+            
+            start = time.perf_counter()
+            try:
+                response = self.session.get(
+                    url,
+                    headers=headers,
+                    params=params,
+                    timeout=60
+                )
+            except requests.exceptions.RequestException as e:
+                metrics.GRAPH_REQUESTS.inc(endpoint=label, status="error")
+                if attempt < self.max_api_retries:
+                    metrics.RETRIES.inc(kind="graph")
+                    time.sleep(2 ** attempt)
+                    continue
+                print(f"API请求失败: {str(e)}")
+                return None
+            finally:
+                metrics.GRAPH_REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=label)
+            
+            metrics.GRAPH_REQUESTS.inc(endpoint=label, status=str(response.status_code))
+            if response.status_code == 200:
+                return response.json()
+            
+            if attempt < self.max_api_retries:
+                if response.status_code in (429, 503):
+                    metrics.GRAPH_THROTTLED.inc(endpoint=label)
+                    metrics.RETRIES.inc(kind="graph")
+                    retry_after = response.headers.get("Retry-After", "")
+                    time.sleep(float(retry_after) if retry_after.isdigit() else 2 ** attempt)
+                    continue
+                if response.status_code == 401 and self._refresh_access_token(access_token):
+                    # 访问令牌过期，静默刷新后重试
+                    metrics.RETRIES.inc(kind="token")
+                    continue
+            
             print(f"API请求失败: {response.status_code}")
             print(response.text)
             return None
@@ -111,7 +290,8 @@ class UnbalancedTrainBatchDownloader:
             
         print(f"正在获取SharePoint站点ID: {self.site_hostname}{self.site_path}")
         endpoint = f"/sites/{self.site_hostname}:{self.site_path}"
-        site_info = self._make_api_request(endpoint)
+        with profiling.phase("resolve_site"):
+            site_info = self._make_api_request(endpoint)
         
         if not site_info or "id" not in site_info:
             raise Exception("无法获取SharePoint站点ID")
@@ -131,7 +311,8 @@ class UnbalancedTrainBatchDownloader:
         # 获取文档库信息
         print("正在获取SharePoint文档库信息...")
         endpoint = f"/sites/{site_id}/drives"
-        drives_info = self._make_api_request(endpoint)
+        with profiling.phase("resolve_drive"):
+            drives_info = self._make_api_request(endpoint)
         
         if not drives_info or "value" not in drives_info or not drives_info["value"]:
             raise Exception("无法获取SharePoint文档库信息")
@@ -180,7 +361,8 @@ class UnbalancedTrainBatchDownloader:
             else:
                 endpoint = f"/drives/{drive_id}/root/children"
                 
-            folder_items = self._make_api_request(endpoint)
+            with profiling.phase("resolve_folder", folder=current_path):
+                folder_items = self._make_api_request(endpoint)
             
             if not folder_items or "value" not in folder_items:
                 raise Exception(f"无法获取文件夹内容: {current_path}")
@@ -207,7 +389,7 @@ class UnbalancedTrainBatchDownloader:
         return current_folder
     
     def get_unbalanced_train_id(self):
-        """获取unbalanced_train文件夹的ID"""
+        """获取目标文件夹(relative_path，默认为unbalanced_train)的ID"""
         if self.unbalanced_train_id:
             return self.unbalanced_train_id
             
@@ -238,7 +420,25 @@ class UnbalancedTrainBatchDownloader:
             drive_id = self.get_drive_id()
             
         endpoint = f"/drives/{drive_id}/items/{item_id}/children"
-        return self._make_api_request(endpoint)
+        with profiling.phase("list_children", item_id=item_id):
+            return self._list_all_pages(endpoint)
+    
+    def _list_all_pages(self, endpoint):
+        """获取列表接口的全部分页结果，合并到同一个value列表中"""
+        result = self._make_api_request(endpoint)
+        if not result or "value" not in result:
+            return result
+        
+        items = result["value"]
+        next_link = result.get("@odata.nextLink")
+        while next_link:
+            page = self._make_api_request(next_link)
+            if not page or "value" not in page:
+                return None
+            items.extend(page["value"])
+            next_link = page.get("@odata.nextLink")
+        
+        return {"value": items}
     
     def _format_size(self, size_bytes):
         """格式化文件大小"""
@@ -251,28 +451,130 @@ class UnbalancedTrainBatchDownloader:
             size_bytes /= 1024.0
         return f"{size_bytes:.2f} PB"
     
-    def get_all_files(self):
-        """获取unbalanced_train目录中所有文件"""
+    def get_all_files(self, refresh=False):
+        """获取目标目录中所有文件，返回FileRecord列表
+        
+        列表按页流式处理，每页只保留紧凑的FileRecord，不会同时持有所有原始项目字典。
+        结果在同一个下载器中缓存，验证、补齐等命令不会重复列出目录。
+        """
+        if self._all_files is not None and not refresh:
+            return self._all_files
+        if self.offline:
+            self._all_files = self._load_listing()
+            return self._all_files
+        
         # 获取目标文件夹ID
         folder_id = self.get_unbalanced_train_id()
         drive_id = self.get_drive_id()
         
-        print(f"\n正在获取unbalanced_train目录中的文件 (ID: {folder_id})...")
-        # 获取目录内容
-        folder_items = self.list_items(folder_id, drive_id)
-        if not folder_items or "value" not in folder_items:
-            raise Exception("无法获取unbalanced_train目录内容")
-        
+        print(f"\n正在获取{self.target_name}目录中的文件 (ID: {folder_id})...")
         # 过滤出所有文件
-        files = [item for item in folder_items["value"] if not item.get("folder")]
+        with profiling.phase("list_children", item_id=folder_id):
+            records = (
+                FileRecord.from_graph(item)
+                for item in self.iter_children(folder_id, drive_id, select=FILE_SELECT_FIELDS)
+                if not item.get("folder")
+            )
+            files = list(self._save_listing(records))
         print(f"找到 {len(files)} 个文件")
         
+        self._all_files = files
+        return files
+    
+    def _listing_path(self):
+        return os.path.join(self.download_dir, f"listing_{self.target_name}.jsonl")
+    
+    def _listing_key(self):
+        return f"{self.site_hostname}{self.site_path}:{self.relative_path}"
+    
+    def _save_listing(self, records):
+        """逐个返回records，同时把它们保存为文件列表，verify --offline 等命令不需要登录和访问网络
+        
+        文件列表是JSON行格式: 第一行是目标和列出时间，之后每行一个记录 (FileRecord各字段的值)。
+        记录边列边写，不会为了保存再构造一份完整的列表；全部写完后才替换旧的文件，
+        列目录中途失败时保留旧的文件列表。保存出错时只打印错误，不影响返回的记录。
+        """
+        temp_path = self._listing_path() + ".tmp"
+        out = None
+        try:
+            try:
+                out = open(temp_path, "w", encoding="utf-8")
+                header = {"format": LISTING_FORMAT, "target": self._listing_key(), "listed_at": time.time()}
+                out.write(json.dumps(header, ensure_ascii=False) + "\n")
+            except OSError as e:
+                out = self._discard_listing(out, temp_path, e)
+            for record in records:
+                if out is not None:
+                    try:
+                        row = [getattr(record, slot) for slot in FileRecord.__slots__]
+                        out.write(json.dumps(row, ensure_ascii=False) + "\n")
+                    except OSError as e:
+                        out = self._discard_listing(out, temp_path, e)
+                yield record
+            if out is not None:
+                try:
+                    out.close()
+                    os.replace(temp_path, self._listing_path())
+                    out = None
+                except OSError as e:
+                    out = self._discard_listing(out, temp_path, e)
+        finally:
+            if out is not None:
+                self._discard_listing(out, temp_path)
+    
+    @staticmethod
+    def _discard_listing(out, temp_path, error=None):
+        """放弃写了一半的文件列表，返回None"""
+        if error is not None:
+            print(f"保存文件列表出错: {str(error)}")
+        if out is not None:
+            out.close()
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        return None
+    
+    def _load_listing(self):
+        """读取上次在线时保存的文件列表，格式不对或目标不同时视为没有缓存"""
+        try:
+            with open(self._listing_path(), "r", encoding="utf-8") as f:
+                header = json.loads(f.readline())
+                if (not isinstance(header, dict) or header.get("format") != LISTING_FORMAT
+                        or header.get("target") != self._listing_key()):
+                    files = None
+                else:
+                    files = [FileRecord(*json.loads(line)) for line in f]
+        except (OSError, ValueError, TypeError):
+            files = None
+        if files is None:
+            raise Exception(f"没有{self.target_name}的文件列表缓存，请先在线运行一次 list 或 verify")
+        age_hours = (time.time() - header["listed_at"]) / 3600
+        print(f"使用 {age_hours:.1f} 小时前保存的文件列表 ({len(files)} 个文件，离线模式)")
         return files
     
-    def split_into_batches(self, files, batch_count=6):
-        """将文件分成指定数量的批次"""
+    def iter_children(self, item_id, drive_id=None, select=None):
+        """逐页获取文件夹的子项目并逐个返回，获取失败时抛出异常"""
+        if not drive_id:
+            drive_id = self.get_drive_id()
+        
+        endpoint = f"/drives/{drive_id}/items/{item_id}/children"
+        params = {"$select": select} if select else None
+        while endpoint:
+            page = self._make_api_request(endpoint, params=params)
+            if not page or "value" not in page:
+                raise Exception(f"无法获取文件夹内容 (ID: {item_id})")
+            yield from page["value"]
+            # nextLink中已经包含了查询参数
+            endpoint = page.get("@odata.nextLink")
+            params = None
+    
+    def split_into_batches(self, files, batch_count=None):
+        """将文件分成指定数量的批次 (默认为self.batch_count)"""
         if not files:
             return []
+        if batch_count is None:
+            batch_count = self.batch_count
             
         batches = []
         files_per_batch = len(files) // batch_count
@@ -289,57 +591,259 @@ class UnbalancedTrainBatchDownloader:
         
         return batches
     
-    def download_file(self, file_item, local_path):
-        """下载单个文件"""
-        # 获取下载链接
-        item_id = file_item["id"]
+    def get_download_url(self, file_item):
+        """获取文件的下载链接，失败时返回None"""
         drive_id = self.get_drive_id()
-        download_info = self.get_item_info(item_id, drive_id)
+        with profiling.phase("get_item_info", file=file_item.name):
+            download_info = self.get_item_info(file_item.id, drive_id)
         
         if not download_info or "@microsoft.graph.downloadUrl" not in download_info:
-            print(f"无法获取文件 {file_item['name']} 的下载链接")
+            return None
+        return download_info["@microsoft.graph.downloadUrl"]
+    
+    def download_file(self, file_item, local_path):
+        """下载单个文件，先写入 .part 文件，完成后再重命名"""
+        # 获取下载链接
+        download_url = self.get_download_url(file_item)
+        if not download_url:
+            print(f"无法获取文件 {file_item.name} 的下载链接")
             return False
-            
-        download_url = download_info["@microsoft.graph.downloadUrl"]
         
         # 创建本地目录（如果不存在）
         os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        part_path = local_path + ".part"
         
         # 下载文件
         try:
-            response = requests.get(download_url, stream=True)
+            response = self.session.get(download_url, stream=True)
             response.raise_for_status()
             
             file_size = int(response.headers.get("Content-Length", 0))
-            print(f"正在下载: {file_item['name']} ({self._format_size(file_size)})")
+            print(f"正在下载: {file_item.name} ({self._format_size(file_size)})")
             
-            with open(local_path, "wb") as f:
+            download_host = urlparse(download_url).hostname or ""
+            with open(part_path, "wb") as f:
                 downloaded = 0
                 for chunk in response.iter_content(chunk_size=8192):
                     if chunk:
                         f.write(chunk)
                         downloaded += len(chunk)
+                        self.limiter.throttle(download_host, len(chunk))
                         # 显示下载进度
                         progress = (downloaded / file_size) * 100 if file_size > 0 else 0
-                        print(f"\r{file_item['name']}: 进度 {progress:.1f}%", end="")
+                        print(f"\r{file_item.name}: 进度 {progress:.1f}%", end="")
             
-            print(f"\n{file_item['name']} 下载完成")
+            os.replace(part_path, local_path)
+            print(f"\n{file_item.name} 下载完成")
             return True
         except Exception as e:
-            print(f"\n{file_item['name']} 下载失败: {str(e)}")
+            print(f"\n{file_item.name} 下载失败: {str(e)}")
             return False
     
-    def download_file_worker(self, file_info):
-        """线程工作函数，用于并行下载"""
-        file_item, local_path = file_info
-        return self.download_file(file_item, local_path)
+    def _run_parallel_downloads(self, download_tasks, on_success=None, run_record=None, journal=None):
+        """并行执行下载任务，返回(成功的文件列表, 失败的文件列表)
+        
+        文件按order_policy排序后交给调度器；批次末尾有线程空闲时，剩余的大文件会被拆分成
+        多个Range分段并行下载。on_success在每个文件下载成功后以(file_item, local_path)调用。
+        提供run_record时，每个文件的耗时、重试次数和错误类别会写入其中。
+        
+        内容(哈希)与本地已有文件相同的文件直接链接，本批次中内容相同的文件只下载一份。
+        配置了分片缓存时先从缓存取文件，下载完成的文件在后台写入缓存。
+        提供journal (BatchJournal) 时记录每个文件的状态和分段位置，用于中断后继续。
+        """
+        if journal is not None:
+            # 无论是下载、缓存还是链接得到的文件，完成后都在日志中标记
+            notify = on_success
+            
+            def on_success(file_item, local_path):
+                journal.downloaded(file_item.id)
+                if notify:
+                    notify(file_item, local_path)
+        
+        unique_tasks, followers, linked = self.dedup.plan(download_tasks)
+        if self.disk_gate is not None and unique_tasks:
+            self._check_disk_space(unique_tasks)
+        successful_links = []
+        failed_links = []
+        
+        def finish_file(file_item, local_path):
+            # 下载完成后把内容相同的其他文件链接到这一份
+            self.dedup.record(file_item, local_path)
+            if on_success:
+                on_success(file_item, local_path)
+            for follower, follower_path in followers.pop(content_key(file_item), []):
+                if self.dedup.link(follower, local_path, follower_path):
+                    successful_links.append((follower, follower_path))
+                    if on_success:
+                        on_success(follower, follower_path)
+                else:
+                    failed_links.append(follower)
+        
+        def download_finished(file_item, local_path):
+            if self.shard_cache:
+                self.shard_cache.populate(file_item, local_path)
+            finish_file(file_item, local_path)
+        
+        for file_item, local_path in linked:
+            successful_links.append((file_item, local_path))
+            if on_success:
+                on_success(file_item, local_path)
+        
+        cached = []
+        if self.shard_cache and unique_tasks:
+            unique_tasks, cached = self._fetch_from_shard_cache(unique_tasks)
+            for file_item, local_path in cached:
+                finish_file(file_item, local_path)
+        
+        successful, failed = [], []
+        if unique_tasks:
+            from download_scheduler import DownloadScheduler
+            scheduler = DownloadScheduler(
+                self,
+                max_workers=self.max_workers,
+                order=self.order_policy,
+                split_threshold=self.split_threshold,
+                journal=journal,
+                disk_gate=self.disk_gate
+            )
+            # 有控制接口时，只剩暂停的文件也继续等待恢复
+            scheduler.hold_paused = self.control is not None
+            start = time.perf_counter()
+            self.scheduler = scheduler
+            try:
+                with profiling.span("download_all", files=len(unique_tasks)):
+                    successful, failed = scheduler.run(unique_tasks, on_success=download_finished)
+            finally:
+                self.scheduler = None
+            if run_record is not None:
+                run_record.add_transfers(scheduler.records, time.perf_counter() - start)
+        if self.shard_cache:
+            with profiling.phase("shard_cache_put"):
+                self.shard_cache.wait()
+        
+        # 下载失败的文件，内容相同的其他文件也无法链接
+        for key_followers in followers.values():
+            failed_links.extend(follower for follower, _ in key_followers)
+        
+        if run_record is not None:
+            for file_item, _ in cached:
+                run_record.add_file(file_item, "cached")
+            for file_item, _ in successful_links:
+                run_record.add_file(file_item, "deduplicated")
+            for file_item in failed_links:
+                run_record.add_file(file_item, "failed", error_class="dedup_source_failed")
+        if successful_links:
+            print(f"按内容去重: {len(successful_links)} 个文件无需下载，"
+                  f"节省 {self._format_size(sum(f.get('size') or 0 for f, _ in successful_links))}")
+        
+        if cached:
+            print(f"分片缓存: {len(cached)} 个文件从 {self.shard_cache.backend.describe()} 获取，"
+                  f"共 {self._format_size(sum(f.get('size') or 0 for f, _ in cached))}")
+        
+        cached_items = [file_item for file_item, _ in cached]
+        return successful + cached_items + [file_item for file_item, _ in successful_links], failed + failed_links
+    
+    def _check_disk_space(self, download_tasks):
+        """下载前比较需要的空间和可用空间，DISK_SPACE_POLICY为abort时空间不足直接报错"""
+        with profiling.phase("disk_plan"):
+            plan = plan_space(download_tasks, self.disk_gate.reserve_bytes)
+        if print_plan(plan, self.disk_gate.reserve_bytes):
+            return
+        if self.disk_policy == "abort":
+            raise Exception("磁盘空间不足，没有开始下载 (DISK_SPACE_POLICY=abort)。"
+                            "释放空间或用 --path-template 指向其他磁盘后重新运行")
+        print("空间不足时会暂停开始新的文件，等待解压、上传等步骤释放空间后继续 (DISK_SPACE_POLICY=wait)")
+    
+    def _fetch_from_shard_cache(self, download_tasks):
+        """并行从分片缓存获取文件，返回(未命中的任务, 命中的任务)"""
+        import concurrent.futures
+        with profiling.phase("shard_cache_get", files=len(download_tasks)):
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                hits = list(executor.map(lambda task: self.shard_cache.fetch(*task), download_tasks))
+        misses = [task for task, hit in zip(download_tasks, hits) if not hit]
+        cached = [task for task, hit in zip(download_tasks, hits) if hit]
+        return misses, cached
+    
+    def _new_run_record(self, command, batch_number):
+        from run_history import RunRecord
+        return RunRecord(command, batch_number, max_workers=self.max_workers, order_policy=self.order_policy)
+    
+    def _save_run_record(self, run_record):
+        """保存运行记录到历史数据库和JSON文件，失败时只打印警告"""
+        from run_history import RunHistory
+        run_record.finish()
+        try:
+            history = RunHistory(RUN_HISTORY_FILE, RUN_RECORDS_DIR)
+            try:
+                path = history.save(run_record)
+            finally:
+                history.close()
+            print(f"运行记录已保存到: {path}")
+        except Exception as e:
+            print(f"保存运行记录出错: {str(e)}")
+    
+    def set_order_policy(self, policy):
+        """设置下载顺序策略"""
+        from download_scheduler import ORDER_POLICIES
+        if policy not in ORDER_POLICIES:
+            print(f"未知的下载顺序: {policy}，可选: {', '.join(ORDER_POLICIES)}")
+            return
+        self.order_policy = policy
+        print(f"设置下载顺序为: {policy}")
+    
+    def _batch_journal(self, batch_number):
+        """批次在运行日志中的视图，按站点、目标文件夹和批次号区分"""
+        return self.journal.batch(f"{self.site_hostname}{self.site_path}:{self.relative_path}:batch_{batch_number}")
+    
+    def _resume_batch(self, batch_number, command):
+        """日志中有未完成的文件时直接继续下载 (不列出远程目录，不检查其他文件)
+        
+        返回是否全部成功；没有需要继续的文件或设置了--fresh时返回None。
+        """
+        if not self.resume:
+            return None
+        journal = self._batch_journal(batch_number)
+        pending = journal.unfinished()
+        if not pending:
+            return None
+        
+        location = journal.location()
+        if location and location[0]:
+            # 下载链接需要驱动器ID，直接使用日志中记录的，不再解析站点
+            self.drive_id, self.unbalanced_train_id = location
+        
+        counts = journal.counts()
+        print(f"从运行日志继续第{batch_number}批次: {len(pending)} 个文件未完成 "
+              f"(下载中 {counts.get('in_flight', 0)}, 失败 {counts.get('failed', 0)}, 排队 {counts.get('queued', 0)})")
+        
+        download_tasks = []
+        for file_item, local_path, state in pending:
+            if state != "queued" and not os.path.exists(local_path + ".part") and os.path.exists(local_path) \
+                    and os.path.getsize(local_path) == file_item.size:
+                # 上次已经完成重命名，只是没来得及写日志
+                journal.downloaded(file_item.id)
+                continue
+            download_tasks.append((file_item, local_path))
+        
+        run_record = self._new_run_record(command, batch_number)
+        successful_files, failed_files = self._run_parallel_downloads(
+            download_tasks, run_record=run_record, journal=journal
+        )
+        self._generate_download_report([f for f, _ in download_tasks] or [f for f, _, _ in pending],
+                                       successful_files, failed_files, [], batch_number)
+        self._save_run_record(run_record)
+        return len(failed_files) == 0
     
     def download_batch_parallel(self, batch_number):
-        """并行下载指定批次的文件"""
-        if batch_number < 1 or batch_number > 6:
-            print("批次号必须在1到6之间")
+        """并行下载指定批次的文件 (运行日志中有未完成的文件时从日志继续)"""
+        if batch_number < 1 or batch_number > self.batch_count:
+            print(f"批次号必须在1到{self.batch_count}之间")
             return
         
+        resumed = self._resume_batch(batch_number, "download")
+        if resumed is not None:
+            return resumed
+        
         print(f"准备下载第{batch_number}批次的文件")
         
         # 获取所有文件
@@ -357,61 +861,44 @@ class UnbalancedTrainBatchDownloader:
         batch = batches[batch_number - 1]
         print(f"第{batch_number}批次包含{len(batch)}个文件")
         
-        # 创建批次特定的下载文件夹
-        batch_dir = os.path.join(DOWNLOAD_PATH, f"batch_{batch_number}")
-        os.makedirs(batch_dir, exist_ok=True)
-        
         # 准备下载任务
+        run_record = self._new_run_record("download", batch_number)
         download_tasks = []
         skipped_files = []
-        for file_item in batch:
-            local_path = os.path.join(batch_dir, file_item["name"])
-            if os.path.exists(local_path):
-                file_size = os.path.getsize(local_path)
-                print(f"文件已存在，跳过: {file_item['name']} ({self._format_size(file_size)})")
-                skipped_files.append(file_item)
-                continue
-                
-            download_tasks.append((file_item, local_path))
+        with profiling.phase("plan"):
+            for file_item in batch:
+                local_path = self.local_path(batch_number, file_item)
+                if os.path.exists(local_path):
+                    file_size = os.path.getsize(local_path)
+                    print(f"文件已存在，跳过: {file_item.name} ({self._format_size(file_size)})")
+                    skipped_files.append((file_item, local_path))
+                    run_record.add_file(file_item, "skipped")
+                    if file_size == file_item.size:
+                        # 已有的文件加入内容索引，供其他数据集去重
+                        self.dedup.record(file_item, local_path)
+                    continue
+                    
+                download_tasks.append((file_item, local_path))
         
         if not download_tasks:
             print("所有文件已下载完成")
-            return
+            return True
+        
+        # 先写入下载计划，之后被中断时从这里继续
+        journal = self._batch_journal(batch_number)
+        journal.begin(download_tasks, skipped_files, self.drive_id, self.unbalanced_train_id)
             
         print(f"开始并行下载 {len(download_tasks)} 个文件 (最大并行数: {self.max_workers})")
         
         # 使用线程池并行下载
-        successful_files = []
-        failed_files = []
-        
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            # 提交所有任务
-            future_to_file = {
-                executor.submit(self.download_file_worker, task): task[0]
-                for task in download_tasks
-            }
-            
-            # 处理完成的任务
-            completed = 0
-            for future in concurrent.futures.as_completed(future_to_file):
-                file_item = future_to_file[future]
-                filename = file_item['name']
-                try:
-                    success = future.result()
-                    completed += 1
-                    print(f"完成进度: {completed}/{len(download_tasks)} ({completed/len(download_tasks)*100:.1f}%)")
-                    
-                    if success:
-                        successful_files.append(file_item)
-                    else:
-                        failed_files.append(file_item)
-                        
-                except Exception as e:
-                    print(f"{filename} 下载时发生错误: {str(e)}")
-                    failed_files.append(file_item)
+        successful_files, failed_files = self._run_parallel_downloads(
+            download_tasks, run_record=run_record, journal=journal
+        )
         
         # 生成下载报告
-        self._generate_download_report(batch, successful_files, failed_files, skipped_files, batch_number)
+        self._generate_download_report(batch, successful_files, failed_files,
+                                       [file_item for file_item, _ in skipped_files], batch_number)
+        self._save_run_record(run_record)
         
         print(f"第{batch_number}批次下载完成！")
         
@@ -437,23 +924,19 @@ class UnbalancedTrainBatchDownloader:
         if failed_count > 0:
             print("\n下载失败的文件:")
             for i, file_item in enumerate(failed_files, 1):
-                size = file_item.get("size", "未知大小")
-                if isinstance(size, (int, float)):
-                    size = self._format_size(size)
-                print(f"  {i}. {file_item['name']} ({size})")
+                size = self._format_size(file_item.size)
+                print(f"  {i}. {file_item.name} ({size})")
             
             # 保存失败文件列表到文件
-            report_path = os.path.join(DOWNLOAD_PATH, f"batch_{batch_number}_failed_files.txt")
+            report_path = os.path.join(self.download_dir, f"batch_{batch_number}_failed_files.txt")
             try:
                 with open(report_path, "w") as f:
                     f.write(f"批次 {batch_number} 下载失败的文件列表\n")
                     f.write(f"创建时间: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
                     f.write("-"*60 + "\n")
                     for file_item in failed_files:
-                        size = file_item.get("size", "未知大小")
-                        if isinstance(size, (int, float)):
-                            size = self._format_size(size)
-                        f.write(f"{file_item['name']} ({size})\n")
+                        size = self._format_size(file_item.size)
+                        f.write(f"{file_item.name} ({size})\n")
                 print(f"\n下载失败文件列表已保存到: {report_path}")
             except Exception as e:
                 print(f"保存失败文件列表出错: {str(e)}")
@@ -462,8 +945,8 @@ class UnbalancedTrainBatchDownloader:
     
     def verify_batch(self, batch_number):
         """验证指定批次的下载情况"""
-        if batch_number < 1 or batch_number > 6:
-            print("批次号必须在1到6之间")
+        if batch_number < 1 or batch_number > self.batch_count:
+            print(f"批次号必须在1到{self.batch_count}之间")
             return
         
         print(f"开始验证第{batch_number}批次的文件...")
@@ -484,27 +967,34 @@ class UnbalancedTrainBatchDownloader:
         print(f"第{batch_number}批次应包含{len(batch)}个文件")
         
         # 检查批次目录
-        batch_dir = os.path.join(DOWNLOAD_PATH, f"batch_{batch_number}")
-        if not os.path.exists(batch_dir):
+        batch_dir = self.batch_dir(batch_number)
+        if not self.path_template and not os.path.exists(batch_dir):
             print(f"批次目录不存在: {batch_dir}")
             return
         
         # 验证每个文件
+        run_record = self._new_run_record("verify", batch_number)
         existing_files = []
         missing_files = []
         for file_item in batch:
-            local_path = os.path.join(batch_dir, file_item["name"])
+            local_path = self.local_path(batch_number, file_item)
             if os.path.exists(local_path):
                 # 检查文件大小是否正确
                 local_size = os.path.getsize(local_path)
-                remote_size = file_item.get("size", 0)
+                remote_size = file_item.size or 0
                 
                 if remote_size > 0 and abs(local_size - remote_size) > 100:  # 允许小误差
-                    missing_files.append((file_item, f"大小不匹配 (本地: {self._format_size(local_size)}, 远程: {self._format_size(remote_size)})"))
+                    reason = f"大小不匹配 (本地: {self._format_size(local_size)}, 远程: {self._format_size(remote_size)})"
+                    missing_files.append((file_item, reason))
+                    run_record.add_file(file_item, "size_mismatch", error_class="size_mismatch", error=reason)
                 else:
                     existing_files.append(file_item)
+                    run_record.add_file(file_item, "ok")
+                    if local_size == remote_size:
+                        self.dedup.record(file_item, local_path)
             else:
                 missing_files.append((file_item, "文件不存在"))
+                run_record.add_file(file_item, "missing", error_class="missing", error="文件不存在")
         
         # 生成验证报告
         print("\n" + "="*60)
@@ -514,43 +1004,150 @@ class UnbalancedTrainBatchDownloader:
         print(f"存在且正确: {len(existing_files)} ({len(existing_files)/len(batch)*100:.1f}%)")
         print(f"缺失或错误: {len(missing_files)} ({len(missing_files)/len(batch)*100:.1f}%)")
         print("-"*60)
+        self._batch_journal(batch_number).mark_many([file_item.id for file_item in existing_files], "verified")
         
         if missing_files:
             print("\n缺失或错误的文件:")
             for i, (file_item, reason) in enumerate(missing_files, 1):
-                size = file_item.get("size", "未知大小")
-                if isinstance(size, (int, float)):
-                    size = self._format_size(size)
-                print(f"  {i}. {file_item['name']} ({size}) - {reason}")
+                size = self._format_size(file_item.size)
+                print(f"  {i}. {file_item.name} ({size}) - {reason}")
             
             # 保存缺失文件列表到文件
-            report_path = os.path.join(DOWNLOAD_PATH, f"batch_{batch_number}_missing_files.txt")
+            report_path = os.path.join(self.download_dir, f"batch_{batch_number}_missing_files.txt")
             try:
                 with open(report_path, "w") as f:
                     f.write(f"批次 {batch_number} 缺失或错误的文件列表\n")
                     f.write(f"创建时间: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
                     f.write("-"*60 + "\n")
                     for file_item, reason in missing_files:
-                        size = file_item.get("size", "未知大小")
-                        if isinstance(size, (int, float)):
-                            size = self._format_size(size)
-                        f.write(f"{file_item['name']} ({size}) - {reason}\n")
+                        size = self._format_size(file_item.size)
+                        f.write(f"{file_item.name} ({size}) - {reason}\n")
                 print(f"\n缺失文件列表已保存到: {report_path}")
             except Exception as e:
                 print(f"保存缺失文件列表出错: {str(e)}")
         
         print("="*60)
+        self._save_run_record(run_record)
         
         return missing_files
     
+    def sync_batch(self, batch_number, delete_removed=False):
+        """增量同步指定批次: 只下载新增或变化的文件，可选删除远程已移除的文件
+        
+        比较远程的eTag/cTag、大小和修改时间与SYNC_STATE_FILE中的记录。如果驱动器支持
+        目标文件夹的delta查询且自上次同步后没有变化，只需一次请求即可结束同步。
+        """
+        if batch_number < 1 or batch_number > self.batch_count:
+            print(f"批次号必须在1到{self.batch_count}之间")
+            return False
+        
+        folder_id = self.get_unbalanced_train_id()
+        drive_id = self.get_drive_id()
+        # 每个批次保存自己的delta链接: 链接是共用的同一个文件夹的，
+        # 但一个批次同步后推进链接不代表其他批次已经处理了这些变化
+        root_key = f"{drive_id}:{folder_id}:batch_{batch_number}"
+        from sync_state import SyncState
+        state = SyncState(SYNC_STATE_FILE)
+        
+        try:
+            # 快速路径: delta显示目标文件夹没有变化时直接结束
+            delta_link = state.get_delta_link(root_key)
+            if delta_link and state.items_under(root_key):
+                changes, new_delta_link = self._fetch_delta(delta_link)
+                if changes is not None:
+                    changes = [c for c in changes if c.get("id") != folder_id]
+                    if not changes:
+                        state.set_delta_link(root_key, new_delta_link)
+                        print(f"第{batch_number}批次自上次同步以来没有变化")
+                        return True
+                    print(f"目标文件夹有 {len(changes)} 个项目发生变化，开始比对")
+            
+            # 在列出文件之前获取最新的delta链接，列表期间发生的变化会在下次同步时被发现
+            new_delta_link = self._get_latest_delta_link(folder_id, drive_id)
+            
+            files = self.get_all_files(refresh=True)
+            batches = self.split_into_batches(files)
+            if batch_number > len(batches):
+                print(f"只有{len(batches)}个批次可用")
+                return False
+            batch = batches[batch_number - 1]
+            
+            # 找出新增或变化的文件
+            download_tasks = []
+            for file_item in batch:
+                local_path = self.local_path(batch_number, file_item)
+                if state.needs_download(file_item, local_path, root_key):
+                    download_tasks.append((file_item, local_path))
+            
+            # 找出远程已移除的文件
+            batch_ids = {file_item.id for file_item in batch}
+            removed = [r for r in state.items_under(root_key) if r["item_id"] not in batch_ids]
+            
+            print(f"第{batch_number}批次: {len(batch)}个文件, 需要传输{len(download_tasks)}个, 远程已移除{len(removed)}个")
+            
+            for record in removed:
+                if delete_removed:
+                    try:
+                        if os.path.exists(record["local_path"]):
+                            os.remove(record["local_path"])
+                        state.remove(record["item_id"])
+                        print(f"已删除远程不存在的文件: {record['local_path']}")
+                    except Exception as e:
+                        print(f"删除文件失败: {record['local_path']}, 错误: {str(e)}")
+                else:
+                    print(f"远程已移除 (本地保留): {record['local_path']}")
+            
+            failed_files = []
+            if download_tasks:
+                print(f"开始并行同步 {len(download_tasks)} 个文件 (最大并行数: {self.max_workers})")
+                run_record = self._new_run_record("sync", batch_number)
+                _, failed_files = self._run_parallel_downloads(
+                    download_tasks,
+                    on_success=lambda file_item, local_path: state.mark_synced(file_item, local_path, root_key),
+                    run_record=run_record
+                )
+                self._save_run_record(run_record)
+            
+            if new_delta_link and not failed_files:
+                state.set_delta_link(root_key, new_delta_link)
+            
+            print(f"第{batch_number}批次同步完成，失败 {len(failed_files)} 个")
+            return len(failed_files) == 0
+        finally:
+            state.close()
+    
+    def _get_latest_delta_link(self, item_id, drive_id=None):
+        """获取指向当前时刻的delta链接，不支持delta时返回None"""
+        if not drive_id:
+            drive_id = self.get_drive_id()
+        endpoint = f"/drives/{drive_id}/items/{item_id}/delta"
+        result = self._make_api_request(endpoint, params={"token": "latest"})
+        if not result:
+            return None
+        return result.get("@odata.deltaLink")
+    
+    def _fetch_delta(self, delta_link):
+        """从delta链接获取全部变化，返回(变化列表, 新的delta链接)；失败时返回(None, None)"""
+        changes = []
+        endpoint = delta_link
+        while endpoint:
+            page = self._make_api_request(endpoint)
+            if not page or "value" not in page:
+                return None, None
+            changes.extend(page["value"])
+            if "@odata.deltaLink" in page:
+                return changes, page["@odata.deltaLink"]
+            endpoint = page.get("@odata.nextLink")
+        return None, None
+    
     def download_batch(self, batch_number, use_parallel=True):
         """下载指定批次的文件，支持选择是否使用并行下载"""
         if use_parallel:
             return self.download_batch_parallel(batch_number)
             
         # 以下是原来的顺序下载代码
-        if batch_number < 1 or batch_number > 6:
-            print("批次号必须在1到6之间")
+        if batch_number < 1 or batch_number > self.batch_count:
+            print(f"批次号必须在1到{self.batch_count}之间")
             return
         
         print(f"准备下载第{batch_number}批次的文件")
@@ -570,16 +1167,12 @@ class UnbalancedTrainBatchDownloader:
         batch = batches[batch_number - 1]
         print(f"第{batch_number}批次包含{len(batch)}个文件")
         
-        # 创建批次特定的下载文件夹
-        batch_dir = os.path.join(DOWNLOAD_PATH, f"batch_{batch_number}")
-        os.makedirs(batch_dir, exist_ok=True)
-        
         # 下载每个文件
         for file_item in batch:
-            local_path = os.path.join(batch_dir, file_item["name"])
+            local_path = self.local_path(batch_number, file_item)
             if os.path.exists(local_path):
                 file_size = os.path.getsize(local_path)
-                print(f"文件已存在，跳过: {file_item['name']} ({self._format_size(file_size)})")
+                print(f"文件已存在，跳过: {file_item.name} ({self._format_size(file_size)})")
                 continue
                 
             self.download_file(file_item, local_path)
@@ -588,6 +1181,128 @@ class UnbalancedTrainBatchDownloader:
         
         print(f"第{batch_number}批次下载完成！")
     
+    def relocate_batch(self, batch_number, source_template=None):
+        """把已下载的批次从旧的目录结构移动到当前的路径模板位置
+        
+        source_template为旧位置的模板 (默认 <download_dir>/batch_{batch}/{name})。只使用同一文件系统内的
+        原子重命名，不复制数据；目标在另一个文件系统上时停止并提示，目标已存在的文件保持不动。
+        """
+        if batch_number < 1 or batch_number > self.batch_count:
+            print(f"批次号必须在1到{self.batch_count}之间")
+            return False
+        if not self.path_template:
+            print("没有设置路径模板 (--path-template 或 DOWNLOAD_PATH_TEMPLATE)，不需要移动")
+            return False
+        
+        source_template = source_template or os.path.join(self.download_dir, "batch_{batch}", "{name}")
+        
+        batches = self.split_into_batches(self.get_all_files())
+        if batch_number > len(batches):
+            print(f"只有{len(batches)}个批次可用")
+            return False
+        
+        moved, already, missing = 0, 0, 0
+        from sync_state import SyncState
+        state = SyncState(SYNC_STATE_FILE)
+        try:
+            for file_item in batches[batch_number - 1]:
+                src = self._format_path(source_template, batch_number, file_item)
+                dst = self.local_path(batch_number, file_item)
+                if os.path.abspath(src) == os.path.abspath(dst) or os.path.exists(dst):
+                    already += 1
+                    continue
+                if not os.path.exists(src):
+                    missing += 1
+                    continue
+                os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+                try:
+                    os.rename(src, dst)
+                except OSError as e:
+                    if e.errno == errno.EXDEV:
+                        print(f"{src} 和 {dst} 不在同一个文件系统上，无法原子移动；"
+                              f"请把路径模板指向同一个文件系统，或直接用模板重新下载")
+                        return False
+                    raise
+                moved += 1
+                # 同步状态中记录的路径也要更新，否则下次同步会重新下载
+                record = state.get(file_item.id)
+                if record and record["local_path"] == src:
+                    state.mark_synced(file_item, dst, record["root_key"])
+        finally:
+            state.close()
+        
+        print(f"第{batch_number}批次: 移动 {moved} 个文件，已在目标位置 {already} 个，旧位置不存在 {missing} 个")
+        return True
+    
+    def select_batch_members(self, batch_number, patterns=(), names=None, output_dir=None):
+        """只下载批次中每个tar分片里选中的成员，不下载整个分片
+        
+        分片是未压缩的tar，成员位于固定偏移: 先用Range请求读取各个头部 (成员索引中有同一eTag的记录时直接使用)，
+        再把选中的成员合并成少量Range请求下载，写入 output_dir/<成员名> (默认 <download_dir>/selected)。
+        patterns为通配符，names为成员名单，都可以匹配完整路径或文件名。
+        """
+        if batch_number < 1 or batch_number > self.batch_count:
+            print(f"批次号必须在1到{self.batch_count}之间")
+            return False
+        output_dir = output_dir or os.path.join(self.download_dir, "selected")
+        
+        batches = self.split_into_batches(self.get_all_files())
+        if batch_number > len(batches):
+            print(f"只有{len(batches)}个批次可用")
+            return False
+        shards = [f for f in batches[batch_number - 1] if f.name.endswith(".tar")]
+        if len(shards) < len(batches[batch_number - 1]):
+            print(f"跳过 {len(batches[batch_number - 1]) - len(shards)} 个不是 .tar 的文件")
+        
+        import concurrent.futures
+        from tar_index import TarIndex
+        from remote_tar import RemoteFile, remote_source, scan_members, select_members, fetch_members
+        drive_id = self.get_drive_id()
+        index = TarIndex(TAR_INDEX_FILE)
+        
+        def select_shard(file_item):
+            remote = RemoteFile(self.session, lambda refresh=False: self.get_download_url(file_item),
+                                file_item.size, limiter=self.limiter)
+            source = remote_source(drive_id, file_item.id)
+            members = index.cached_members(source, file_item.size, file_item.etag)
+            if members is None:
+                with profiling.phase("scan_tar_headers", file=file_item.name):
+                    index.record(source, scan_members(remote), size=file_item.size, etag=file_item.etag)
+                members = index.members(source)
+            selected = select_members(members, patterns, names)
+            with profiling.phase("transfer", file=file_item.name):
+                fetched, transferred = fetch_members(remote, selected, output_dir)
+            return len(members), len(selected), fetched, transferred + remote.bytes_read, remote.requests
+        
+        print(f"\n第{batch_number}批次: 从 {len(shards)} 个分片中选择成员 -> {output_dir}")
+        totals = [0, 0, 0, 0, 0]
+        failed = []
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = {executor.submit(select_shard, file_item): file_item for file_item in shards}
+                for future in concurrent.futures.as_completed(futures):
+                    file_item = futures[future]
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        print(f"{file_item.name} 失败: {str(e)}")
+                        failed.append(file_item)
+                        continue
+                    totals = [a + b for a, b in zip(totals, result)]
+                    print(f"{file_item.name}: {result[1]}/{result[0]} 个成员匹配，下载 {result[2]} 个 "
+                          f"({self._format_size(result[3])}，{result[4]} 次请求)")
+        finally:
+            index.close()
+        
+        shard_bytes = sum(f.size or 0 for f in shards)
+        print("\n" + "=" * 60)
+        print(f"选择完成: {totals[1]}/{totals[0]} 个成员匹配，本次下载 {totals[2]} 个")
+        print(f"传输 {self._format_size(totals[3])} (整批分片 {self._format_size(shard_bytes)})，共 {totals[4]} 次Range请求")
+        if failed:
+            print(f"失败的分片: {', '.join(f.name for f in failed)}，重新运行会跳过已下载的成员")
+        print("=" * 60)
+        return not failed
+    
     def list_all_batches(self):
         """列出所有批次及其包含的文件"""
         # 获取所有文件
@@ -603,21 +1318,60 @@ class UnbalancedTrainBatchDownloader:
         for i, batch in enumerate(batches, 1):
             print(f"\n批次 {i} (包含 {len(batch)} 个文件):")
             for j, file_item in enumerate(batch, 1):
-                size = file_item.get("size", "未知大小")
-                if isinstance(size, (int, float)):
-                    size = self._format_size(size)
-                print(f"  {j}. {file_item['name']} ({size})")
+                size = self._format_size(file_item.size)
+                print(f"  {j}. {file_item.name} ({size})")
+    
+    def set_rate_limit(self, rate):
+        """设置下载限速(字节/秒)，None表示不限速，运行期间修改立即生效"""
+        self.limiter.set_rate(rate)
+        if rate:
+            print(f"设置下载限速为: {self._format_size(rate)}/s")
+        else:
+            print("已取消下载限速")
     
     def set_max_workers(self, workers):
-        """设置最大并行下载数量"""
+        """设置最大并行下载数量，下载中修改时立即生效"""
         self.max_workers = max(1, min(20, workers))  # 限制在1-20之间
         print(f"设置最大并行下载数量为: {self.max_workers}")
+        scheduler = self.scheduler
+        if scheduler is not None:
+            scheduler.set_workers(self.max_workers)
+    
+    def enqueue_batch(self, batch_number):
+        """把另一个批次加入正在进行的下载 (控制接口的add命令)，返回加入的文件数
+        
+        新批次有自己的运行日志，和单独运行时一样可以中断后继续；本地已存在的文件跳过。
+        """
+        scheduler = self.scheduler
+        if scheduler is None:
+            raise RuntimeError("当前没有正在进行的下载")
+        if batch_number < 1 or batch_number > self.batch_count:
+            raise ValueError(f"批次号必须在1到{self.batch_count}之间")
+        batch = self.split_into_batches(self.get_all_files())[batch_number - 1]
+        download_tasks, skipped = [], []
+        for file_item in batch:
+            local_path = self.local_path(batch_number, file_item)
+            (skipped if os.path.exists(local_path) else download_tasks).append((file_item, local_path))
+        journal = self._batch_journal(batch_number)
+        journal.begin(download_tasks, skipped, self.drive_id, self.unbalanced_train_id)
+        
+        def on_success(file_item, local_path):
+            journal.downloaded(file_item.id)
+            self.dedup.record(file_item, local_path)
+        
+        added = scheduler.add_tasks(download_tasks, journal, on_success, group=f"第{batch_number}批次")
+        print(f"已加入第{batch_number}批次: {added} 个文件 (本地已存在 {len(skipped)} 个)")
+        return added
     
     def download_missing_files(self, batch_number):
         """下载指定批次中缺失的文件"""
-        if batch_number < 1 or batch_number > 6:
-            print("批次号必须在1到6之间")
+        if batch_number < 1 or batch_number > self.batch_count:
+            print(f"批次号必须在1到{self.batch_count}之间")
             return False
+        
+        resumed = self._resume_batch(batch_number, "missing")
+        if resumed is not None:
+            return resumed
             
         print(f"开始检查第{batch_number}批次中缺失的文件...")
         
@@ -630,14 +1384,10 @@ class UnbalancedTrainBatchDownloader:
             
         print(f"发现{len(missing_files)}个缺失或错误的文件，准备下载...")
         
-        # 创建批次特定的下载文件夹
-        batch_dir = os.path.join(DOWNLOAD_PATH, f"batch_{batch_number}")
-        os.makedirs(batch_dir, exist_ok=True)
-        
         # 准备下载任务
         download_tasks = []
         for file_item, reason in missing_files:
-            local_path = os.path.join(batch_dir, file_item["name"])
+            local_path = self.local_path(batch_number, file_item)
             
             # 如果是大小不匹配，先删除现有文件
             if "大小不匹配" in reason and os.path.exists(local_path):
@@ -654,37 +1404,20 @@ class UnbalancedTrainBatchDownloader:
             print("没有需要下载的文件")
             return True
             
+        # 验证通过的文件和待下载的文件一起写入运行日志
+        missing_ids = {file_item.id for file_item, _ in missing_files}
+        batch = self.split_into_batches(self.get_all_files())[batch_number - 1]
+        verified = [(f, self.local_path(batch_number, f)) for f in batch if f.id not in missing_ids]
+        journal = self._batch_journal(batch_number)
+        journal.begin(download_tasks, verified, self.drive_id, self.unbalanced_train_id, done_state="verified")
+            
         print(f"开始并行下载 {len(download_tasks)} 个缺失文件 (最大并行数: {self.max_workers})")
         
         # 使用线程池并行下载
-        successful_files = []
-        failed_files = []
-        
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            # 提交所有任务
-            future_to_file = {
-                executor.submit(self.download_file_worker, task): task[0]
-                for task in download_tasks
-            }
-            
-            # 处理完成的任务
-            completed = 0
-            for future in concurrent.futures.as_completed(future_to_file):
-                file_item = future_to_file[future]
-                filename = file_item['name']
-                try:
-                    success = future.result()
-                    completed += 1
-                    print(f"完成进度: {completed}/{len(download_tasks)} ({completed/len(download_tasks)*100:.1f}%)")
-                    
-                    if success:
-                        successful_files.append(file_item)
-                    else:
-                        failed_files.append(file_item)
-                        
-                except Exception as e:
-                    print(f"{filename} 下载时发生错误: {str(e)}")
-                    failed_files.append(file_item)
+        run_record = self._new_run_record("missing", batch_number)
+        successful_files, failed_files = self._run_parallel_downloads(
+            download_tasks, run_record=run_record, journal=journal
+        )
         
         # 生成下载报告
         print("\n" + "="*60)
@@ -698,70 +1431,208 @@ class UnbalancedTrainBatchDownloader:
         if failed_files:
             print("\n以下文件下载失败:")
             for i, file_item in enumerate(failed_files, 1):
-                size = file_item.get("size", "未知大小")
-                if isinstance(size, (int, float)):
-                    size = self._format_size(size)
-                print(f"  {i}. {file_item['name']} ({size})")
+                size = self._format_size(file_item.size)
+                print(f"  {i}. {file_item.name} ({size})")
         
         print("="*60)
+        self._save_run_record(run_record)
         
         return len(failed_files) == 0
 
+def show_stats(batch_number=None, last=10):
+    """stats [批次号] [--last=N]: 比较历史运行的吞吐量，不需要登录"""
+    if not os.path.exists(RUN_HISTORY_FILE):
+        print("没有历史运行记录")
+        return
+    from run_history import RunHistory, print_stats
+    history = RunHistory(RUN_HISTORY_FILE)
+    try:
+        print_stats(history, batch_number, last)
+    finally:
+        history.close()
+
+CLI_EPILOG = """示例:
+  python batch_download_unbalanced_train.py 1 10 --limit=50M   (等同于 download 1 10)
+  python batch_download_unbalanced_train.py verify 1 --offline
+  python batch_download_unbalanced_train.py select 1 --members='*.flac' --output=downloads/a_t5/train
+  python batch_download_unbalanced_train.py job jobs.json verify
+
+下载和missing命令被中断后重新运行会从运行日志继续 (不重新列出远程目录)，加 --fresh 忽略日志重新规划。
+所有命令都可以加 --profile[=cprofile|sample] 记录各阶段耗时，结果写入 profiles/ (可用 --profile-dir=<目录> 指定)。
+"""
+
+def _common_options():
+    """所有子命令共用的选项，可以写在子命令的前面或后面"""
+    parser = argparse.ArgumentParser(add_help=False)
+    # 默认值为SUPPRESS，写在子命令前面的选项不会被子命令的默认值覆盖
+    options = parser.add_argument_group("通用选项")
+    options.add_argument("--limit", default=argparse.SUPPRESS, metavar="速率", help="限制总带宽，例如 50M")
+    options.add_argument("--order", default=argparse.SUPPRESS, choices=("largest", "smallest", "listing"),
+                         help="下载顺序 (默认largest，大文件优先)")
+    options.add_argument("--path-template", default=argparse.SUPPRESS, metavar="模板",
+                         help="直接写入最终目录，例如 downloads/a_t5/{split}/{name}")
+    options.add_argument("--split", default=argparse.SUPPRESS, choices=("train", "test", "valid"),
+                         help="路径模板中{split}的值 (默认train)")
+    options.add_argument("--fresh", action="store_true", default=argparse.SUPPRESS, help="忽略运行日志重新规划")
+    options.add_argument("--metrics-port", default=argparse.SUPPRESS, metavar="端口", help="提供 /metrics 端点")
+    options.add_argument("--metrics-log", default=argparse.SUPPRESS, metavar="文件", help="定期写入JSON指标")
+    options.add_argument("--control", default=argparse.SUPPRESS, metavar="地址",
+                         help="启动控制接口，例如 unix:///tmp/clap_download.sock (见download_control.py)")
+    return parser
+
+def build_parser():
+    common = _common_options()
+    parser = argparse.ArgumentParser(
+        prog="batch_download_unbalanced_train.py", parents=[common], epilog=CLI_EPILOG,
+        description="分批下载SharePoint上的CLAP数据集", formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    subparsers = parser.add_subparsers(dest="command", metavar="<命令>")
+
+    def add_command(name, help_text):
+        return subparsers.add_parser(name, help=help_text, description=help_text, parents=[common])
+
+    def add_batch(command, workers=False):
+        command.add_argument("batch", type=int, help="批次号")
+        if workers:
+            command.add_argument("workers", type=int, nargs="?", help="并行数量 (1-20，默认5)")
+        return command
+
+    add_command("help", "显示帮助")
+    add_command("list", "列出所有批次及其包含的文件")
+    add_batch(add_command("download", "下载指定批次的文件 (也可以直接写批次号)"), workers=True)
+    verify = add_batch(add_command("verify", "验证指定批次的下载情况"))
+    verify.add_argument("--offline", action="store_true", help="使用上次保存的文件列表，不登录也不访问网络")
+    add_batch(add_command("missing", "只下载指定批次中缺失的文件"), workers=True)
+    sync = add_batch(add_command("sync", "增量同步指定批次 (只传输新增或变化的文件)"), workers=True)
+    sync.add_argument("--delete", action="store_true", help="删除远程已经移除的本地文件")
+    select = add_batch(add_command("select", "按Range请求只下载分片中选中的成员"), workers=True)
+    select.add_argument("--members", action="append", default=[], metavar="通配符", help="要下载的成员，可以写多个")
+    select.add_argument("--members-from", metavar="名单", help="成员名单文件，每行一个成员名或文件名")
+    select.add_argument("--output", metavar="目录", help="输出目录 (默认 downloads/selected)")
+    relocate = add_batch(add_command("relocate", "把已下载的文件原子移动到 --path-template 的位置"))
+    relocate.add_argument("--from", dest="source_template", metavar="旧模板",
+                          help="旧位置的模板 (默认 downloads/batch_{batch}/{name})")
+    stats = add_command("stats", "比较历史运行的吞吐量和失败原因 (不需要登录)")
+    stats.add_argument("batch", type=int, nargs="?", help="只看指定批次")
+    stats.add_argument("--last", type=int, default=10, help="列出最近的N次运行")
+    job = add_command("job", "按作业文件(JSON/YAML)并发处理多个数据集")
+    job.add_argument("job_file", help="作业文件")
+    job.add_argument("job_command", nargs="?", default="download",
+                     choices=("download", "verify", "missing", "sync", "relocate"), help="默认download")
+    return parser
+
+def parse_cli_args(argv):
+    """解析命令行参数，兼容旧的 "<批次号> [并行数量]" 写法"""
+    # --profile 在main()中已经处理
+    argv = [arg for arg in argv if not arg.startswith("--profile")]
+    first = next((i for i, arg in enumerate(argv) if not arg.startswith("-")), None)
+    if first is not None and argv[first].isdigit():
+        argv.insert(first, "download")
+    parser = build_parser()
+    return parser, parser.parse_args(argv)
+
 def main():
+    # --profile[=cprofile|sample] 需要在登录之前开始，才能记录获取令牌的耗时
+    profile_mode = None
+    profile_dir = os.path.join("profiles", time.strftime("%Y%m%d_%H%M%S"))
+    for arg in sys.argv:
+        if arg == "--profile":
+            profile_mode = "phases"
+        elif arg.startswith("--profile="):
+            profile_mode = arg.split("=", 1)[1]
+        elif arg.startswith("--profile-dir="):
+            profile_dir = arg.split("=", 1)[1]
+    
+    if not profile_mode:
+        _run_cli()
+        return
+    try:
+        with profiling.profile_run(profile_mode, profile_dir):
+            _run_cli()
+    except ValueError as e:
+        print(str(e))
+
+def _run_cli(argv=None):
+    parser, args = parse_cli_args(sys.argv[1:] if argv is None else argv)
+    command = args.command
+    if command in (None, "help"):
+        parser.print_help()
+        return
+    if command == "stats":
+        show_stats(args.batch, args.last)
+        return
+    
+    stop_metrics_logger = None
+    stop_control = None
     try:
-        downloader = UnbalancedTrainBatchDownloader()
-        
-        if len(sys.argv) < 2:
-            # 如果没有提供参数，显示用法信息
-            print("用法:")
-            print("  python batch_download_unbalanced_train.py list  - 列出所有批次及其包含的文件")
-            print("  python batch_download_unbalanced_train.py <批次号>  - 下载指定批次的文件 (1-6)")
-            print("  python batch_download_unbalanced_train.py <批次号> <并行数量>  - 设置并行下载数量并下载")
-            print("  python batch_download_unbalanced_train.py verify <批次号>  - 验证指定批次的下载情况")
-            print("  python batch_download_unbalanced_train.py missing <批次号>  - 只下载指定批次中缺失的文件")
+        rate_limit = parse_rate(args.limit) if getattr(args, "limit", None) else None
+        metrics_port = getattr(args, "metrics_port", METRICS_PORT)
+        metrics_log = getattr(args, "metrics_log", METRICS_LOG_FILE)
+        if metrics_port:
+            metrics.start_metrics_server(int(metrics_port))
+        if metrics_log:
+            stop_metrics_logger = metrics.start_json_logger(metrics_log, METRICS_LOG_INTERVAL)
+        
+        if command == "job":
+            # 按作业文件下载多个数据集
+            from dataset_jobs import load_job_spec
+            job = load_job_spec(args.job_file)
+            job.run(args.job_command, rate_limit=rate_limit)
             return
-            
-        command = sys.argv[1].lower()
+        
+        downloader = UnbalancedTrainBatchDownloader(
+            path_template=getattr(args, "path_template", DOWNLOAD_PATH_TEMPLATE),
+            split=getattr(args, "split", "train")
+        )
+        if rate_limit:
+            downloader.set_rate_limit(rate_limit)
+        if getattr(args, "order", None):
+            downloader.set_order_policy(args.order)
+        if getattr(args, "fresh", False):
+            downloader.resume = False
+        if getattr(args, "workers", None):
+            downloader.set_max_workers(args.workers)
+        control_address = getattr(args, "control", CONTROL_ADDRESS)
+        if control_address and command in ("download", "missing", "sync"):
+            from download_control import start_control_server
+            stop_control = start_control_server(downloader, control_address)
         
         if command == "list":
             # 列出所有批次
             downloader.list_all_batches()
-        elif command == "verify" and len(sys.argv) > 2 and sys.argv[2].isdigit():
-            # 验证指定批次
-            batch_number = int(sys.argv[2])
-            downloader.verify_batch(batch_number)
-        elif command == "missing" and len(sys.argv) > 2 and sys.argv[2].isdigit():
+        elif command == "verify":
+            # 验证指定批次，--offline时使用保存的文件列表
+            downloader.offline = args.offline
+            downloader.verify_batch(args.batch)
+        elif command == "relocate":
+            # 把旧目录结构中的文件移动到路径模板的位置
+            downloader.relocate_batch(args.batch, args.source_template)
+        elif command == "sync":
+            # 增量同步指定批次
+            downloader.sync_batch(args.batch, delete_removed=args.delete)
+        elif command == "missing":
             # 下载缺失文件
-            batch_number = int(sys.argv[2])
-            # 检查是否提供了并行数量参数
-            if len(sys.argv) > 3 and sys.argv[3].isdigit():
-                workers = int(sys.argv[3])
-                downloader.set_max_workers(workers)
-            downloader.download_missing_files(batch_number)
-        elif command.isdigit():
-            # 下载指定批次
-            batch_number = int(command)
-            
-            # 检查是否提供了并行数量参数
-            if len(sys.argv) > 2 and sys.argv[2].isdigit():
-                workers = int(sys.argv[2])
-                downloader.set_max_workers(workers)
-                
+            downloader.download_missing_files(args.batch)
+        elif command == "select":
+            # 只下载分片中选中的成员
+            names = None
+            if args.members_from:
+                from remote_tar import read_manifest
+                names = read_manifest(args.members_from)
+            downloader.select_batch_members(args.batch, args.members, names, args.output)
+        elif command == "download":
             # 使用并行下载
-            downloader.download_batch(batch_number)
-        else:
-            print("无效的命令")
-            print("用法:")
-            print("  python batch_download_unbalanced_train.py list  - 列出所有批次及其包含的文件")
-            print("  python batch_download_unbalanced_train.py <批次号>  - 下载指定批次的文件 (1-6)")
-            print("  python batch_download_unbalanced_train.py <批次号> <并行数量>  - 设置并行下载数量并下载")
-            print("  python batch_download_unbalanced_train.py verify <批次号>  - 验证指定批次的下载情况")
-            print("  python batch_download_unbalanced_train.py missing <批次号>  - 只下载指定批次中缺失的文件")
+            downloader.download_batch(args.batch)
             
     except Exception as e:
         print(f"发生错误: {str(e)}")
         import traceback
         traceback.print_exc()
+    finally:
+        if stop_control:
+            stop_control()
+        if stop_metrics_logger:
+            stop_metrics_logger()
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
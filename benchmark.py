@@ -0,0 +1,493 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+离线基准测试: 在本地启动一个模拟Microsoft Graph/SharePoint CDN的HTTP服务器，
+用真实的下载代码路径测量吞吐量，不需要访问线上租户。
+
+模拟服务器支持:
+  /sites/{hostname}:{path}、/sites/{id}/drives
+  /drives/{id}/root/children、/drives/{id}/items/{id}/children (分页)
+  /drives/{id}/items/{id}、/$batch
+  /download/{id} (支持Range请求)
+并可以注入请求延迟、单连接带宽上限、429限流、连接中断和下载链接过期。
+
+用法示例:
+  python benchmark.py --files 200 --size 4M --workers 8
+  python benchmark.py --files 50 --size 64M --bandwidth 20M --throttle-rate 0.05 --drop-rate 0.02
+  python benchmark.py --files 8 --size 32M --bandwidth 8M --url-ttl 1
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import requests
+
+from rate_limiter import parse_rate, BandwidthLimiter
+import metrics
+import profiling
+
+class MockDataset:
+    """模拟的SharePoint站点: 一个文档库中按relative_path嵌套的文件夹，最后一级包含若干文件
+
+    文件内容由文件ID确定性生成，不占用内存，可以按任意Range读取。
+    duplicate_rate比例的文件与之前的某个文件内容相同(哈希相同)，用于测试按内容去重。
+    最后empty_files个文件大小为0，用于测试空文件。
+    """
+
+    def __init__(self, relative_path, file_count, file_size, size_jitter=0.0, seed=0, duplicate_rate=0.0,
+                 empty_files=0):
+        self.drive_id = "b!benchmark-drive"
+        self.site_id = "benchmark-site"
+        self.folders = {}  # 文件夹ID -> [子项目]
+        self.items = {}  # 项目ID -> 项目
+        self.content_ids = {}  # 文件ID -> 生成内容使用的ID
+        self.root_children = []
+
+        rng = random.Random(seed)
+        parent_children = self.root_children
+        parent_id = "root"
+        for depth, name in enumerate(relative_path.strip("/").split("/")):
+            folder_id = f"folder{depth}"
+            folder = {"id": folder_id, "name": name, "folder": {"childCount": 1},
+                      "parentReference": {"driveId": self.drive_id, "id": parent_id}}
+            parent_children.append(folder)
+            self.items[folder_id] = folder
+            self.folders[folder_id] = []
+            parent_children = self.folders[folder_id]
+            parent_id = folder_id
+
+        self.target_folder_id = parent_id
+        for i in range(file_count):
+            size = max(1, int(file_size * (1 + rng.uniform(-size_jitter, size_jitter))))
+            if i >= file_count - empty_files:
+                size = 0
+            item_id = f"file{i:06d}"
+            content_id = item_id
+            if i > 0 and rng.random() < duplicate_rate:
+                content_id = self.content_ids[f"file{rng.randrange(i):06d}"]
+                size = self.items[content_id]["size"]
+            self.content_ids[item_id] = content_id
+            quick_xor_hash = hashlib.sha1(f"{content_id}:{size}".encode()).hexdigest()[:27] + "="
+            item = {
+                "id": item_id, "name": f"{i}.tar", "size": size,
+                "file": {"mimeType": "application/x-tar", "hashes": {"quickXorHash": quick_xor_hash}},
+                "eTag": f'"{{{item_id}}},1"', "cTag": f'"c:{{{item_id}}},1"',
+                "lastModifiedDateTime": "2024-01-01T00:00:00Z",
+                "parentReference": {"driveId": self.drive_id, "id": parent_id},
+            }
+            parent_children.append(item)
+            self.items[item_id] = item
+        self.items[self.target_folder_id]["folder"]["childCount"] = file_count
+
+    @staticmethod
+    def _block(item_id):
+        return hashlib.sha256(item_id.encode()).digest() * 2048  # 64KB的重复块
+
+    def read(self, item_id, start, end):
+        """读取文件的 [start, end) 区间"""
+        block = self._block(self.content_ids[item_id])
+        block_size = len(block)
+        out = bytearray()
+        pos = start
+        while pos < end:
+            offset = pos % block_size
+            take = min(block_size - offset, end - pos)
+            out += block[offset:offset + take]
+            pos += take
+        return bytes(out)
+
+    def checksum(self, item_id):
+        """完整文件内容的sha1，用于校验下载结果"""
+        sha1 = hashlib.sha1()
+        size = self.items[item_id]["size"]
+        for start in range(0, size, 4 * 1024 * 1024):
+            sha1.update(self.read(item_id, start, min(size, start + 4 * 1024 * 1024)))
+        return sha1.hexdigest()
+
+class MockGraphServer:
+    """模拟Graph API和下载CDN的本地HTTP服务器"""
+
+    def __init__(self, dataset, latency=0.0, bandwidth=None, throttle_rate=0.0,
+                 drop_rate=0.0, page_size=200, seed=0, url_ttl=0.0):
+        self.dataset = dataset
+        self.latency = latency  # 每个请求的额外延迟(秒)
+        self.bandwidth = bandwidth  # 每个下载连接的带宽上限(字节/秒)
+        self.throttle_rate = throttle_rate  # Graph请求返回429的概率
+        self.drop_rate = drop_rate  # 下载中途断开连接的概率
+        self.page_size = page_size
+        self.url_ttl = url_ttl  # 下载链接的有效秒数，过期后返回401 (0表示不过期)
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.stats = {"graph_calls": 0, "download_calls": 0, "throttled": 0, "dropped": 0, "expired": 0, "bytes_sent": 0}
+
+        handler = self._make_handler()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.httpd.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_port}"
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _chance(self, probability):
+        if probability <= 0:
+            return False
+        with self._rng_lock:
+            return self._rng.random() < probability
+
+    def _count(self, key, amount=1):
+        with self._stats_lock:
+            self.stats[key] += amount
+
+    def _graph_response(self, path, query):
+        """处理单个Graph GET请求，返回(状态码, JSON对象)"""
+        dataset = self.dataset
+        base = f"{self.base_url}/v1.0"
+
+        if re.match(r"^/sites/[^/]+:/", path):
+            return 200, {"id": dataset.site_id}
+        if path == f"/sites/{dataset.site_id}/drives":
+            return 200, {"value": [{"id": dataset.drive_id, "name": "datasets"}]}
+
+        match = re.match(r"^/drives/[^/]+/(?:root|items/([^/]+))(/children)?$", path)
+        if not match:
+            return 404, {"error": {"code": "itemNotFound", "message": path}}
+
+        item_id = match.group(1)
+        if match.group(2):
+            children = dataset.root_children if item_id is None else dataset.folders.get(item_id)
+            if children is None:
+                return 404, {"error": {"code": "itemNotFound"}}
+            skip = int(query.get("$skiptoken", ["0"])[0])
+            page = [self._with_download_url(child) for child in children[skip:skip + self.page_size]]
+            select = query.get("$select", [""])[0]
+            if select:
+                # 和Graph一样只返回$select指定的字段，nextLink中保留$select
+                fields = set(select.split(","))
+                page = [{k: v for k, v in child.items() if k in fields} for child in page]
+            result = {"value": page}
+            if skip + self.page_size < len(children):
+                select_query = f"&$select={select}" if select else ""
+                result["@odata.nextLink"] = f"{base}{path}?$skiptoken={skip + self.page_size}{select_query}"
+            return 200, result
+
+        item = dataset.items.get(item_id)
+        if item is None:
+            return 404, {"error": {"code": "itemNotFound"}}
+        return 200, self._with_download_url(item)
+
+    def _with_download_url(self, item):
+        if "file" not in item:
+            return item
+        item = dict(item)
+        download_url = f"{self.base_url}/download/{item['id']}"
+        if self.url_ttl:
+            download_url += f"?expires={time.time() + self.url_ttl:.3f}"
+        item["@microsoft.graph.downloadUrl"] = download_url
+        return item
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, status, obj, extra_headers=None):
+                body = json.dumps(obj).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for key, value in (extra_headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _throttled(self):
+                if server._chance(server.throttle_rate):
+                    server._count("throttled")
+                    self._send_json(429, {"error": {"code": "tooManyRequests"}}, {"Retry-After": "1"})
+                    return True
+                return False
+
+            def do_GET(self):
+                if server.latency:
+                    time.sleep(server.latency)
+                parsed = urlparse(self.path)
+                if parsed.path.startswith("/download/"):
+                    expires = parse_qs(parsed.query).get("expires")
+                    if expires and float(expires[0]) < time.time():
+                        server._count("download_calls")
+                        server._count("expired")
+                        return self._send_json(401, {"error": {"code": "unauthenticated", "message": "链接已过期"}})
+                    return self._download(parsed.path[len("/download/"):])
+
+                server._count("graph_calls")
+                if not parsed.path.startswith("/v1.0/"):
+                    return self._send_json(404, {"error": {"code": "notFound"}})
+                if self._throttled():
+                    return
+                status, obj = server._graph_response(parsed.path[len("/v1.0"):], parse_qs(parsed.query))
+                self._send_json(status, obj)
+
+            def do_POST(self):
+                if server.latency:
+                    time.sleep(server.latency)
+                server._count("graph_calls")
+                parsed = urlparse(self.path)
+                length = int(self.headers.get("Content-Length", 0))
+                payload = json.loads(self.rfile.read(length) or b"{}")
+                if parsed.path != "/v1.0/$batch":
+                    return self._send_json(404, {"error": {"code": "notFound"}})
+                if self._throttled():
+                    return
+
+                responses = []
+                for request in payload.get("requests", []):
+                    sub = urlparse(request.get("url", ""))
+                    status, obj = server._graph_response("/" + sub.path.lstrip("/"), parse_qs(sub.query))
+                    responses.append({"id": request.get("id"), "status": status, "body": obj})
+                self._send_json(200, {"responses": responses})
+
+            def _download(self, item_id):
+                server._count("download_calls")
+                item = server.dataset.items.get(item_id)
+                if item is None or "file" not in item:
+                    return self._send_json(404, {"error": {"code": "itemNotFound"}})
+
+                size = item["size"]
+                start, end = 0, size
+                range_header = self.headers.get("Range")
+                if range_header:
+                    match = re.match(r"bytes=(\d+)-(\d*)", range_header)
+                    start = int(match.group(1))
+                    end = min(size, int(match.group(2)) + 1) if match.group(2) else size
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{end - 1}/{size}")
+                else:
+                    self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(end - start))
+                self.send_header("Accept-Ranges", "bytes")
+                self.end_headers()
+
+                drop_at = None
+                if server._chance(server.drop_rate):
+                    drop_at = start + (end - start) // 2
+
+                chunk_size = 64 * 1024
+                pos = start
+                begin = time.time()
+                try:
+                    while pos < end:
+                        if drop_at is not None and pos >= drop_at:
+                            server._count("dropped")
+                            self.close_connection = True
+                            self.connection.shutdown(2)
+                            return
+                        take = min(chunk_size, end - pos)
+                        self.wfile.write(server.dataset.read(item_id, pos, pos + take))
+                        pos += take
+                        server._count("bytes_sent", take)
+                        if server.bandwidth:
+                            # 按单连接带宽上限限速
+                            expected = (pos - start) / server.bandwidth
+                            delay = expected - (time.time() - begin)
+                            if delay > 0:
+                                time.sleep(delay)
+                except (BrokenPipeError, ConnectionResetError):
+                    # 客户端提前关闭连接(例如尾部拆分后停止读取)
+                    self.close_connection = True
+
+        return Handler
+
+class _TimingSession(requests.Session):
+    """记录下载请求首字节时间(响应头到达)的Session"""
+
+    def __init__(self, download_prefix):
+        super().__init__()
+        self.download_prefix = download_prefix
+        self.ttfb = []
+        self._lock = threading.Lock()
+
+    def request(self, method, url, *args, **kwargs):
+        start = time.perf_counter()
+        response = super().request(method, url, *args, **kwargs)
+        if url.startswith(self.download_prefix):
+            with self._lock:
+                self.ttfb.append(time.perf_counter() - start)
+        return response
+
+def _percentile(values, percent):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100.0 * (len(values) - 1))))
+    return values[index]
+
+def run_benchmark(args):
+    """启动模拟服务器，用UnbalancedTrainBatchDownloader完整执行站点解析、列表和并行下载"""
+    import batch_download_unbalanced_train as batch_module
+
+    relative_path = "/CLAP_audio_dataset/a_t5/unbalanced_train"
+    dataset = MockDataset(relative_path, args.files, parse_rate(args.size), args.size_jitter, seed=args.seed,
+                          duplicate_rate=args.duplicate_rate, empty_files=args.empty_files)
+    server = MockGraphServer(
+        dataset,
+        latency=args.latency,
+        bandwidth=parse_rate(args.bandwidth) if args.bandwidth else None,
+        throttle_rate=args.throttle_rate,
+        drop_rate=args.drop_rate,
+        page_size=args.page_size,
+        seed=args.seed,
+        url_ttl=args.url_ttl
+    ).start()
+
+    work_dir = tempfile.mkdtemp(prefix="onedrive_benchmark_")
+    old_cwd = os.getcwd()
+    old_graph_base = batch_module.GRAPH_API_BASE
+    try:
+        os.chdir(work_dir)
+        batch_module.GRAPH_API_BASE = f"{server.base_url}/v1.0"
+
+        downloader = batch_module.UnbalancedTrainBatchDownloader(access_token="benchmark")
+        downloader.max_workers = args.workers
+        downloader.order_policy = args.order
+        downloader.split_threshold = parse_rate(args.split_threshold)
+        downloader.limiter = BandwidthLimiter(rate=parse_rate(args.limit) if args.limit else None)
+
+        timing_session = _TimingSession(f"{server.base_url}/download/")
+        for prefix, adapter in downloader.session.adapters.items():
+            timing_session.mount(prefix, adapter)
+        downloader.session = timing_session
+
+        start = time.perf_counter()
+        files = downloader.get_all_files()
+        listing_seconds = time.perf_counter() - start
+
+        download_dir = os.path.join(work_dir, "downloads", "benchmark")
+        tasks = [(file_item, os.path.join(download_dir, file_item["name"])) for file_item in files]
+        download_start = time.perf_counter()
+        successful, failed = downloader._run_parallel_downloads(tasks)
+        download_seconds = time.perf_counter() - download_start
+        total_seconds = time.perf_counter() - start
+
+        corrupt = 0
+        if args.verify:
+            for file_item in successful:
+                path = os.path.join(download_dir, file_item["name"])
+                with open(path, "rb") as f:
+                    if hashlib.sha1(f.read()).hexdigest() != dataset.checksum(file_item["id"]):
+                        corrupt += 1
+
+        total_bytes = sum(file_item["size"] for file_item in successful)
+        file_count = max(1, len(files))
+        return {
+            "files": len(files),
+            "successful": len(successful),
+            "failed": len(failed),
+            "corrupt": corrupt,
+            "bytes": total_bytes,
+            "listing_seconds": listing_seconds,
+            "download_seconds": download_seconds,
+            "total_seconds": total_seconds,
+            "files_per_second": len(successful) / download_seconds if download_seconds else 0.0,
+            "mb_per_second": total_bytes / 1024 / 1024 / download_seconds if download_seconds else 0.0,
+            "graph_calls": server.stats["graph_calls"],
+            "graph_calls_per_file": server.stats["graph_calls"] / file_count,
+            "download_requests": server.stats["download_calls"],
+            "throttled": server.stats["throttled"],
+            "dropped": server.stats["dropped"],
+            "expired": server.stats["expired"],
+            "ttfb_p50_ms": _percentile(timing_session.ttfb, 50) * 1000,
+            "ttfb_p99_ms": _percentile(timing_session.ttfb, 99) * 1000,
+            "retries": sum(value for _, _, value in metrics.RETRIES.samples()),
+        }
+    finally:
+        batch_module.GRAPH_API_BASE = old_graph_base
+        os.chdir(old_cwd)
+        server.stop()
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+def print_report(result):
+    print("\n" + "=" * 60)
+    print("基准测试结果")
+    print("=" * 60)
+    print(f"文件数: {result['files']} (成功 {result['successful']}, 失败 {result['failed']}, 校验错误 {result['corrupt']})")
+    print(f"总数据量: {result['bytes'] / 1024 / 1024:.1f} MB")
+    print(f"列表耗时: {result['listing_seconds']:.2f} 秒, 下载耗时: {result['download_seconds']:.2f} 秒")
+    print(f"吞吐量: {result['files_per_second']:.2f} 文件/秒, {result['mb_per_second']:.2f} MB/秒")
+    print(f"Graph请求: {result['graph_calls']} 次 ({result['graph_calls_per_file']:.2f} 次/文件)")
+    print(f"下载请求: {result['download_requests']} 次, 限流(429): {result['throttled']} 次, "
+          f"连接中断: {result['dropped']} 次, 链接过期: {result['expired']} 次")
+    print(f"首字节时间: p50 {result['ttfb_p50_ms']:.1f} ms, p99 {result['ttfb_p99_ms']:.1f} ms")
+    print(f"客户端重试: {result['retries']} 次")
+    print("=" * 60)
+
+def main():
+    parser = argparse.ArgumentParser(description="在本地模拟服务器上测量批量下载器的吞吐量")
+    parser.add_argument("--files", type=int, default=100, help="文件数量")
+    parser.add_argument("--size", default="4M", help="平均文件大小，例如 4M")
+    parser.add_argument("--size-jitter", type=float, default=0.5, help="文件大小的随机浮动比例 (0-1)")
+    parser.add_argument("--workers", type=int, default=5, help="并行下载数量")
+    parser.add_argument("--order", default="largest", help="下载顺序: largest / smallest / listing")
+    parser.add_argument("--split-threshold", default="64M", help="尾部拆分阈值")
+    parser.add_argument("--limit", default="", help="客户端总带宽限制，例如 50M")
+    parser.add_argument("--latency", type=float, default=0.0, help="每个请求的服务器延迟(秒)")
+    parser.add_argument("--bandwidth", default="", help="每个下载连接的服务器带宽上限，例如 20M")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Graph请求返回429的概率")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="下载中途断开连接的概率")
+    parser.add_argument("--url-ttl", type=float, default=0.0, help="下载链接的有效秒数，0表示不过期")
+    parser.add_argument("--page-size", type=int, default=200, help="children列表每页的项目数")
+    parser.add_argument("--duplicate-rate", type=float, default=0.0, help="与其他文件内容相同的文件比例")
+    parser.add_argument("--empty-files", type=int, default=0, help="其中大小为0的文件数量")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    parser.add_argument("--no-verify", dest="verify", action="store_false", help="不校验下载内容")
+    parser.add_argument("--keep", action="store_true", help="保留临时下载目录")
+    parser.add_argument("--json", action="store_true", help="以JSON格式输出结果")
+    parser.add_argument("--metrics-port", type=int, default=0, help="运行期间提供 /metrics 端点的端口")
+    parser.add_argument("--profile", nargs="?", const="phases", default=None,
+                        help="记录各阶段耗时: phases(默认) / cprofile / sample")
+    parser.add_argument("--profile-dir", default="profiles/benchmark", help="性能分析结果的输出目录")
+    args = parser.parse_args()
+
+    if args.metrics_port:
+        metrics.start_metrics_server(args.metrics_port)
+
+    if args.profile:
+        with profiling.profile_run(args.profile, args.profile_dir):
+            result = run_benchmark(args)
+    else:
+        result = run_benchmark(args)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
+
+    # 有失败、校验错误或遗漏的文件时返回非零退出码，方便在脚本中检测回归
+    ok = result["failed"] == 0 and result["corrupt"] == 0 and result["successful"] == result["files"]
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
@@ -6,12 +6,51 @@ import json
 import requests
 import time
 import sys
+import threading
+import concurrent.futures
+from collections import OrderedDict
 from msal import PublicClientApplication, SerializableTokenCache
+from token_broker import TokenCacheFile
 from config import (
     CLIENT_ID, AUTHORITY, SCOPE, 
-    DOWNLOAD_PATH, TOKEN_CACHE_FILE
+    DOWNLOAD_PATH, TOKEN_CACHE_FILE, GRAPH_API_BASE
 )
 
+class ListingCache:
+    """带过期时间的LRU文件夹列表缓存 (线程安全)"""
+    
+    def __init__(self, max_entries=512, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl  # 缓存有效期(秒)
+        self._entries = OrderedDict()  # key -> (写入时间, 列表)
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        """获取缓存的列表，不存在或已过期时返回None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if time.time() - stored_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+    
+    def put(self, key, value):
+        """写入缓存，超出容量时淘汰最久未使用的条目"""
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def invalidate(self, key):
+        """删除指定条目"""
+        with self._lock:
+            self._entries.pop(key, None)
+
 class OneDriveSharedBrowser:
     def __init__(self):
         # 创建下载目录
@@ -35,10 +74,31 @@ class OneDriveSharedBrowser:
         # 获取访问令牌
         self.access_token = self._get_access_token()
         
+        # 文件夹列表缓存和后台预取
+        self.listing_cache = ListingCache(max_entries=512, ttl=300)
+        self.max_prefetch = 64  # 每个目录最多预取的子文件夹数量
+        self._prefetch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+        self._inflight = {}  # 正在加载的列表: key -> Future
+        self._inflight_lock = threading.Lock()
+        
+        # 空间统计(du)缓存和带宽测量
+        self.du_workers = 8  # 统计空间占用时的并行列目录数量
+        self._du_cache = {}  # (驱动器ID, 项目ID) -> {"bytes", "files", "folders"}
+        self.measured_bandwidth = None  # 最近一次测得的下载带宽(字节/秒)
+        self._bandwidth_measured_at = 0
+        self.bandwidth_ttl = 600  # 带宽测量结果的有效期(秒)
+        
+        # 复用HTTP连接
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=8)
+        self.session.mount("https://", adapter)
+        self.max_api_retries = 3
+        
     def _save_token_cache(self):
-        """保存令牌缓存到文件"""
-        with open(TOKEN_CACHE_FILE, "w") as f:
-            f.write(self.token_cache.serialize())
+        """保存令牌缓存到文件 (加锁并原子替换，和同时运行的其他下载进程不冲突)"""
+        cache_file = TokenCacheFile(TOKEN_CACHE_FILE)
+        with cache_file.locked():
+            cache_file.save(self.token_cache)
     
     def _get_access_token(self):
         """获取访问令牌，如果需要则进行交互式登录"""
@@ -69,21 +129,44 @@ class OneDriveSharedBrowser:
         return result["access_token"]
     
     def _make_api_request(self, endpoint, params=None):
-        """向Microsoft Graph API发送请求"""
+        """向Microsoft Graph API发送请求
+        
+        遇到限流(429/503)时按Retry-After等待后重试，网络错误时等待后重试，最多重试max_api_retries次。
+        """
         headers = {
             "Authorization": f"Bearer {self.access_token}",
             "Accept": "application/json"
         }
         
-        response = requests.get(
-            f"https://graph.microsoft.com/v1.0{endpoint}",
-            headers=headers,
-            params=params
-        )
-        
-        if response.status_code == 200:
-            return response.json()
+        # 分页链接(@odata.nextLink)是完整URL，直接使用
+        if endpoint.startswith(("https://", "http://")):
+            url = endpoint
         else:
+            url = f"{GRAPH_API_BASE}{endpoint}"
+        
+        for attempt in range(self.max_api_retries + 1):
+            try:
+                response = self.session.get(
+                    url,
+                    headers=headers,
+                    params=params,
+                    timeout=60
+                )
+            except requests.exceptions.RequestException as e:
+                if attempt < self.max_api_retries:
+                    time.sleep(2 ** attempt)
+                    continue
+                print(f"API请求失败: {str(e)}")
+                return None
+            
+            if response.status_code == 200:
+                return response.json()
+            
+            if response.status_code in (429, 503) and attempt < self.max_api_retries:
+                retry_after = response.headers.get("Retry-After", "")
+                time.sleep(float(retry_after) if retry_after.isdigit() else 2 ** attempt)
+                continue
+            
             print(f"API请求失败: {response.status_code}")
             print(response.text)
             return None
@@ -91,7 +174,7 @@ class OneDriveSharedBrowser:
     def list_shared_items(self):
         """列出所有共享项目"""
         endpoint = "/me/drive/sharedWithMe"
-        return self._make_api_request(endpoint)
+        return self._list_all_pages(endpoint)
     
     def list_items(self, item_id, drive_id=None):
         """列出指定项目中的所有子项目"""
@@ -101,7 +184,24 @@ class OneDriveSharedBrowser:
         else:
             # 否则使用默认驱动器
             endpoint = f"/me/drive/items/{item_id}/children"
-        return self._make_api_request(endpoint)
+        return self._list_all_pages(endpoint)
+    
+    def _list_all_pages(self, endpoint):
+        """获取列表接口的全部分页结果，合并到同一个value列表中"""
+        result = self._make_api_request(endpoint)
+        if not result or "value" not in result:
+            return result
+        
+        items = result["value"]
+        next_link = result.get("@odata.nextLink")
+        while next_link:
+            page = self._make_api_request(next_link)
+            if not page or "value" not in page:
+                return None
+            items.extend(page["value"])
+            next_link = page.get("@odata.nextLink")
+        
+        return {"value": items}
     
     def get_item_info(self, item_id, drive_id=None):
         """获取项目信息"""
@@ -113,89 +213,348 @@ class OneDriveSharedBrowser:
             endpoint = f"/me/drive/items/{item_id}"
         return self._make_api_request(endpoint)
     
-    def browse_directory(self, item_id=None, drive_id=None, path=""):
-        """浏览目录并显示文件和文件夹数量"""
+    def _listing_key(self, item_id, drive_id):
+        """列表缓存的键，共享根目录使用固定键"""
         if item_id is None:
-            # 如果没有指定item_id，则浏览共享根目录
-            print("\n浏览OneDrive共享项目")
-            shared_items = self.list_shared_items()
-            if not shared_items or "value" not in shared_items:
-                print("无法获取共享项目列表")
-                return
-            
-            full_path = "共享项目"
-            print(f"\n当前目录: {full_path}")
-            
-            # 获取共享项目数量
-            items = shared_items["value"]
-            folders = [item for item in items if item.get("remoteItem", {}).get("folder")]
-            files = [item for item in items if not item.get("remoteItem", {}).get("folder")]
-            
-            folder_count = len(folders)
-            file_count = len(files)
-            
-            print(f"该目录包含 {folder_count} 个文件夹和 {file_count} 个文件")
+            return ("shared",)
+        return (drive_id, item_id)
+    
+    def _load_listing(self, item_id, drive_id):
+        """从Graph获取目录内容并写入缓存，失败时返回None"""
+        if item_id is None:
+            result = self.list_shared_items()
+        else:
+            result = self.list_items(item_id, drive_id)
+        
+        if not result or "value" not in result:
+            return None
+        
+        self.listing_cache.put(self._listing_key(item_id, drive_id), result["value"])
+        return result["value"]
+    
+    def _prefetch_listing(self, item_id, drive_id):
+        """后台预取任务，目录在排队期间已被缓存时不再请求"""
+        cached = self.listing_cache.get(self._listing_key(item_id, drive_id))
+        if cached is not None:
+            return cached
+        return self._load_listing(item_id, drive_id)
+    
+    def _discard_inflight(self, key, future):
+        with self._inflight_lock:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+    
+    def get_listing(self, item_id=None, drive_id=None, refresh=False):
+        """获取目录内容，优先使用缓存；refresh为True时强制重新获取"""
+        key = self._listing_key(item_id, drive_id)
+        if refresh:
+            self.listing_cache.invalidate(key)
+        else:
+            cached = self.listing_cache.get(key)
+            if cached is not None:
+                return cached
+        
+        # 已在后台加载时等待其结果；仍在排队的预取任务则取消，直接在当前线程加载，
+        # 避免用户操作排在大量预取请求之后
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+        if future is not None and not future.cancel():
+            return future.result()
+        
+        return self._load_listing(item_id, drive_id)
+    
+    def _child_location(self, folder, at_root, drive_id):
+        """返回子文件夹的(项目ID, 驱动器ID)，共享根目录中的项目需要从remoteItem中读取"""
+        if at_root:
+            remote_item = folder.get("remoteItem", {})
+            subfolder_id = remote_item.get("id", folder.get("id"))
+            subfolder_drive_id = remote_item.get("parentReference", {}).get("driveId")
+        else:
+            subfolder_id = folder["id"]
+            subfolder_drive_id = folder.get("parentReference", {}).get("driveId", drive_id)
+        return subfolder_id, subfolder_drive_id
+    
+    def _prefetch_children(self, folders, at_root, drive_id):
+        """在后台预取当前目录下子文件夹的内容"""
+        for folder in folders[:self.max_prefetch]:
+            subfolder_id, subfolder_drive_id = self._child_location(folder, at_root, drive_id)
+            key = self._listing_key(subfolder_id, subfolder_drive_id)
+            if self.listing_cache.get(key) is not None:
+                continue
             
-            # 显示所有文件夹
-            if folder_count > 0:
-                print("\n文件夹:")
-                for idx, folder in enumerate(folders, 1):
-                    print(f"  {idx}. {folder['name']}")
+            with self._inflight_lock:
+                if key in self._inflight:
+                    continue
+                future = self._prefetch_executor.submit(self._prefetch_listing, subfolder_id, subfolder_drive_id)
+                self._inflight[key] = future
+            future.add_done_callback(lambda f, key=key: self._discard_inflight(key, f))
+    
+    def compute_usage(self, item_id, drive_id, quick=False):
+        """统计子树的总字节数、文件数和文件夹数
+        
+        quick为True时只使用Graph提供的size和folder.childCount信息，不遍历子文件夹；
+        此时文件夹的size已经包含其下所有内容，但文件数只能统计到直接子项。
+        否则并行遍历整棵子树，结果按项目ID缓存，其中每个子文件夹的统计也会被缓存。
+        返回(统计结果, 遍历中发现的最大文件)，无法获取时返回(None, None)。
+        """
+        key = (drive_id, item_id)
+        if not quick and key in self._du_cache:
+            return self._du_cache[key], None
+        
+        if quick:
+            items = self.get_listing(item_id, drive_id)
+            if items is None:
+                return None, None
+            usage = {"bytes": 0, "files": 0, "folders": 0, "exact": True}
+            for item in items:
+                usage["bytes"] += item.get("size") or 0
+                if item.get("folder"):
+                    usage["folders"] += 1
+                    if item["folder"].get("childCount"):
+                        usage["exact"] = False
+                else:
+                    usage["files"] += 1
+            return usage, None
+        
+        return self._walk_usage(item_id, drive_id)
+    
+    def _walk_usage(self, item_id, drive_id):
+        """并行遍历子树统计空间占用，并把每个文件夹的统计结果写入缓存"""
+        root_key = (drive_id, item_id)
+        totals = {root_key: [0, 0, 0]}  # key -> [字节数, 文件数, 文件夹数]
+        parents = {}  # key -> 父文件夹key
+        order = [root_key]  # 发现顺序，父文件夹总在子文件夹之前
+        walked = {root_key}  # 实际遍历过(而非取自缓存)的文件夹
+        largest_file = None
+        complete = True
+        
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.du_workers) as executor:
+            pending = {executor.submit(self.get_listing, item_id, drive_id): root_key}
             
-            # 显示所有文件
-            if file_count > 0:
-                print("\n文件:")
-                for idx, file in enumerate(files, 1):
-                    remote_item = file.get("remoteItem", {})
-                    size = remote_item.get("size", "未知大小")
-                    if isinstance(size, (int, float)):
-                        size = self._format_size(size)
-                    print(f"  {idx}. {file['name']} ({size})")
+            while pending:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    key = pending.pop(future)
+                    try:
+                        items = future.result()
+                    except Exception as e:
+                        print(f"获取项目内容时发生错误: {key[1]}, 错误: {str(e)}")
+                        items = None
+                    if items is None:
+                        complete = False
+                        continue
+                    
+                    stats = totals[key]
+                    for item in items:
+                        if not item.get("folder"):
+                            stats[0] += item.get("size") or 0
+                            stats[1] += 1
+                            if largest_file is None or (item.get("size") or 0) > (largest_file.get("size") or 0):
+                                largest_file = item
+                            continue
+                        
+                        stats[2] += 1
+                        child_drive_id = item.get("parentReference", {}).get("driveId", key[0])
+                        child_key = (child_drive_id, item["id"])
+                        parents[child_key] = key
+                        order.append(child_key)
+                        
+                        cached = self._du_cache.get(child_key)
+                        if cached:
+                            # 已统计过的子树直接使用缓存结果
+                            totals[child_key] = [cached["bytes"], cached["files"], cached["folders"]]
+                        elif not item["folder"].get("childCount"):
+                            # 空文件夹无需列出
+                            totals[child_key] = [0, 0, 0]
+                        else:
+                            totals[child_key] = [0, 0, 0]
+                            walked.add(child_key)
+                            pending[executor.submit(self.get_listing, item["id"], child_drive_id)] = child_key
+        
+        # 自底向上汇总子树结果
+        for key in reversed(order):
+            if key in parents:
+                parent_stats = totals[parents[key]]
+                for i in range(3):
+                    parent_stats[i] += totals[key][i]
+        
+        if not complete:
+            print("警告: 部分文件夹无法列出，统计结果不完整")
+        
+        for key in walked:
+            usage = {"bytes": totals[key][0], "files": totals[key][1], "folders": totals[key][2], "exact": complete}
+            if complete:
+                self._du_cache[key] = usage
+        
+        root_stats = totals[root_key]
+        return {"bytes": root_stats[0], "files": root_stats[1], "folders": root_stats[2], "exact": complete}, largest_file
+    
+    def measure_bandwidth(self, file_item=None, sample_bytes=8 * 1024 * 1024):
+        """下载文件的前sample_bytes字节测量当前带宽(字节/秒)，结果在bandwidth_ttl内复用"""
+        if self.measured_bandwidth and time.time() - self._bandwidth_measured_at < self.bandwidth_ttl:
+            return self.measured_bandwidth
+        
+        if not file_item:
+            return self.measured_bandwidth
+        
+        download_url = file_item.get("@microsoft.graph.downloadUrl")
+        if not download_url:
+            drive_id = file_item.get("parentReference", {}).get("driveId")
+            info = self.get_item_info(file_item["id"], drive_id)
+            download_url = info.get("@microsoft.graph.downloadUrl") if info else None
+        if not download_url:
+            return self.measured_bandwidth
+        
+        try:
+            start = time.time()
+            response = self.session.get(
+                download_url,
+                headers={"Range": f"bytes=0-{sample_bytes - 1}"},
+                stream=True,
+                timeout=60
+            )
+            response.raise_for_status()
+            received = 0
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                received += len(chunk)
+                if received >= sample_bytes:
+                    break
+            response.close()
+            elapsed = time.time() - start
+        except Exception as e:
+            print(f"测量带宽失败: {str(e)}")
+            return self.measured_bandwidth
+        
+        if elapsed > 0 and received > 0:
+            self.measured_bandwidth = received / elapsed
+            self._bandwidth_measured_at = time.time()
+        return self.measured_bandwidth
+    
+    def _format_duration(self, seconds):
+        """格式化时长"""
+        seconds = int(seconds)
+        hours, remainder = divmod(seconds, 3600)
+        minutes, seconds = divmod(remainder, 60)
+        if hours:
+            return f"{hours}小时{minutes}分"
+        if minutes:
+            return f"{minutes}分{seconds}秒"
+        return f"{seconds}秒"
+    
+    def show_usage(self, targets, path, quick=False):
+        """统计并显示一组文件夹的空间占用和预计传输时间
+        
+        targets为[(项目ID, 驱动器ID), ...]，在共享根目录统计时会包含多个共享文件夹。
+        """
+        start = time.time()
+        total = {"bytes": 0, "files": 0, "folders": 0, "exact": True}
+        largest_file = None
+        for target_id, target_drive_id in targets:
+            usage, largest = self.compute_usage(target_id, target_drive_id, quick=quick)
+            if usage is None:
+                print(f"无法获取项目内容: {target_id}")
+                total["exact"] = False
+                continue
+            for field in ("bytes", "files", "folders"):
+                total[field] += usage[field]
+            total["exact"] = total["exact"] and usage["exact"]
+            if largest and (largest_file is None or largest.get("size", 0) > largest_file.get("size", 0)):
+                largest_file = largest
+        
+        bandwidth = self.measure_bandwidth(largest_file)
+        
+        print(f"\n=== 空间占用: {path} ===")
+        print(f"总大小: {self._format_size(total['bytes'])}")
+        if total["exact"]:
+            print(f"文件数: {total['files']}")
+            print(f"文件夹数: {total['folders']}")
+        else:
+            # 快速模式下子文件夹中的文件没有被统计
+            print(f"文件数: 至少 {total['files']} (去掉 --quick 可统计完整数量)")
+            print(f"文件夹数: 至少 {total['folders']}")
+        if bandwidth:
+            eta = total["bytes"] / bandwidth
+            print(f"当前测得带宽: {self._format_size(bandwidth)}/s, 单线程预计传输时间: {self._format_duration(eta)}")
+        else:
+            print("尚未测得带宽，无法估算传输时间")
+        print(f"统计耗时: {time.time() - start:.1f} 秒")
+    
+    def _print_listing(self, folders, files, at_root):
+        """显示目录中的文件夹和文件"""
+        print(f"该目录包含 {len(folders)} 个文件夹和 {len(files)} 个文件")
+        
+        # 显示所有文件夹
+        if folders:
+            print("\n文件夹:")
+            for idx, folder in enumerate(folders, 1):
+                print(f"  {idx}. {folder['name']}")
+        
+        # 显示所有文件
+        if files:
+            print("\n文件:")
+            for idx, file in enumerate(files, 1):
+                if at_root:  # 在根目录
+                    size = file.get("remoteItem", {}).get("size", "未知大小")
+                else:
+                    size = file.get("size", "未知大小")
+                if isinstance(size, (int, float)):
+                    size = self._format_size(size)
+                print(f"  {idx}. {file['name']} ({size})")
+    
+    def browse_directory(self, item_id=None, drive_id=None, path=""):
+        """浏览目录并显示文件和文件夹数量
+        
+        目录列表会被缓存，进入目录时在后台预取其子文件夹，已访问过的目录可以立即显示。
+        导航路径保存在显式的栈中，返回上级目录不需要任何请求。
+        """
+        # 导航栈，每一层为(项目ID, 驱动器ID, 显示路径)
+        if item_id is None:
+            print("\n浏览OneDrive共享项目")
+            stack = [(None, None, "共享项目")]
         else:
-            # 获取指定项目信息
             item_info = self.get_item_info(item_id, drive_id)
             if not item_info:
                 print(f"无法获取项目信息: {item_id}")
                 return
-            
             item_name = item_info.get("name", "未命名项目")
-            full_path = f"{path}/{item_name}" if path else item_name
-            
-            # 获取子项目
-            items_result = self.list_items(item_id, drive_id)
-            if not items_result or "value" not in items_result:
-                print(f"无法获取项目内容: {item_id}")
-                return
-            
-            print(f"\n当前目录: {full_path}")
-            
-            # 计算文件和文件夹数量
-            items = items_result["value"]
-            folders = [item for item in items if item.get("folder")]
-            files = [item for item in items if not item.get("folder")]
-            
-            folder_count = len(folders)
-            file_count = len(files)
-            
-            print(f"该目录包含 {folder_count} 个文件夹和 {file_count} 个文件")
-            
-            # 显示所有文件夹
-            if folder_count > 0:
-                print("\n文件夹:")
-                for idx, folder in enumerate(folders, 1):
-                    print(f"  {idx}. {folder['name']}")
-            
-            # 显示所有文件
-            if file_count > 0:
-                print("\n文件:")
-                for idx, file in enumerate(files, 1):
-                    size = file.get("size", "未知大小")
-                    if isinstance(size, (int, float)):
-                        size = self._format_size(size)
-                    print(f"  {idx}. {file['name']} ({size})")
-
+            stack = [(item_id, drive_id, f"{path}/{item_name}" if path else item_name)]
+        
+        refresh = False
+        reload_listing = True
+        
         # 模拟终端提示符和命令处理
         while True:
+            current_id, current_drive_id, full_path = stack[-1]
+            at_root = current_id is None
+            
+            if reload_listing:
+                items = self.get_listing(current_id, current_drive_id, refresh=refresh)
+                refresh = False
+                reload_listing = False
+                
+                if items is None:
+                    if at_root:
+                        print("无法获取共享项目列表")
+                    else:
+                        print(f"无法获取项目内容: {current_id}")
+                    if len(stack) == 1:
+                        return
+                    stack.pop()
+                    reload_listing = True
+                    continue
+                
+                # 计算文件和文件夹数量
+                if at_root:
+                    folders = [item for item in items if item.get("remoteItem", {}).get("folder")]
+                    files = [item for item in items if not item.get("remoteItem", {}).get("folder")]
+                else:
+                    folders = [item for item in items if item.get("folder")]
+                    files = [item for item in items if not item.get("folder")]
+                
+                print(f"\n当前目录: {full_path}")
+                self._print_listing(folders, files, at_root)
+                self._prefetch_children(folders, at_root, current_drive_id)
+            
             command = input(f"\n{full_path}> ").strip()
             
             if not command:
@@ -209,29 +568,44 @@ class OneDriveSharedBrowser:
                 print("  ls             - 列出当前目录内容")
                 print("  cd <序号>       - 进入指定序号的文件夹")
                 print("  cd ..          - 返回上级目录")
+                print("  refresh        - 重新获取当前目录内容 (忽略缓存)")
+                print("  du [序号] [--quick] - 统计当前目录或指定子文件夹的总大小、文件数和预计传输时间")
                 print("  exit/quit      - 退出程序")
                 print("  help/?         - 显示帮助信息")
                 
             elif cmd == "ls":
                 # 重新显示当前目录内容
-                print(f"该目录包含 {folder_count} 个文件夹和 {file_count} 个文件")
+                self._print_listing(folders, files, at_root)
                 
-                if folder_count > 0:
-                    print("\n文件夹:")
-                    for idx, folder in enumerate(folders, 1):
-                        print(f"  {idx}. {folder['name']}")
+            elif cmd == "refresh":
+                refresh = True
+                reload_listing = True
+                # 空间统计结果也可能已经过时
+                self._du_cache.clear()
                 
-                if file_count > 0:
-                    print("\n文件:")
-                    for idx, file in enumerate(files, 1):
-                        if item_id is None:  # 在根目录
-                            remote_item = file.get("remoteItem", {})
-                            size = remote_item.get("size", "未知大小")
-                        else:
-                            size = file.get("size", "未知大小")
-                        if isinstance(size, (int, float)):
-                            size = self._format_size(size)
-                        print(f"  {idx}. {file['name']} ({size})")
+            elif cmd == "du":
+                quick = "--quick" in cmd_parts
+                args = [part for part in cmd_parts[1:] if part != "--quick"]
+                if args:
+                    try:
+                        folder_idx = int(args[0]) - 1
+                    except ValueError:
+                        print("请输入有效的文件夹序号")
+                        continue
+                    if not 0 <= folder_idx < len(folders):
+                        print("无效的文件夹序号")
+                        continue
+                    selected_folder = folders[folder_idx]
+                    targets = [self._child_location(selected_folder, at_root, current_drive_id)]
+                    usage_path = selected_folder["name"] if at_root else f"{full_path}/{selected_folder['name']}"
+                elif at_root:
+                    # 共享根目录: 汇总所有共享文件夹
+                    targets = [self._child_location(folder, True, None) for folder in folders]
+                    usage_path = full_path
+                else:
+                    targets = [(current_id, current_drive_id)]
+                    usage_path = full_path
+                self.show_usage(targets, usage_path, quick=quick)
                 
             elif cmd == "cd":
                 if len(cmd_parts) < 2:
@@ -240,27 +614,23 @@ class OneDriveSharedBrowser:
                     
                 if cmd_parts[1] == "..":
                     # 返回上级目录
-                    if item_id is not None:  # 只有非根目录可以返回
-                        return
+                    if len(stack) > 1:
+                        stack.pop()
+                        reload_listing = True
                     else:
                         print("已在根目录，无法返回上级")
                 else:
                     # 尝试解析序号并进入子文件夹
                     try:
                         folder_idx = int(cmd_parts[1]) - 1
-                        if 0 <= folder_idx < folder_count:
+                        if 0 <= folder_idx < len(folders):
                             selected_folder = folders[folder_idx]
-                            
-                            # 处理共享项目和常规项目的区别
-                            if item_id is None:  # 在根目录
-                                remote_item = selected_folder.get("remoteItem", {})
-                                subfolder_id = remote_item.get("id", selected_folder.get("id"))
-                                subfolder_drive_id = remote_item.get("parentReference", {}).get("driveId")
-                            else:  # 在子目录
-                                subfolder_id = selected_folder["id"]
-                                subfolder_drive_id = selected_folder.get("parentReference", {}).get("driveId", drive_id)
-                            
-                            self.browse_directory(subfolder_id, subfolder_drive_id, full_path)
+                            subfolder_id, subfolder_drive_id = self._child_location(
+                                selected_folder, at_root, current_drive_id
+                            )
+                            subfolder_path = selected_folder["name"] if at_root else f"{full_path}/{selected_folder['name']}"
+                            stack.append((subfolder_id, subfolder_drive_id, subfolder_path))
+                            reload_listing = True
                         else:
                             print("无效的文件夹序号")
                     except ValueError:
@@ -7,11 +7,68 @@ load_dotenv()
 # Microsoft Azure应用程序凭据
 CLIENT_ID = os.getenv("CLIENT_ID")  # 应用程序(客户端)ID
 TENANT_ID = os.getenv("TENANT_ID")  # 租户ID
+CLIENT_SECRET = os.getenv("CLIENT_SECRET", "")  # 客户端密码，设置后使用客户端凭据登录 (不需要人工操作，需要应用程序权限)
+REDIRECT_URI = os.getenv("REDIRECT_URI", "http://localhost")  # get_token.py 授权码流程的重定向地址
 
 # Microsoft Graph API端点
 AUTHORITY = f"https://login.microsoftonline.com/{TENANT_ID}"
 SCOPE = ["Files.Read", "Files.Read.All"]  # 所需的权限范围
+APP_SCOPE = ["https://graph.microsoft.com/.default"]  # 客户端凭据登录使用应用程序已授予的全部权限
+GRAPH_API_BASE = os.getenv("GRAPH_API_BASE", "https://graph.microsoft.com/v1.0")  # Graph API地址，基准测试时指向本地模拟服务器
 
 # 本地设置
 DOWNLOAD_PATH = "downloads"  # 下载文件的本地目录
-TOKEN_CACHE_FILE = "token_cache.json"  # 令牌缓存文件 
\ No newline at end of file
+# 每个文件的本地路径模板，留空表示 downloads/batch_N/<文件名>
+# 例如 "downloads/a_t5/{split}/{name}" 直接写入step1_unzip.py处理的train目录 (可用字段见batch_download_unbalanced_train.py)
+DOWNLOAD_PATH_TEMPLATE = os.getenv("DOWNLOAD_PATH_TEMPLATE", "")
+TOKEN_CACHE_FILE = "token_cache.json"  # 令牌缓存文件
+# 令牌代理 (python token_broker.py serve 启动)，多个节点和进程从这里获取令牌，只有代理负责登录和刷新
+# 例如 "unix:///run/clap/token.sock" 或 "http://head-node:8766"，留空表示在本进程中登录
+TOKEN_BROKER = os.getenv("TOKEN_BROKER", "")
+TOKEN_BROKER_SECRET = os.getenv("TOKEN_BROKER_SECRET", "")  # 代理和客户端共享的密钥，使用TCP地址时应当设置
+# 缓存中没有可用令牌时是否允许设备代码登录 (需要人工操作)；集群节点上设为0，缺少令牌时立即报错而不是等待
+AUTH_INTERACTIVE = os.getenv("AUTH_INTERACTIVE", "1") != "0"
+SYNC_STATE_FILE = os.path.join(DOWNLOAD_PATH, "sync_state.db")  # 增量同步状态数据库
+
+# 下载限速 (例如 "50M" 表示50MB/s，留空表示不限速)
+DOWNLOAD_RATE_LIMIT = os.getenv("DOWNLOAD_RATE_LIMIT", "")
+# 分时段限速，例如 "09:00-18:00=20M" 表示工作时间限速20MB/s，其余时间使用DOWNLOAD_RATE_LIMIT
+DOWNLOAD_RATE_SCHEDULE = os.getenv("DOWNLOAD_RATE_SCHEDULE", "")
+# 按主机限速，例如 "*.sharepoint.com=40M"
+HOST_RATE_LIMITS = os.getenv("HOST_RATE_LIMITS", "")
+
+# 运行指标 (端口为空表示不启动 /metrics 端点，日志文件为空表示不写JSON指标日志)
+METRICS_PORT = os.getenv("METRICS_PORT", "")
+METRICS_LOG_FILE = os.getenv("METRICS_LOG_FILE", "")
+METRICS_LOG_INTERVAL = float(os.getenv("METRICS_LOG_INTERVAL", "30"))  # JSON指标日志的写入间隔(秒)
+
+# 磁盘空间: 下载前比较需要的空间和可用空间，下载中可用空间低于保留值时暂停开始新的文件
+DISK_RESERVE = os.getenv("DISK_RESERVE", "5G")  # 始终保留的空闲空间
+# wait(默认，空间不足时暂停，等待解压/上传等步骤释放空间) / abort(空间不足时不开始下载) / off(不检查)
+DISK_SPACE_POLICY = os.getenv("DISK_SPACE_POLICY", "wait")
+DISK_PREALLOCATE = os.getenv("DISK_PREALLOCATE", "0") == "1"  # 用fallocate预先分配 .part 文件的空间
+DISK_WAIT_POLL = float(os.getenv("DISK_WAIT_POLL", "30"))  # 暂停时检查可用空间的间隔(秒)
+DISK_WAIT_TIMEOUT = float(os.getenv("DISK_WAIT_TIMEOUT", "0"))  # 最多等待的秒数，0表示一直等待
+
+# 下载进程的控制接口 (运行中修改优先级、暂停/恢复文件、并行数和限速，见download_control.py)
+# 例如 "unix:///tmp/clap_download.sock" 或 "http://127.0.0.1:9200"，留空表示不启动
+CONTROL_ADDRESS = os.getenv("CONTROL_ADDRESS", "")
+
+# 运行记录 (每次运行的结构化结果和用于比较吞吐量的历史数据库)
+RUN_HISTORY_FILE = os.path.join(DOWNLOAD_PATH, "run_history.db")
+RUN_RECORDS_DIR = os.path.join(DOWNLOAD_PATH, "runs")  # 每次运行的 <run_id>.json (安装pyarrow时还有 .parquet)
+RUN_JOURNAL_FILE = os.path.join(DOWNLOAD_PATH, "journal.db")  # 每个文件的状态和断点，中断后从这里继续
+TAR_INDEX_FILE = os.getenv("TAR_INDEX_FILE", os.path.join(DOWNLOAD_PATH, "tar_index.db"))  # tar分片的成员偏移索引
+
+# 按内容去重: 远程文件的哈希与本地已有文件相同时不再下载
+# hardlink(默认，依次尝试硬链接、reflink、本地复制) / reflink(写时复制，修改互不影响) / copy / off
+DEDUP_MODE = os.getenv("DEDUP_MODE", "hardlink")
+# 全局内容索引，多个数据集镜像可以指向同一个文件以便互相去重
+CONTENT_INDEX_FILE = os.getenv("CONTENT_INDEX_FILE", os.path.join(DOWNLOAD_PATH, "content_index.db"))
+
+# 多个下载节点共享的分片缓存: 共享目录(例如NFS上的路径)或局域网缓存服务器地址(http://host:8765)，留空表示不使用
+# 缓存服务器用 python shard_cache.py serve --root=<目录> 启动
+SHARD_CACHE = os.getenv("SHARD_CACHE", "")
+SHARD_CACHE_MAX_BYTES = os.getenv("SHARD_CACHE_MAX_BYTES", "500G")  # 共享目录缓存的容量上限，超过时淘汰最久未使用的文件
+# 缓存服务器的写入密钥: 服务器和各下载节点设置相同的值，没有设置时服务器只接受本机写入
+SHARD_CACHE_TOKEN = os.getenv("SHARD_CACHE_TOKEN", "")
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import base64
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+# Linux的FICLONE ioctl，用于在支持写时复制的文件系统(btrfs、XFS等)上创建reflink
+_FICLONE = 0x40049409
+
+# 去重方式 -> 依次尝试的链接方法
+DEDUP_METHODS = {
+    "hardlink": ("hardlink", "reflink", "copy"),
+    "reflink": ("reflink", "copy"),
+    "copy": ("copy",),
+    "off": (),
+}
+
+def _item_hashes(item):
+    """(quickXorHash, sha1Hash)，item可以是Graph项目字典或FileRecord"""
+    quick_xor_hash = getattr(item, "quick_xor_hash", None)
+    sha1_hash = getattr(item, "sha1_hash", None)
+    if quick_xor_hash is None and sha1_hash is None and isinstance(item, dict):
+        hashes = (item.get("file") or {}).get("hashes") or {}
+        quick_xor_hash = hashes.get("quickXorHash")
+        sha1_hash = hashes.get("sha1Hash")
+    return quick_xor_hash, sha1_hash
+
+def content_key(item):
+    """根据Graph提供的文件哈希生成内容键，没有哈希时返回None
+
+    item可以是Graph项目字典或FileRecord。SharePoint/OneDrive商业版提供quickXorHash，
+    个人版提供sha1Hash。
+    """
+    quick_xor_hash, sha1_hash = _item_hashes(item)
+    if quick_xor_hash:
+        return f"quickXorHash:{quick_xor_hash}"
+    if sha1_hash:
+        return f"sha1Hash:{sha1_hash.lower()}"
+    return None
+
+# quickXorHash: 第i个字节异或到160位状态的第 (i*11) % 160 位 (循环)，最后把长度异或到高64位。
+# 每160个字节的位置重复一次，先把对齐的160字节块互相异或 (大整数上按一半折叠)，最后再移位
+_QXH_WIDTH = 160
+_QXH_BLOCK = 160  # 字节
+_QXH_CHUNK = _QXH_BLOCK * 65536  # 约10MB，必须是_QXH_BLOCK的2的幂次倍
+
+def _fold_blocks(data):
+    """把data (长度为_QXH_BLOCK的2的幂次倍) 的所有160字节块异或成一块，返回大整数 (小端)"""
+    value = int.from_bytes(data, "little")
+    nbytes = len(data)
+    while nbytes > _QXH_BLOCK:
+        nbytes //= 2
+        value = (value & ((1 << (nbytes * 8)) - 1)) ^ (value >> (nbytes * 8))
+    return value
+
+def quick_xor_hash(path):
+    """计算文件的quickXorHash (SharePoint/OneDrive商业版的文件哈希)，返回base64字符串"""
+    folded = 0
+    length = 0
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(_QXH_CHUNK)
+            if not data:
+                break
+            length += len(data)
+            if len(data) < _QXH_CHUNK:
+                # 最后一块补零到2的幂次个160字节块，补的零不影响异或结果
+                blocks = -(-len(data) // _QXH_BLOCK)
+                data += bytes((1 << (blocks - 1).bit_length()) * _QXH_BLOCK - len(data))
+            folded ^= _fold_blocks(data)
+    block = folded.to_bytes(_QXH_BLOCK, "little")
+    mask = (1 << _QXH_WIDTH) - 1
+    state = 0
+    for i, byte in enumerate(block):
+        if byte:
+            shift = (i * 11) % _QXH_WIDTH
+            value = byte << shift
+            state ^= (value | (value >> _QXH_WIDTH)) & mask
+    state ^= length << (_QXH_WIDTH - 64)
+    return base64.b64encode(state.to_bytes(_QXH_WIDTH // 8, "little")).decode("ascii")
+
+def verify_content(item, path):
+    """检查文件内容与item的quickXorHash/sha1Hash是否一致；item没有哈希时返回None"""
+    expected_qxh, expected_sha1 = _item_hashes(item)
+    if expected_qxh:
+        return quick_xor_hash(path) == expected_qxh
+    if expected_sha1:
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha1.update(chunk)
+        return sha1.hexdigest() == expected_sha1.lower()
+    return None
+
+def _reflink(src, dst):
+    import fcntl
+    with open(src, "rb") as source, open(dst, "wb") as target:
+        fcntl.ioctl(target.fileno(), _FICLONE, source.fileno())
+
+def link_file(src, dst, methods=DEDUP_METHODS["hardlink"]):
+    """把src的内容放到dst，依次尝试methods中的方法，返回成功的方法名，全部失败时返回None
+
+    先写入临时文件再原子替换dst，不会留下不完整的文件。
+    """
+    os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+    temp_path = dst + ".link"
+    for method in methods:
+        try:
+            if os.path.lexists(temp_path):
+                os.remove(temp_path)
+            if method == "hardlink":
+                os.link(src, temp_path)
+            elif method == "reflink":
+                _reflink(src, temp_path)
+            else:
+                shutil.copyfile(src, temp_path)
+            os.replace(temp_path, dst)
+            return method
+        except (OSError, ImportError):
+            # 跨文件系统、文件系统不支持或平台不支持时尝试下一种方法
+            if os.path.lexists(temp_path):
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+    return None
+
+class ContentIndex:
+    """全局内容索引: 内容键(文件哈希) -> 本地已有的文件路径
+
+    可以放在多个数据集镜像共用的位置(CONTENT_INDEX_FILE)，查询时会检查文件是否仍然存在、
+    大小是否一致，失效的记录会被删除。
+    """
+
+    def __init__(self, db_path):
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # 每个文件都会写入一条记录，WAL模式下NORMAL同步级别足够安全且不必每次提交都刷盘
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS content (
+                content_key TEXT NOT NULL,
+                size INTEGER,
+                local_path TEXT NOT NULL,
+                added_at REAL,
+                PRIMARY KEY (content_key, local_path)
+            );
+        """)
+        self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def lookup(self, key, size, exclude=None):
+        """返回内容键对应的一个有效本地文件路径，没有时返回None"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT local_path FROM content WHERE content_key = ? ORDER BY added_at",
+                (key,)
+            ).fetchall()
+
+        stale = []
+        found = None
+        for (path,) in rows:
+            if exclude and os.path.abspath(path) == os.path.abspath(exclude):
+                continue
+            try:
+                if size is None or os.path.getsize(path) == size:
+                    found = path
+                    break
+            except OSError:
+                pass
+            stale.append(path)
+
+        if stale:
+            with self._lock:
+                self._conn.executemany(
+                    "DELETE FROM content WHERE content_key = ? AND local_path = ?",
+                    [(key, path) for path in stale]
+                )
+                self._conn.commit()
+        return found
+
+    def add(self, key, size, local_path):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO content (content_key, size, local_path, added_at) VALUES (?, ?, ?, ?)",
+                (key, size, local_path, time.time())
+            )
+            self._conn.commit()
+
+class ContentDeduplicator:
+    """按内容去重: 远程文件的哈希与本地已有文件相同时，用硬链接/reflink代替下载
+
+    同一次运行中相同内容的文件只下载一份，其余的等第一份完成后再链接。
+    """
+
+    def __init__(self, index, mode="hardlink"):
+        if mode not in DEDUP_METHODS:
+            raise ValueError(f"未知的去重方式: {mode}，可选: {', '.join(DEDUP_METHODS)}")
+        self.index = index
+        self.methods = DEDUP_METHODS[mode]
+        self.enabled = bool(self.methods)
+        self.saved_bytes = 0
+        self._lock = threading.Lock()
+        self._inflight = {}  # 内容键 -> 正在下载该内容的线程完成时设置的Event
+
+    def record(self, item, local_path):
+        """记录一个本地已有的文件，供之后的文件去重"""
+        key = content_key(item) if self.enabled else None
+        if key:
+            self.index.add(key, item.get("size"), local_path)
+
+    def link_existing(self, item, local_path):
+        """如果索引中已有相同内容的本地文件，链接到local_path并返回True"""
+        key = content_key(item) if self.enabled else None
+        if not key:
+            return False
+        source = self.index.lookup(key, item.get("size"), exclude=local_path)
+        if not source:
+            return False
+        return self.link(item, source, local_path)
+
+    def link(self, item, source, local_path):
+        method = link_file(source, local_path, self.methods)
+        if not method:
+            return False
+        with self._lock:
+            self.saved_bytes += item.get("size") or 0
+        self.index.add(content_key(item), item.get("size"), local_path)
+        print(f"内容相同，已{_METHOD_NAMES[method]}: {item.get('name')} <- {source}")
+        return True
+
+    def plan(self, download_tasks):
+        """把下载任务分成三类，返回(需要下载的任务, {内容键: [重复的任务]}, 已链接的任务)
+
+        索引中已有内容的文件立即链接；本批次中内容相同的文件只保留第一个进行下载。
+        """
+        if not self.enabled:
+            return list(download_tasks), {}, []
+
+        unique_tasks, followers, linked = [], {}, []
+        owners = set()
+        for file_item, local_path in download_tasks:
+            key = content_key(file_item)
+            if key is None:
+                unique_tasks.append((file_item, local_path))
+            elif key in owners:
+                followers.setdefault(key, []).append((file_item, local_path))
+            elif self.link_existing(file_item, local_path):
+                linked.append((file_item, local_path))
+            else:
+                owners.add(key)
+                unique_tasks.append((file_item, local_path))
+        return unique_tasks, followers, linked
+
+    def fetch(self, item, local_path, download_fn):
+        """下载或链接单个文件，用于边遍历边下载的场景
+
+        另一个线程正在下载相同内容时等待其完成后链接；对方失败时自己下载。
+        """
+        key = content_key(item) if self.enabled else None
+        if key is None:
+            return download_fn(item, local_path)
+
+        with self._lock:
+            event = self._inflight.get(key)
+            owner = event is None
+            if owner:
+                event = self._inflight[key] = threading.Event()
+        if not owner:
+            event.wait()
+
+        try:
+            if self.link_existing(item, local_path):
+                return True
+            success = download_fn(item, local_path)
+            if success:
+                self.index.add(key, item.get("size"), local_path)
+            return success
+        finally:
+            if owner:
+                with self._lock:
+                    self._inflight.pop(key, None)
+                event.set()
+
+_METHOD_NAMES = {"hardlink": "硬链接", "reflink": "reflink", "copy": "本地复制"}
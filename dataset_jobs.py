@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import concurrent.futures
+import json
+import os
+
+import requests
+
+try:
+    import yaml
+except ImportError:
+    # 没有安装PyYAML时只支持JSON作业文件
+    yaml = None
+
+from config import DOWNLOAD_PATH
+from rate_limiter import parse_rate
+from download_scheduler import ORDER_POLICIES
+from batch_download_unbalanced_train import UnbalancedTrainBatchDownloader
+
+# 作业文件中每个目标可以使用的字段 (也可以写在defaults中作为所有目标的默认值)
+TARGET_FIELDS = {
+    "name", "site_hostname", "site_path", "path", "batch_count", "batches",
+    "download_dir", "batch_dir", "path_template", "split", "max_workers", "order",
+}
+
+# 作业可以执行的命令 -> 下载器方法
+JOB_COMMANDS = {
+    "download": "download_batch_parallel",
+    "verify": "verify_batch",
+    "missing": "download_missing_files",
+    "sync": "sync_batch",
+    "relocate": "relocate_batch",
+}
+
+class DatasetTarget:
+    """作业文件中的一个数据集目标"""
+
+    def __init__(self, spec):
+        unknown = set(spec) - TARGET_FIELDS
+        if unknown:
+            raise ValueError(f"未知的目标字段: {', '.join(sorted(unknown))}")
+        if not spec.get("path"):
+            raise ValueError("每个目标都需要指定path (SharePoint文档库中的文件夹路径)")
+
+        self.path = spec["path"]
+        self.name = spec.get("name") or os.path.basename(self.path.rstrip("/"))
+        self.site_hostname = spec.get("site_hostname", "techn365.sharepoint.com")
+        self.site_path = spec.get("site_path", "/sites/clap")
+        self.batch_count = int(spec.get("batch_count", 6))
+        self.download_dir = spec.get("download_dir") or os.path.join(DOWNLOAD_PATH, self.name)
+        self.batch_dir = spec.get("batch_dir")
+        self.path_template = spec.get("path_template")
+        self.split = spec.get("split", "train")
+        self.max_workers = int(spec.get("max_workers", 5))
+        self.order = spec.get("order", "largest")
+        if self.order not in ORDER_POLICIES:
+            raise ValueError(f"目标 {self.name} 的下载顺序无效: {self.order}，可选: {', '.join(ORDER_POLICIES)}")
+
+        batches = spec.get("batches", "all")
+        if batches == "all":
+            self.batches = list(range(1, self.batch_count + 1))
+        else:
+            self.batches = [int(b) for b in batches]
+            invalid = [b for b in self.batches if b < 1 or b > self.batch_count]
+            if invalid:
+                raise ValueError(f"目标 {self.name} 的批次号必须在1到{self.batch_count}之间: {invalid}")
+
+    def create_downloader(self, shared=None, access_token=None):
+        downloader = UnbalancedTrainBatchDownloader(
+            access_token=access_token,
+            site_hostname=self.site_hostname,
+            site_path=self.site_path,
+            relative_path=self.path,
+            batch_count=self.batch_count,
+            download_dir=self.download_dir,
+            batch_dir=self.batch_dir,
+            path_template=self.path_template,
+            split=self.split,
+            shared=shared
+        )
+        downloader.max_workers = self.max_workers
+        downloader.order_policy = self.order
+        return downloader
+
+class DatasetJob:
+    """一个作业文件: 多个数据集目标，在同一个进程中并发下载
+
+    所有目标共用一次登录、一个HTTP连接池、去重索引、分片缓存和进程内的限速器。
+    concurrency为同时处理的目标数量，每个目标内部的批次依次执行。
+    """
+
+    def __init__(self, spec):
+        unknown = set(spec) - {"targets", "defaults", "concurrency", "rate_limit"}
+        if unknown:
+            raise ValueError(f"未知的作业字段: {', '.join(sorted(unknown))}")
+        if not spec.get("targets"):
+            raise ValueError("作业文件中没有targets")
+
+        defaults = spec.get("defaults") or {}
+        self.targets = [DatasetTarget(dict(defaults, **target)) for target in spec["targets"]]
+        names = [target.name for target in self.targets]
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if duplicates:
+            raise ValueError(f"目标名称重复，请用name区分: {', '.join(duplicates)}")
+        self.concurrency = max(1, int(spec.get("concurrency", 2)))
+        self.rate_limit = parse_rate(str(spec["rate_limit"])) if spec.get("rate_limit") else None
+
+    def create_downloaders(self, access_token=None):
+        """为每个目标创建下载器，第一个负责登录，其余共用它的登录状态和连接池"""
+        first = self.targets[0].create_downloader(access_token=access_token)
+        downloaders = [first] + [target.create_downloader(shared=first) for target in self.targets[1:]]
+
+        # 连接池大小按同时下载的线程总数设置，避免多个目标并发时反复新建连接
+        busiest = sorted((target.max_workers for target in self.targets), reverse=True)
+        pool_size = max(20, sum(busiest[:self.concurrency]) + self.concurrency)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        first.session.mount("https://", adapter)
+        first.session.mount("http://", adapter)
+        return downloaders
+
+    def run(self, command="download", access_token=None, rate_limit=None):
+        """对所有目标执行命令，返回 {目标名称: 是否全部成功}"""
+        if command not in JOB_COMMANDS:
+            raise ValueError(f"未知的作业命令: {command}，可选: {', '.join(JOB_COMMANDS)}")
+
+        downloaders = self.create_downloaders(access_token)
+        rate = rate_limit or self.rate_limit
+        if rate:
+            downloaders[0].set_rate_limit(rate)
+
+        def run_target(target, downloader):
+            method = getattr(downloader, JOB_COMMANDS[command])
+            success = True
+            for batch_number in target.batches:
+                print(f"\n[{target.name}] {command} 第{batch_number}批次")
+                result = method(batch_number)
+                if command == "verify":
+                    # verify返回缺失或错误的文件列表
+                    success = success and result is not None and not result
+                else:
+                    success = success and bool(result)
+            return success
+
+        results = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency,
+                                                   thread_name_prefix="dataset-job") as executor:
+            futures = {
+                executor.submit(run_target, target, downloader): target
+                for target, downloader in zip(self.targets, downloaders)
+            }
+            for future in concurrent.futures.as_completed(futures):
+                target = futures[future]
+                try:
+                    results[target.name] = future.result()
+                except Exception as e:
+                    print(f"[{target.name}] 发生错误: {str(e)}")
+                    results[target.name] = False
+
+        print("\n" + "=" * 60)
+        print(f"作业完成 ({command})")
+        print("=" * 60)
+        for target in self.targets:
+            status = "成功" if results.get(target.name) else "有失败"
+            print(f"  {target.name}: {status} (批次 {', '.join(map(str, target.batches))}, 目录 {target.download_dir})")
+        print("=" * 60)
+        return results
+
+def load_job_spec(path):
+    """读取作业文件 (.json，或安装PyYAML时的 .yaml/.yml)"""
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+    if path.endswith((".yaml", ".yml")):
+        if yaml is None:
+            raise ValueError("读取YAML作业文件需要安装PyYAML (pip install pyyaml)，或改用JSON格式")
+        spec = yaml.safe_load(text)
+    else:
+        spec = json.loads(text)
+    if not isinstance(spec, dict):
+        raise ValueError(f"作业文件格式无效: {path}")
+    return DatasetJob(spec)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import errno
+import os
+import threading
+import time
+
+import metrics
+
+DISK_SPACE_POLICIES = ("wait", "abort", "off")
+
+class DiskFullError(Exception):
+    """等待磁盘空间超时"""
+
+def _existing_dir(path):
+    """path所在的、已经存在的最近一级目录 (目标目录可能还没有创建)"""
+    directory = os.path.dirname(os.path.abspath(path))
+    while not os.path.isdir(directory):
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            break
+        directory = parent
+    return directory
+
+def free_bytes(path):
+    """path所在文件系统中当前用户可用的字节数"""
+    st = os.statvfs(_existing_dir(path))
+    return st.f_bavail * st.f_frsize
+
+def allocated_bytes(path):
+    """文件实际占用的磁盘空间 (预分配的 .part 文件是稀疏的，只有写入的部分占用空间)"""
+    try:
+        return os.stat(path).st_blocks * 512
+    except OSError:
+        return 0
+
+def _device(path):
+    return os.stat(_existing_dir(path)).st_dev
+
+def plan_space(download_tasks, reserve_bytes=0):
+    """按文件系统汇总下载还需要的空间，返回 [{"path", "files", "needed", "free", "short"}, ...]
+
+    needed为各文件的大小减去 .part 文件已经占用的空间 (继续下载时只需要剩余部分)，
+    short为还差的字节数 (考虑保留空间reserve_bytes)，空间足够时为0。
+    """
+    filesystems = {}
+    for file_item, local_path in download_tasks:
+        size = file_item.get("size") or 0
+        device = _device(local_path)
+        entry = filesystems.setdefault(device, {
+            "path": _existing_dir(local_path), "files": 0, "needed": 0, "free": free_bytes(local_path),
+        })
+        entry["files"] += 1
+        entry["needed"] += max(0, size - allocated_bytes(local_path + ".part"))
+    plan = list(filesystems.values())
+    for entry in plan:
+        entry["short"] = max(0, entry["needed"] + reserve_bytes - entry["free"])
+    return plan
+
+class DiskSpaceGate:
+    """下载的磁盘空间背压
+
+    每个文件开始下载前调用acquire: 目标文件系统的可用空间减去正在下载的文件还要写入的空间和
+    保留空间后，放不下这个文件时暂停 (工作线程等待，已经在下载的文件继续)，每隔poll_interval秒
+    重新检查，解压或上传等下游步骤删除文件、释放空间后自动继续。wait_timeout为0表示一直等待。
+    preallocate为True时用posix_fallocate真正预留 .part 文件的空间，空间不足在开始时就会发现，
+    而不是下载到一半才写入失败。
+    同一进程中的多个下载器 (例如作业文件中的多个目标) 共用一个DiskSpaceGate，预留空间一起计算。
+    """
+
+    def __init__(self, reserve_bytes=0, preallocate=False, poll_interval=30, wait_timeout=0):
+        self.reserve_bytes = reserve_bytes
+        self.preallocate = preallocate
+        self.poll_interval = poll_interval
+        self.wait_timeout = wait_timeout
+        self._lock = threading.Lock()
+        self._inflight = {}  # .part路径 -> (文件系统, 大小)
+        self._waiting = 0
+
+    def _outstanding(self, device):
+        """正在下载的文件还要写入的字节数 (持有锁时调用)"""
+        return sum(max(0, size - allocated_bytes(path))
+                   for path, (dev, size) in self._inflight.items() if dev == device)
+
+    def _try_reserve(self, part_path, size):
+        device = _device(part_path)
+        with self._lock:
+            needed = max(0, size - allocated_bytes(part_path))
+            available = free_bytes(part_path) - self._outstanding(device) - self.reserve_bytes
+            if needed <= available:
+                self._inflight[part_path] = (device, size)
+                return True, available
+            return False, available
+
+    def acquire(self, part_path, size):
+        """等到part_path所在的文件系统放得下size字节后登记这个文件"""
+        if not size:
+            return
+        ok, available = self._try_reserve(part_path, size)
+        if ok:
+            return
+        name = os.path.basename(part_path)
+        print(f"磁盘空间不足，暂停开始新的下载: {name} 需要 {_format_size(size)}，"
+              f"可用 {_format_size(max(0, available))} (保留 {_format_size(self.reserve_bytes)})，"
+              f"等待释放空间...")
+        self._wait(lambda: self._try_reserve(part_path, size)[0], _existing_dir(part_path))
+        print(f"磁盘空间已恢复，继续下载: {name}")
+
+    def wait_for_space(self, path, size):
+        """写入时遇到ENOSPC (例如其他程序占用了空间) 后等待，直到有size字节的空余"""
+        print(f"磁盘已满，暂停写入 {os.path.basename(path)}，等待释放空间...")
+        self._wait(lambda: free_bytes(path) - self.reserve_bytes >= size, _existing_dir(path))
+
+    def _wait(self, ready, directory):
+        deadline = time.monotonic() + self.wait_timeout if self.wait_timeout else None
+        with self._lock:
+            self._waiting += 1
+        metrics.DISK_INTAKE_PAUSED.set(1)
+        try:
+            while not ready():
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise DiskFullError(f"等待 {directory} 的磁盘空间超过 {self.wait_timeout:.0f} 秒")
+                metrics.DISK_FREE_BYTES.set(free_bytes(directory), path=directory)
+                time.sleep(self.poll_interval)
+        finally:
+            with self._lock:
+                self._waiting -= 1
+                if self._waiting == 0:
+                    metrics.DISK_INTAKE_PAUSED.set(0)
+
+    def release(self, part_path):
+        with self._lock:
+            self._inflight.pop(part_path, None)
+
+    def allocate(self, f, size):
+        """把 .part 文件扩展到size字节；preallocate时真正分配磁盘空间，文件系统不支持时退回稀疏文件"""
+        if self.preallocate and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)
+                return
+            except OSError as e:
+                if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+                    raise
+        f.truncate(size)
+
+def is_disk_full(error):
+    return isinstance(error, OSError) and error.errno in (errno.ENOSPC, errno.EDQUOT)
+
+def _format_size(size_bytes):
+    for unit in ("B", "KB", "MB", "GB", "TB"):
+        if size_bytes < 1024 or unit == "TB":
+            return f"{size_bytes:.2f} {unit}"
+        size_bytes /= 1024
+
+def print_plan(plan, reserve_bytes=0):
+    """打印磁盘空间计划，返回空间是否足够"""
+    sufficient = True
+    for entry in plan:
+        status = "足够" if not entry["short"] else f"不足，还差 {_format_size(entry['short'])}"
+        print(f"磁盘空间: {entry['path']} 需要 {_format_size(entry['needed'])} ({entry['files']} 个文件)，"
+              f"可用 {_format_size(entry['free'])}，保留 {_format_size(reserve_bytes)} - {status}")
+        if entry["short"]:
+            sufficient = False
+    return sufficient
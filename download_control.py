@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import fnmatch
+import http.client
+import json
+import os
+import threading
+from urllib.parse import urlparse
+
+from config import CONTROL_ADDRESS
+
+# 控制命令: 名称 -> 说明
+COMMANDS = {
+    "status": "查看线程数、进度、下载中/排队/暂停的文件",
+    "priority": "修改文件的优先级 (数值大的先下载)",
+    "pause": "暂停文件 (下载中的停在当前位置)",
+    "resume": "恢复暂停的文件",
+    "workers": "修改并行下载数量",
+    "rate": "修改总带宽限制",
+    "add": "把另一个批次加入正在进行的下载",
+}
+
+def make_matcher(patterns):
+    """按文件名通配符或项目ID选择文件，没有条件时选择全部"""
+    patterns = list(patterns or ())
+    if not patterns:
+        return lambda file_item: True
+    return lambda file_item: any(
+        file_item["id"] == p or fnmatch.fnmatchcase(file_item["name"], p) for p in patterns
+    )
+
+class DownloadController:
+    """把控制命令应用到下载器当前的调度器上"""
+
+    def __init__(self, downloader):
+        self.downloader = downloader
+
+    def _scheduler(self):
+        scheduler = self.downloader.scheduler
+        if scheduler is None:
+            raise RuntimeError("当前没有正在进行的下载")
+        return scheduler
+
+    def handle(self, command, params):
+        downloader = self.downloader
+        if command == "status":
+            result = self._scheduler().status(int(params.get("limit", 20)))
+            result["rate_limit"] = downloader.limiter.current_rate()
+            return result
+        if command == "priority":
+            count = self._scheduler().set_priority(make_matcher(params.get("patterns")), int(params["priority"]))
+            return {"changed": count}
+        if command == "pause":
+            if not params.get("patterns"):
+                raise ValueError("pause 需要指定文件名通配符或项目ID")
+            return {"paused": self._scheduler().pause(make_matcher(params["patterns"]))}
+        if command == "resume":
+            return {"resumed": self._scheduler().resume(make_matcher(params.get("patterns")))}
+        if command == "workers":
+            downloader.set_max_workers(int(params["count"]))
+            return {"max_workers": downloader.max_workers}
+        if command == "rate":
+            from rate_limiter import parse_rate
+            downloader.set_rate_limit(parse_rate(params.get("limit") or ""))
+            return {"rate_limit": downloader.limiter.current_rate()}
+        if command == "add":
+            return {"added": downloader.enqueue_batch(int(params["batch"]))}
+        raise ValueError(f"未知的控制命令: {command}")
+
+def _make_handler(controller):
+    from http.server import BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def _reply(self, status, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _dispatch(self, params):
+            command = urlparse(self.path).path.strip("/")
+            if command not in COMMANDS:
+                self._reply(404, {"error": f"未知的控制命令: {command}"})
+                return
+            try:
+                self._reply(200, controller.handle(command, params))
+            except (KeyError, ValueError, TypeError) as e:
+                self._reply(400, {"error": f"参数错误: {e}"})
+            except Exception as e:
+                self._reply(409, {"error": str(e)})
+
+        def do_GET(self):
+            self._dispatch({})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            try:
+                params = json.loads(self.rfile.read(length) or b"{}")
+            except ValueError:
+                self._reply(400, {"error": "请求内容不是有效的JSON"})
+                return
+            self._dispatch(params)
+
+    return Handler
+
+def start_control_server(downloader, address=CONTROL_ADDRESS):
+    """在后台线程中启动控制接口，返回停止函数
+
+    address为 unix:///路径 (只有当前用户可以连接) 或 http://127.0.0.1:端口。
+    控制接口没有认证，TCP地址只允许本机回环地址。
+    """
+    handler = _make_handler(DownloadController(downloader))
+    parsed = urlparse(address)
+    socket_path = None
+    if parsed.scheme == "unix":
+        import socketserver
+        socket_path = parsed.path
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = socketserver.ThreadingUnixStreamServer(socket_path, handler)
+        os.chmod(socket_path, 0o600)
+    elif parsed.scheme == "http":
+        if parsed.hostname not in ("127.0.0.1", "localhost", "::1"):
+            raise ValueError(f"控制接口只能监听本机地址: {address}")
+        from http.server import ThreadingHTTPServer
+        server = ThreadingHTTPServer((parsed.hostname, parsed.port or 0), handler)
+        address = f"http://{parsed.hostname}:{server.server_port}"
+    else:
+        raise ValueError(f"无效的控制接口地址: {address} (应为 unix:///路径 或 http://127.0.0.1:端口)")
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="download-control", daemon=True).start()
+    downloader.control = address
+    print(f"控制接口: {address}  (python download_control.py --control={address} status)")
+
+    def stop():
+        server.shutdown()
+        server.server_close()
+        downloader.control = None
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+    return stop
+
+def send_command(address, command, params=None, timeout=30):
+    """向正在运行的下载进程发送控制命令，返回结果 (dict)"""
+    parsed = urlparse(address)
+    if parsed.scheme == "unix":
+        from token_broker import UnixHTTPConnection
+        conn = UnixHTTPConnection(parsed.path, timeout)
+    elif parsed.scheme == "http":
+        conn = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=timeout)
+    else:
+        raise ValueError(f"无效的控制接口地址: {address}")
+    try:
+        body = json.dumps(params or {}).encode("utf-8")
+        conn.request("POST", f"/{command}", body=body, headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        result = json.loads(response.read() or b"{}")
+    except OSError as e:
+        raise Exception(f"无法连接控制接口 {address}: {e}")
+    finally:
+        conn.close()
+    if response.status != 200:
+        raise Exception(result.get("error", f"控制接口返回错误 {response.status}"))
+    return result
+
+def _format_size(size_bytes):
+    for unit in ("B", "KB", "MB", "GB", "TB"):
+        if size_bytes < 1024 or unit == "TB":
+            return f"{size_bytes:.2f} {unit}"
+        size_bytes /= 1024
+
+def print_status(status):
+    rate = status.get("rate_limit")
+    print(f"线程: {status['workers']}/{status['max_workers']}  进度: {status['completed']}/{status['total']} "
+          f"(失败 {status['failed']})  限速: {_format_size(rate) + '/s' if rate else '不限'}")
+    if status["active"]:
+        print("下载中:")
+        for f in status["active"]:
+            print(f"  [{f['priority']:>3}] {f['name']} ({f['segments']} 个分段，剩余 {_format_size(f['remaining'])})")
+    print(f"排队: {status['queued_count']}")
+    for f in status["queued"]:
+        print(f"  [{f['priority']:>3}] {f['name']} ({_format_size(f['size'] or 0)})")
+    if status["paused"]:
+        print(f"暂停: {len(status['paused'])}")
+        for f in status["paused"]:
+            print(f"  [{f['priority']:>3}] {f['name']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="调整正在运行的下载: 优先级、暂停/恢复、并行数、限速、加入批次")
+    parser.add_argument("--control", default=CONTROL_ADDRESS,
+                        help="下载进程的控制接口地址 (默认CONTROL_ADDRESS)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    status = subparsers.add_parser("status", help=COMMANDS["status"])
+    status.add_argument("--limit", type=int, default=20, help="列出排在最前面的N个文件")
+    priority = subparsers.add_parser("priority", help=COMMANDS["priority"])
+    priority.add_argument("priority", type=int)
+    priority.add_argument("patterns", nargs="+", help="文件名通配符或项目ID")
+    pause = subparsers.add_parser("pause", help=COMMANDS["pause"])
+    pause.add_argument("patterns", nargs="+", help="文件名通配符或项目ID")
+    resume = subparsers.add_parser("resume", help=COMMANDS["resume"])
+    resume.add_argument("patterns", nargs="*", help="文件名通配符或项目ID，不写表示全部")
+    workers = subparsers.add_parser("workers", help=COMMANDS["workers"])
+    workers.add_argument("count", type=int)
+    rate = subparsers.add_parser("rate", help=COMMANDS["rate"])
+    rate.add_argument("limit", help="例如 50M，0表示不限速")
+    add = subparsers.add_parser("add", help=COMMANDS["add"])
+    add.add_argument("batch", type=int)
+
+    args = parser.parse_args()
+    if not args.control:
+        parser.error("请用 --control 或 CONTROL_ADDRESS 指定下载进程的控制接口地址")
+
+    params = {key: value for key, value in vars(args).items() if key not in ("control", "command")}
+    try:
+        result = send_command(args.control, args.command, params)
+    except Exception as e:
+        print(f"发生错误: {e}")
+        raise SystemExit(1)
+    if args.command == "status":
+        print_status(result)
+    else:
+        print(json.dumps(result, ensure_ascii=False))
+
+if __name__ == "__main__":
+    main()
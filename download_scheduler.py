@@ -0,0 +1,723 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import heapq
+import itertools
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+
+import metrics
+import profiling
+from disk_space import is_disk_full
+
+# 排序策略: 名称 -> 排序键函数(参数为file_item)。也可以直接传入自定义的键函数
+ORDER_POLICIES = {
+    "listing": None,  # 保持列表顺序
+    "largest": lambda file_item: -(file_item.get("size") or 0),  # 大文件优先，缩短整体完成时间
+    "smallest": lambda file_item: file_item.get("size") or 0,  # 小文件优先，尽早开始校验
+}
+
+class _Transfer:
+    """一个文件的下载状态，可能由多个分段并行完成"""
+
+    def __init__(self, file_item, local_path, journal=None, on_success=None, group=None):
+        self.file_item = file_item
+        self.local_path = local_path
+        self.part_path = local_path + ".part"
+        self.size = file_item.get("size")
+        self.journal = journal  # 记录这个文件状态的BatchJournal (运行中加入的批次有自己的日志)
+        self.on_success = on_success
+        self.group = group  # 运行中加入的批次的名称，原有的文件为None
+        self.priority = 0
+        self.rank = 0  # 按排序策略的位置，同一优先级中rank小的先下载
+        self.paused = False
+        self.finished = False
+        self.download_url = None
+        self.url_lock = threading.Lock()  # 多个分段同时发现下载链接过期时只重新获取一次
+        self.pending_segments = 0
+        self.failed = False
+        self.error = None
+        self.started_at = None
+        self.retries = 0
+        self.segments = 0
+
+class _Segment:
+    """文件中的一个字节区间 [start, end)，end可能在下载过程中因尾部拆分而缩小"""
+
+    def __init__(self, transfer, start, end):
+        self.transfer = transfer
+        self.start = start
+        self.pos = start
+        self.end = end
+
+    @property
+    def remaining(self):
+        return self.end - self.pos
+
+def _transfer_of(work):
+    return work if isinstance(work, _Transfer) else work.transfer
+
+class _Paused(Exception):
+    """文件被暂停，分段停在当前位置，恢复后从这里继续"""
+
+class _RetryableError(Exception):
+    """可以从当前位置重试的分段错误，retry_after为服务器要求的等待秒数"""
+
+    def __init__(self, message, kind, retry_after=None, url=None):
+        super().__init__(message)
+        self.kind = kind  # throttled / connection / truncated / expired / disk_full
+        self.retry_after = retry_after
+        self.url = url  # kind为expired时是失效的下载链接
+
+def _error_class(error):
+    """错误类别，写入运行记录用于统计失败原因"""
+    if error is None:
+        return None
+    if isinstance(error, _RetryableError):
+        return error.kind
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return f"http_{error.response.status_code}"
+    return type(error).__name__
+
+# fdatasync只同步数据不同步元数据，没有时(例如macOS)使用fsync
+_fdatasync = getattr(os, "fdatasync", os.fsync)
+
+# 预先认证的下载链接过期时服务器返回的状态码，重新获取链接后从当前位置重试
+_EXPIRED_STATUS = (401, 403, 404, 410)
+
+# 可以从已下载位置重试的网络错误 (本地磁盘错误和HTTP 4xx不重试)
+_NETWORK_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.Timeout,
+)
+
+class DownloadScheduler:
+    """按文件大小排序的并行下载调度器
+
+    文件按排序策略进入队列，由固定数量的工作线程处理。当队列已空、有工作线程空闲时，
+    会把剩余字节最多的正在下载的文件从当前位置一分为二，新分段交给空闲线程用Range请求
+    下载(尾部拆分)，避免批次末尾只剩几个大文件单线程下载。
+    分段写入同一个预分配的 .part 文件，全部完成后原子重命名为目标文件。
+    连接中断或被限流的分段从已下载的位置继续，最多重试max_retries次。
+
+    提供journal (run_journal.BatchJournal) 时，每个分段每下载checkpoint_bytes字节就把 .part 文件
+    同步到磁盘并记录位置；进程重启后从记录的位置继续下载，而不是从头开始。
+
+    提供disk_gate (disk_space.DiskSpaceGate) 时，每个文件开始前先等到磁盘放得下它；
+    写入时磁盘已满的分段等待空间释放后从当前位置继续，不算作失败。
+
+    队列是按优先级排列的堆: 优先级高的先下载，同一优先级中已经开始的文件的分段优先，其余按排序策略。
+    运行中可以通过set_priority/pause/resume/set_workers/add_tasks调整 (见download_control.py)，
+    优先级和暂停标记写入日志，重启后仍然有效。暂停的文件停在当前位置；只剩暂停的文件时，
+    hold_paused为True (有控制接口可以恢复) 则继续等待，否则结束运行，这些文件留到下次。
+    """
+
+    def __init__(self, downloader, max_workers=5, order="largest",
+                 split_threshold=64 * 1024 * 1024, chunk_size=1024 * 1024, max_retries=3,
+                 journal=None, checkpoint_bytes=64 * 1024 * 1024, disk_gate=None):
+        self.downloader = downloader
+        self.max_workers = max_workers
+        self.order = order
+        self.split_threshold = split_threshold  # 剩余字节超过该值的分段才会被拆分
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.journal = journal
+        self.checkpoint_bytes = checkpoint_bytes
+        self.disk_gate = disk_gate
+
+        self.hold_paused = False
+
+        self._lock = threading.Lock()
+        self._work_available = threading.Condition(self._lock)
+        # 待处理的 _Transfer(尚未开始) 或 _Segment(拆分出的分段)，堆中的元素为 (排序键, 工作)
+        self._queue = []
+        self._seq = itertools.count()
+        self._rank = itertools.count()
+        self._held = {}  # 暂停的文件: item_id -> [工作, ...]
+        self._transfers = {}  # item_id -> _Transfer，包括已经完成的
+        self._active_segments = []
+        self._unfinished = 0
+        self._threads = []
+        self._live_workers = 0
+        self._closed = False  # 所有工作线程都已退出，不能再加入任务
+        self.records = []
+        self._successful = []
+        self._failed = []
+        self._completed = 0
+        self._total = 0
+        self._groups = {}  # 运行中加入的批次: 名称 -> [成功数, 失败数]
+
+    def _sort_tasks(self, download_tasks):
+        key = ORDER_POLICIES.get(self.order) if isinstance(self.order, str) else self.order
+        if isinstance(self.order, str) and self.order not in ORDER_POLICIES:
+            raise ValueError(f"未知的排序策略: {self.order}")
+        if key is None:
+            return list(download_tasks)
+        return sorted(download_tasks, key=lambda task: key(task[0]))
+
+    def run(self, download_tasks, on_success=None):
+        """下载所有任务，返回(成功的文件列表, 失败的文件列表)
+
+        download_tasks为[(file_item, local_path), ...]；on_success在文件完成时以
+        (file_item, local_path)调用，调用在持有调度器锁之外进行。
+        每个文件的耗时、重试次数、分段数和错误类别保存在self.records中。
+        暂停的文件没有下载，算在失败的文件中 (错误类别为paused)，日志中的状态不变。
+        运行中加入的批次 (add_tasks) 不计入返回值，只记录在self.records中。
+        """
+        self._enqueue(download_tasks, self.journal, on_success)
+
+        metrics.QUEUE_DEPTH.add_callback(self._queue_depth)
+        try:
+            with self._lock:
+                self._start_workers(min(self.max_workers, max(1, self._total)))
+            while True:
+                with self._lock:
+                    workers = [t for t in self._threads if t.is_alive()]
+                if not workers:
+                    break
+                for worker in workers:
+                    worker.join()
+        finally:
+            metrics.QUEUE_DEPTH.remove_callback(self._queue_depth)
+
+        self._record_paused()
+        for group, (succeeded, failed) in self._groups.items():
+            print(f"运行中加入的{group}: 成功 {succeeded} 个，失败 {failed} 个")
+        return self._successful, self._failed
+
+    def _enqueue(self, download_tasks, journal, on_success, group=None):
+        """把任务按排序策略加入队列，已经在本次运行中的文件跳过，返回加入的数量"""
+        options = journal.queue_options() if journal else {}
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("下载已经结束，不能再加入文件")
+            added = 0
+            for file_item, local_path in self._sort_tasks(download_tasks):
+                if file_item["id"] in self._transfers:
+                    continue
+                transfer = _Transfer(file_item, local_path, journal, on_success, group)
+                transfer.priority, transfer.paused = options.get(file_item["id"], (0, False))
+                transfer.rank = next(self._rank)
+                self._transfers[file_item["id"]] = transfer
+                if transfer.paused:
+                    self._held.setdefault(file_item["id"], []).append(transfer)
+                else:
+                    self._push(transfer)
+                added += 1
+            self._unfinished += added
+            self._total += added
+            if group is not None:
+                self._groups.setdefault(group, [0, 0])
+            self._work_available.notify_all()
+        return added
+
+    def _push(self, work):
+        """加入队列 (持有锁时调用)，已经开始的文件的分段排在同一优先级的新文件之前"""
+        transfer = _transfer_of(work)
+        rank = transfer.rank if work is transfer else -1
+        heapq.heappush(self._queue, ((-transfer.priority, rank, next(self._seq)), work))
+
+    def _start_workers(self, count):
+        """启动工作线程，直到存活的线程数达到count (持有锁时调用)"""
+        while self._live_workers < count:
+            worker = threading.Thread(target=self._worker, name=f"download-worker-{len(self._threads)}", daemon=True)
+            self._threads.append(worker)
+            self._live_workers += 1
+            worker.start()
+
+    def _record_paused(self):
+        """运行结束时仍然暂停的文件记为失败 (错误类别paused)"""
+        for works in self._held.values():
+            transfer = _transfer_of(works[0])
+            if transfer.group is None:
+                self._failed.append(transfer.file_item)
+            self.records.append({
+                "file_item": transfer.file_item, "success": False,
+                "duration": time.time() - transfer.started_at if transfer.started_at else 0,
+                "retries": transfer.retries, "segments": transfer.segments,
+                "error_class": "paused", "error": "已暂停",
+            })
+        if self._held:
+            print(f"{len(self._held)} 个文件已暂停，没有下载 (日志中保留暂停标记，恢复后重新运行同一个命令即可继续)")
+
+    def _queue_depth(self):
+        """供metrics采集: 排队中的工作数量和正在下载的分段数量"""
+        with self._lock:
+            return [(("queued",), len(self._queue)), (("active",), len(self._active_segments))]
+
+    def _next_work(self):
+        """取下一个工作单元；队列为空时尝试拆分尾部分段；全部完成或线程数被调低时返回None"""
+        with self._lock:
+            while True:
+                if self._live_workers > self.max_workers:
+                    self._live_workers -= 1
+                    return None
+                if self._queue:
+                    work = heapq.heappop(self._queue)[1]
+                    transfer = _transfer_of(work)
+                    if transfer.paused:
+                        self._held.setdefault(transfer.file_item["id"], []).append(work)
+                        continue
+                    return work
+                if self._unfinished == 0 or (
+                        self._unfinished == len(self._held) and not self._active_segments and not self.hold_paused):
+                    # 全部完成，或者只剩暂停的文件且没有控制接口可以恢复
+                    self._live_workers -= 1
+                    if self._live_workers == 0:
+                        self._closed = True
+                    self._work_available.notify_all()
+                    return None
+
+                segment = self._split_largest_segment()
+                if segment is not None:
+                    return segment
+
+                # 等待新的工作或其他线程完成
+                self._work_available.wait(timeout=1.0)
+
+    def _split_largest_segment(self):
+        """把剩余字节最多的分段从中间拆开，返回新分段；没有可拆分的分段时返回None"""
+        candidates = [
+            s for s in self._active_segments
+            if not s.transfer.failed and not s.transfer.paused and s.transfer.size and s.remaining > self.split_threshold
+        ]
+        if not candidates:
+            return None
+
+        segment = max(candidates, key=lambda s: s.remaining)
+        middle = segment.pos + segment.remaining // 2
+        new_segment = _Segment(segment.transfer, middle, segment.end)
+        if segment.transfer.journal:
+            segment.transfer.journal.split(segment.transfer.file_item["id"], segment.start, middle, segment.end)
+        segment.end = middle
+        segment.transfer.pending_segments += 1
+        segment.transfer.segments += 1
+        print(f"尾部拆分: {segment.transfer.file_item['name']} 从 "
+              f"{self.downloader._format_size(middle)} 处拆分出 "
+              f"{self.downloader._format_size(new_segment.remaining)}")
+        return new_segment
+
+    def _worker(self):
+        while True:
+            work = self._next_work()
+            if work is None:
+                return
+
+            if isinstance(work, _Transfer):
+                segment = self._start_transfer(work)
+                if segment is None:
+                    continue
+            else:
+                segment = work
+
+            self._run_segment(segment)
+
+    def _resume_ranges(self, transfer):
+        """日志中记录的分段，.part文件不存在或大小不对时返回None (从头下载)"""
+        if not transfer.journal or not transfer.size:
+            return None
+        ranges = transfer.journal.resume_segments(transfer.file_item["id"])
+        if not ranges:
+            return None
+        try:
+            if os.path.getsize(transfer.part_path) != transfer.size:
+                return None
+        except OSError:
+            return None
+        return ranges
+
+    def _start_transfer(self, transfer):
+        """获取下载链接并预分配 .part 文件，返回第一个分段
+
+        日志中有上次的分段位置时只下载每个分段剩余的部分，其余分段放回队列。
+        """
+        file_item = transfer.file_item
+        transfer.started_at = time.time()
+        ranges = self._resume_ranges(transfer)
+        if ranges is not None and all(pos >= end for _, pos, end in ranges):
+            # 上次已经全部下载，只差重命名
+            transfer.segments = len(ranges)
+            self._finish_transfer(transfer)
+            return None
+
+        try:
+            if self.disk_gate is not None:
+                # 磁盘空间不足时在这里等待 (在获取下载链接之前，等待期间链接不会过期)
+                with profiling.phase("disk_wait", file=file_item["name"]):
+                    self.disk_gate.acquire(transfer.part_path, transfer.size)
+
+            transfer.download_url = self.downloader.get_download_url(file_item)
+            if not transfer.download_url:
+                raise Exception("无法获取下载链接")
+
+            if ranges is None:
+                with profiling.phase("preallocate", file=file_item["name"]):
+                    os.makedirs(os.path.dirname(transfer.local_path) or ".", exist_ok=True)
+                    with open(transfer.part_path, "wb") as f:
+                        if transfer.size and self.disk_gate is not None:
+                            self.disk_gate.allocate(f, transfer.size)
+                        elif transfer.size:
+                            f.truncate(transfer.size)
+                end = transfer.size if transfer.size is not None else float("inf")
+                ranges = [(0, 0, end)]
+                if transfer.journal and transfer.size:
+                    transfer.journal.start(file_item["id"], ranges)
+        except Exception as e:
+            transfer.failed = True
+            transfer.error = e
+            self._finish_transfer(transfer)
+            return None
+
+        segments = []
+        for start, pos, end in ranges:
+            segment = _Segment(transfer, start, end)
+            segment.pos = pos
+            if segment.remaining > 0:
+                segments.append(segment)
+        if not segments:
+            # 空文件 (大小为0): 已经创建了空的 .part 文件，不需要下载
+            transfer.segments = len(ranges)
+            self._finish_transfer(transfer)
+            return None
+        resumed = sum(pos - start for start, pos, _ in ranges)
+        if resumed:
+            print(f"继续下载: {file_item['name']} (已完成 {self.downloader._format_size(resumed)} / "
+                  f"{self.downloader._format_size(transfer.size)})")
+        else:
+            print(f"正在下载: {file_item['name']} ({self.downloader._format_size(transfer.size)})")
+        with self._lock:
+            transfer.pending_segments = len(segments)
+            transfer.segments = len(ranges)
+            for segment in segments[1:]:
+                self._push(segment)
+            if len(segments) > 1:
+                self._work_available.notify_all()
+        return segments[0]
+
+    def _run_segment(self, segment):
+        transfer = segment.transfer
+        with self._lock:
+            self._active_segments.append(segment)
+
+        held = False
+        try:
+            attempt = 0
+            while not transfer.failed:
+                try:
+                    self._download_segment(segment)
+                    break
+                except _RetryableError as e:
+                    if e.kind == "disk_full" and self.disk_gate is not None:
+                        # 等待下游步骤释放空间，不计入重试次数
+                        metrics.RETRIES.inc(kind="disk_full")
+                        self.disk_gate.wait_for_space(transfer.part_path, segment.remaining)
+                        continue
+                    if attempt >= self.max_retries:
+                        raise
+                    attempt += 1
+                    transfer.retries += 1
+                    metrics.RETRIES.inc(kind="download")
+                    print(f"{transfer.file_item['name']}: {e}，"
+                          f"从 {self.downloader._format_size(segment.pos)} 处重试 ({attempt}/{self.max_retries})")
+                    if e.kind == "expired":
+                        self._refresh_download_url(transfer, e.url)
+                        continue
+                    time.sleep(e.retry_after if e.retry_after is not None else 2 ** (attempt - 1))
+        except _Paused:
+            held = True
+        except Exception as e:
+            transfer.failed = True
+            transfer.error = e
+        finally:
+            with self._lock:
+                self._active_segments.remove(segment)
+                done = False
+                if held and transfer.paused:
+                    self._held.setdefault(transfer.file_item["id"], []).append(segment)
+                elif held:
+                    # 暂停后又立即恢复了
+                    self._push(segment)
+                else:
+                    transfer.pending_segments -= 1
+                    done = transfer.pending_segments == 0
+                self._work_available.notify_all()
+            if done:
+                self._finish_transfer(transfer)
+
+    def _refresh_download_url(self, transfer, stale_url):
+        """下载链接过期 (长时间下载、重试或暂停后恢复) 时重新获取，其他分段已经获取过时直接使用"""
+        with transfer.url_lock:
+            if transfer.download_url != stale_url:
+                return
+            with profiling.phase("refresh_url", file=transfer.file_item["name"]):
+                download_url = self.downloader.get_download_url(transfer.file_item)
+            if not download_url:
+                raise Exception("无法重新获取下载链接")
+            transfer.download_url = download_url
+
+    def _download_segment(self, segment):
+        """从segment.pos开始下载到segment.end，网络错误、限流和链接过期抛出_RetryableError"""
+        transfer = segment.transfer
+        download_url = transfer.download_url
+        headers = {}
+        if segment.pos > 0 or transfer.size:
+            end = "" if segment.end == float("inf") else segment.end - 1
+            headers["Range"] = f"bytes={segment.pos}-{end}"
+
+        download_host = urlparse(download_url).hostname or ""
+        worker = threading.current_thread().name
+        name = transfer.file_item["name"]
+        start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            # connect阶段包括建立连接/TLS握手(连接未复用时)和等待响应头
+            with profiling.phase("connect", file=name):
+                response = self.downloader.session.get(download_url, headers=headers, stream=True, timeout=60)
+        except _NETWORK_ERRORS as e:
+            raise _RetryableError(f"连接失败: {e}", "connection")
+        metrics.DOWNLOAD_TTFB_SECONDS.observe(time.perf_counter() - start)
+
+        # 按块累计网络读取、写磁盘和限速等待的时间，分段结束时计入性能分析汇总
+        timings = [0.0, 0.0, 0.0]  # 读取, 写入, 限速等待
+        segment_from = segment.pos
+        loop_cpu_start = time.thread_time()
+
+        try:
+            if response.status_code in (429, 503):
+                metrics.GRAPH_THROTTLED.inc(endpoint="download")
+                retry_after = response.headers.get("Retry-After", "")
+                raise _RetryableError(f"服务器限流 ({response.status_code})", "throttled",
+                                      float(retry_after) if retry_after.isdigit() else None)
+            if response.status_code in _EXPIRED_STATUS:
+                raise _RetryableError(f"下载链接已失效 ({response.status_code})", "expired", url=download_url)
+            response.raise_for_status()
+            if segment.pos > 0 and response.status_code != 206:
+                raise Exception("服务器不支持Range请求，无法分段下载")
+
+            with open(transfer.part_path, "r+b") as f:
+                try:
+                    self._receive(segment, response, f, download_host, worker, start, timings)
+                finally:
+                    # 无论正常结束、中断还是暂停，都记录已经落盘的位置
+                    if transfer.journal and transfer.size and segment.pos > segment_from:
+                        self._checkpoint(segment, f)
+        except _NETWORK_ERRORS as e:
+            raise _RetryableError(f"连接中断: {e}", "connection")
+        except OSError as e:
+            if is_disk_full(e):
+                raise _RetryableError(f"磁盘已满: {e}", "disk_full")
+            raise
+        finally:
+            response.close()
+            if profiling.PROFILER.enabled:
+                profiler = profiling.PROFILER
+                read_seconds, write_seconds, throttle_seconds = timings
+                # 读取和写入的CPU时间难以分开，统一计入transfer
+                profiler.add("transfer", read_seconds, time.thread_time() - loop_cpu_start, file=name)
+                profiler.add("disk_write", write_seconds, file=name)
+                if throttle_seconds:
+                    profiler.add("throttle", throttle_seconds, file=name)
+                profiler.trace("segment", start, time.perf_counter() - start, time.thread_time() - cpu_start,
+                               file=name, offset=segment_from, bytes=segment.pos - segment_from,
+                               transfer_ms=round(read_seconds * 1000, 1), disk_write_ms=round(write_seconds * 1000, 1),
+                               throttle_ms=round(throttle_seconds * 1000, 1))
+
+        if transfer.paused and segment.pos < segment.end:
+            raise _Paused()
+        if segment.end != float("inf") and segment.pos < segment.end:
+            raise _RetryableError(f"连接提前结束 (已下载 {segment.pos - segment.start} 字节)", "truncated")
+
+    def _receive(self, segment, response, f, download_host, worker, start, timings):
+        """把响应写入segment.pos处，直到分段结束或连接结束；读取、写入和限速等待的耗时累加到timings"""
+        transfer = segment.transfer
+        checkpoint = transfer.journal is not None and bool(transfer.size)
+        unsynced = 0
+        f.seek(segment.pos)
+        chunk_start = start  # 从发出请求开始计时，包含首字节等待
+        read_start = time.perf_counter()
+        for chunk in response.iter_content(chunk_size=self.chunk_size):
+            read_end = time.perf_counter()
+            timings[0] += read_end - read_start
+            if transfer.failed or transfer.paused:
+                return
+            if not chunk:
+                read_start = time.perf_counter()
+                continue
+            with self._lock:
+                # 分段可能已被拆分，只写到当前的end为止
+                limit = segment.end - segment.pos
+            if len(chunk) > limit:
+                chunk = chunk[:int(limit)]
+            f.write(chunk)
+            write_end = time.perf_counter()
+            timings[1] += write_end - read_end
+            self.downloader.limiter.throttle(download_host, len(chunk))
+            now = time.perf_counter()
+            timings[2] += now - write_end
+            metrics.DOWNLOAD_BYTES.inc(len(chunk), worker=worker)
+            metrics.DOWNLOAD_ACTIVE_SECONDS.inc(now - chunk_start, worker=worker)
+            chunk_start = now
+            with self._lock:
+                segment.pos += len(chunk)
+                if segment.pos >= segment.end:
+                    return
+            unsynced += len(chunk)
+            if checkpoint and unsynced >= self.checkpoint_bytes:
+                sync_start = time.perf_counter()
+                self._checkpoint(segment, f)
+                timings[1] += time.perf_counter() - sync_start
+                unsynced = 0
+            read_start = time.perf_counter()
+
+    def _checkpoint(self, segment, f):
+        """把已写入的数据同步到磁盘后再记录分段位置"""
+        f.flush()
+        _fdatasync(f.fileno())
+        segment.transfer.journal.checkpoint(segment.transfer.file_item["id"], segment.start, segment.pos)
+
+    def _finish_transfer(self, transfer):
+        file_item = transfer.file_item
+        if self.disk_gate is not None:
+            self.disk_gate.release(transfer.part_path)
+        success = False
+        if not transfer.failed:
+            try:
+                with profiling.phase("finalize", file=file_item["name"]):
+                    actual_size = os.path.getsize(transfer.part_path)
+                    if transfer.size is not None and actual_size != transfer.size:
+                        raise Exception(f"文件大小不匹配 (本地: {actual_size}, 远程: {transfer.size})")
+                    os.replace(transfer.part_path, transfer.local_path)
+                success = True
+            except Exception as e:
+                transfer.error = e
+
+        elapsed = time.time() - transfer.started_at if transfer.started_at else 0
+        with self._lock:
+            transfer.finished = True
+            self._completed += 1
+            self._unfinished -= 1
+            completed = self._completed
+            if transfer.group is None:
+                (self._successful if success else self._failed).append(file_item)
+            else:
+                self._groups[transfer.group][0 if success else 1] += 1
+            self.records.append({
+                "file_item": file_item,
+                "success": success,
+                "duration": elapsed,
+                "retries": transfer.retries,
+                "segments": transfer.segments,
+                "error_class": None if success else _error_class(transfer.error),
+                "error": None if success else transfer.error,
+            })
+            self._work_available.notify_all()
+
+        metrics.DOWNLOAD_FILES.inc(result="success" if success else "failed")
+        if not success and transfer.journal:
+            # 保留分段位置，下次从断点继续
+            transfer.journal.mark(file_item["id"], "failed")
+        if success:
+            print(f"{file_item['name']} 下载完成 ({elapsed:.1f} 秒)")
+            if transfer.on_success:
+                transfer.on_success(file_item, transfer.local_path)
+        else:
+            print(f"{file_item['name']} 下载失败: {transfer.error}")
+        print(f"完成进度: {completed}/{self._total} ({completed/self._total*100:.1f}%)")
+
+    # 以下方法供控制接口 (download_control.py) 在运行中调用，match为以file_item为参数、返回bool的函数
+
+    def _persist(self, transfers, method, value):
+        """把优先级或暂停标记写入各文件所属批次的日志"""
+        journals = {}
+        for transfer in transfers:
+            if transfer.journal is not None:
+                journals.setdefault(id(transfer.journal), (transfer.journal, []))[1].append(transfer.file_item["id"])
+        for journal, item_ids in journals.values():
+            getattr(journal, method)(item_ids, value)
+
+    def set_priority(self, match, priority):
+        """修改未完成的文件的优先级 (数值大的先下载)，返回修改的文件数"""
+        with self._lock:
+            transfers = [t for t in self._transfers.values() if not t.finished and match(t.file_item)]
+            for transfer in transfers:
+                transfer.priority = priority
+            self._queue = [((-_transfer_of(work).priority,) + key[1:], work) for key, work in self._queue]
+            heapq.heapify(self._queue)
+        self._persist(transfers, "set_priority", priority)
+        return len(transfers)
+
+    def pause(self, match):
+        """暂停未完成的文件: 排队的不再开始，下载中的停在当前位置，返回暂停的文件数"""
+        with self._lock:
+            transfers = [t for t in self._transfers.values()
+                         if not t.finished and not t.paused and match(t.file_item)]
+            for transfer in transfers:
+                transfer.paused = True
+            queue = []
+            for entry in self._queue:
+                transfer = _transfer_of(entry[1])
+                if transfer.paused:
+                    self._held.setdefault(transfer.file_item["id"], []).append(entry[1])
+                else:
+                    queue.append(entry)
+            self._queue = queue
+            heapq.heapify(self._queue)
+        self._persist(transfers, "set_paused", True)
+        return len(transfers)
+
+    def resume(self, match):
+        """恢复暂停的文件，返回恢复的文件数"""
+        with self._lock:
+            transfers = [t for t in self._transfers.values() if t.paused and match(t.file_item)]
+            for transfer in transfers:
+                transfer.paused = False
+                for work in self._held.pop(transfer.file_item["id"], []):
+                    self._push(work)
+            self._work_available.notify_all()
+        self._persist(transfers, "set_paused", False)
+        return len(transfers)
+
+    def set_workers(self, count):
+        """修改并行下载数: 调高时立即启动新的线程，调低时多出的线程做完手上的分段后退出"""
+        with self._lock:
+            self.max_workers = count
+            if not self._closed and self._unfinished:
+                self._start_workers(count)
+            self._work_available.notify_all()
+
+    def add_tasks(self, download_tasks, journal=None, on_success=None, group=None):
+        """运行中加入新的文件，返回加入的数量 (已经在本次运行中的文件跳过)"""
+        added = self._enqueue(download_tasks, journal, on_success, group or "文件")
+        with self._lock:
+            if not self._closed:
+                self._start_workers(min(self.max_workers, self._unfinished))
+        return added
+
+    def status(self, limit=20):
+        """当前状态: 线程数、进度、下载中的文件、排在最前面的文件和暂停的文件"""
+        def describe(transfer):
+            return {"id": transfer.file_item["id"], "name": transfer.file_item["name"],
+                    "size": transfer.size, "priority": transfer.priority}
+
+        with self._lock:
+            active = {}
+            for segment in self._active_segments:
+                entry = active.setdefault(segment.transfer.file_item["id"], dict(describe(segment.transfer), segments=0, remaining=0))
+                entry["segments"] += 1
+                entry["remaining"] += 0 if segment.end == float("inf") else segment.remaining
+            return {
+                "workers": self._live_workers,
+                "max_workers": self.max_workers,
+                "completed": self._completed,
+                "total": self._total,
+                "failed": sum(1 for r in self.records if not r["success"]),
+                "active": list(active.values()),
+                "queued_count": len(self._queue),
+                "queued": [describe(_transfer_of(work)) for _, work in sorted(self._queue, key=lambda e: e[0])[:limit]],
+                "paused": [describe(_transfer_of(works[0])) for works in self._held.values()],
+            }
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
 import json
 import webbrowser
 from urllib.parse import parse_qs, urlparse
@@ -10,6 +11,7 @@ from config import (
     CLIENT_ID, CLIENT_SECRET, AUTHORITY, SCOPE, 
     REDIRECT_URI, TOKEN_CACHE_FILE
 )
+from token_broker import TokenCacheFile
 
 def get_access_token():
     """获取OneDrive访问令牌"""
@@ -40,6 +42,12 @@ def get_access_token():
         result = app.acquire_token_silent(SCOPE, account=accounts[0])
     
     if not result:
+        if not sys.stdin.isatty():
+            # 集群节点等非交互环境中没有人粘贴重定向URL，直接退出而不是一直等待输入
+            print("没有可用的缓存令牌，且当前不是交互式终端。")
+            print("请设置 CLIENT_SECRET 使用客户端凭据，或用 python token_broker.py serve 集中登录后设置 TOKEN_BROKER")
+            return None
+        
         print("需要获取新的访问令牌...")
         
         # 获取授权URL
@@ -79,9 +87,10 @@ def get_access_token():
     
     # 检查结果
     if "access_token" in result:
-        # 保存令牌缓存
-        with open(TOKEN_CACHE_FILE, "w") as f:
-            f.write(token_cache.serialize())
+        # 保存令牌缓存 (加锁并原子替换，不会和正在运行的下载进程互相覆盖成不完整的文件)
+        cache_file = TokenCacheFile(TOKEN_CACHE_FILE)
+        with cache_file.locked():
+            cache_file.save(token_cache)
         
         print("\n成功获取访问令牌!")
         print(f"令牌类型: {result.get('token_type', 'Bearer')}")
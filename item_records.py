@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 列出文件时只请求需要的字段，减少响应大小和解析开销
+FILE_SELECT_FIELDS = "id,name,size,eTag,cTag,lastModifiedDateTime,file,folder"
+
+# Graph字段名 -> FileRecord属性名，用于兼容按字典方式访问项目的代码(例如SyncState)
+_GRAPH_KEYS = {
+    "id": "id",
+    "name": "name",
+    "size": "size",
+    "eTag": "etag",
+    "cTag": "ctag",
+    "lastModifiedDateTime": "last_modified",
+}
+
+class FileRecord:
+    """紧凑的文件记录，只保留下载、校验和同步需要的字段
+
+    Graph返回的项目字典包含几十个嵌套字段，列出数百万个文件时会占用大量内存。
+    FileRecord使用__slots__只保存id、名称、大小、哈希和eTag/cTag，
+    同时支持 record["name"] / record.get("size") 的访问方式，可以直接传给按字典处理项目的代码。
+    """
+
+    __slots__ = ("id", "name", "size", "etag", "ctag", "last_modified", "quick_xor_hash", "sha1_hash")
+
+    def __init__(self, id, name, size=None, etag=None, ctag=None, last_modified=None,
+                 quick_xor_hash=None, sha1_hash=None):
+        self.id = id
+        self.name = name
+        self.size = size
+        self.etag = etag
+        self.ctag = ctag
+        self.last_modified = last_modified
+        self.quick_xor_hash = quick_xor_hash
+        self.sha1_hash = sha1_hash
+
+    @classmethod
+    def from_graph(cls, item):
+        """从Graph API返回的项目字典创建记录"""
+        hashes = (item.get("file") or {}).get("hashes") or {}
+        return cls(
+            item["id"],
+            item.get("name"),
+            item.get("size"),
+            item.get("eTag"),
+            item.get("cTag"),
+            item.get("lastModifiedDateTime"),
+            hashes.get("quickXorHash"),
+            hashes.get("sha1Hash"),
+        )
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, _GRAPH_KEYS[key])
+        except KeyError:
+            raise KeyError(key) from None
+
+    def get(self, key, default=None):
+        attribute = _GRAPH_KEYS.get(key)
+        if attribute is None:
+            return default
+        value = getattr(self, attribute)
+        return default if value is None else value
+
+    def __contains__(self, key):
+        return key in _GRAPH_KEYS and getattr(self, _GRAPH_KEYS[key]) is not None
+
+    def __repr__(self):
+        return f"FileRecord(id={self.id!r}, name={self.name!r}, size={self.size!r})"
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import bisect
+import json
+import re
+import sys
+import threading
+import time
+
+# 默认的耗时分桶(秒)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.extend(extra)
+    if not pairs:
+        return ""
+    escaped = ",".join(
+        f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for name, value in pairs
+    )
+    return "{" + escaped + "}"
+
+class Counter:
+    """只增不减的计数器"""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+class Gauge:
+    """可增可减的数值；也可以提供回调，在采集时计算当前值
+
+    回调返回[(标签值元组, 数值), ...]。
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labelnames=(), callback=None):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._callbacks = [callback] if callback else []
+        self._lock = threading.Lock()
+
+    def set(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] = value
+
+    def add_callback(self, callback):
+        with self._lock:
+            self._callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            try:
+                for key, value in callback():
+                    values[tuple(key)] = value
+            except Exception:
+                # 采集指标不能影响下载
+                pass
+        return [(self.name, key, value) for key, value in values.items()]
+
+class Histogram:
+    """累积分桶的直方图，同时记录总和与次数"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # key -> [各分桶计数..., 总和, 次数]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                entry[index] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def time(self, **labels):
+        """计时上下文管理器"""
+        return _Timer(self, labels)
+
+    def samples(self):
+        with self._lock:
+            values = {key: list(entry) for key, entry in self._values.items()}
+        samples = []
+        for key, entry in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, entry):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", key, cumulative, ("le", repr(float(bound)))))
+            samples.append((f"{self.name}_bucket", key, entry[-1], ("le", "+Inf")))
+            samples.append((f"{self.name}_sum", key, entry[-2]))
+            samples.append((f"{self.name}_count", key, entry[-1]))
+        return samples
+
+    def summary(self):
+        """每组标签的次数、总和与平均值，用于JSON日志"""
+        with self._lock:
+            return {
+                key: {"count": entry[-1], "sum": entry[-2], "avg": entry[-2] / entry[-1] if entry[-1] else 0.0}
+                for key, entry in self._values.items()
+            }
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+class MetricsRegistry:
+    """指标注册表，可以输出Prometheus文本格式或JSON快照"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=(), callback=None):
+        return self._register(Gauge(name, help_text, labelnames, callback))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def render_prometheus(self):
+        """Prometheus文本格式"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for sample in metric.samples():
+                name, key, value = sample[:3]
+                extra = [sample[3]] if len(sample) > 3 else None
+                lines.append(f"{name}{_format_labels(metric.labelnames, key, extra)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """所有指标的JSON快照，直方图只保留次数、总和与平均值"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        result = {"timestamp": time.time()}
+        for metric in metrics:
+            if isinstance(metric, Histogram):
+                values = metric.summary()
+            else:
+                values = {key: value for _, key, value in metric.samples()}
+            result[metric.name] = [
+                dict(zip(metric.labelnames, key), **(value if isinstance(value, dict) else {"value": value}))
+                for key, value in values.items()
+            ]
+        return result
+
+REGISTRY = MetricsRegistry()
+
+# 下载器使用的指标
+GRAPH_REQUEST_SECONDS = REGISTRY.histogram(
+    "onedrive_graph_request_seconds", "Graph API请求耗时", ("endpoint",))
+GRAPH_REQUESTS = REGISTRY.counter(
+    "onedrive_graph_requests_total", "Graph API请求次数", ("endpoint", "status"))
+GRAPH_THROTTLED = REGISTRY.counter(
+    "onedrive_graph_throttled_total", "Graph API返回429/503限流的次数", ("endpoint",))
+RETRIES = REGISTRY.counter(
+    "onedrive_retries_total", "重试次数", ("kind",))
+DOWNLOAD_BYTES = REGISTRY.counter(
+    "onedrive_download_bytes_total", "各下载线程接收的字节数", ("worker",))
+DOWNLOAD_ACTIVE_SECONDS = REGISTRY.counter(
+    "onedrive_download_active_seconds_total", "各下载线程处于传输状态的时间，与字节数相除即为线程带宽", ("worker",))
+DOWNLOAD_FILES = REGISTRY.counter(
+    "onedrive_download_files_total", "完成下载的文件数", ("result",))
+DOWNLOAD_TTFB_SECONDS = REGISTRY.histogram(
+    "onedrive_download_ttfb_seconds", "下载请求的首字节时间")
+TOKEN_REFRESH_SECONDS = REGISTRY.histogram(
+    "onedrive_token_refresh_seconds", "获取/刷新访问令牌的耗时", buckets=(0.1, 0.5, 1, 5, 30, 120, 600))
+QUEUE_DEPTH = REGISTRY.gauge(
+    "onedrive_queue_depth", "调度器中的工作数量", ("state",))
+HTTP_CONNECTIONS = REGISTRY.gauge(
+    "onedrive_http_connections_opened", "连接池新建的连接数", ("host",))
+HTTP_POOL_REQUESTS = REGISTRY.gauge(
+    "onedrive_http_pool_requests", "通过连接池发送的请求数，与新建连接数相比可以看出连接复用情况", ("host",))
+DISK_INTAKE_PAUSED = REGISTRY.gauge(
+    "onedrive_disk_intake_paused", "因磁盘空间不足暂停开始新下载时为1")
+DISK_FREE_BYTES = REGISTRY.gauge(
+    "onedrive_disk_free_bytes", "暂停期间下载目录所在文件系统的可用空间", ("path",))
+
+_ID_SEGMENT = re.compile(r"/(sites|drives|items)/[^/]+")
+_PATH_SEGMENT = re.compile(r"root:/.*?:")
+_SITE_PATH = re.compile(r"^/sites/[^/:]+:/.*$")
+
+def endpoint_label(endpoint):
+    """把具体的请求路径归一为模板，例如 /drives/{id}/items/{id}/children"""
+    path = endpoint.split("?", 1)[0]
+    if "://" in path:
+        path = "/" + path.split("://", 1)[1].split("/", 1)[-1]
+        path = re.sub(r"^/v1\.0", "", path)
+    if _SITE_PATH.match(path):
+        return "/sites/{host}:{path}"
+    path = _PATH_SEGMENT.sub("root:{path}:", path)
+    return _ID_SEGMENT.sub(lambda m: f"/{m.group(1)}/{{id}}", path)
+
+def track_session_connections(session):
+    """采集requests.Session连接池的新建连接数和请求数"""
+    def collect():
+        samples = []
+        for adapter in list(session.adapters.values()):
+            pools = getattr(getattr(adapter, "poolmanager", None), "pools", None)
+            if pools is None:
+                continue
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                samples.append(((pool.host,), pool.num_connections, pool.num_requests))
+        return samples
+
+    HTTP_CONNECTIONS.add_callback(lambda: [(key, opened) for key, opened, _ in collect()])
+    HTTP_POOL_REQUESTS.add_callback(lambda: [(key, sent) for key, _, sent in collect()])
+
+def _make_handler(registry):
+    # http.server只在启动指标端点时才导入，不影响命令的启动时间
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?", 1)[0] == "/metrics":
+                body = registry.render_prometheus().encode("utf-8")
+                content_type = "text/plain; version=0.0.4; charset=utf-8"
+            elif self.path.split("?", 1)[0] == "/metrics.json":
+                body = json.dumps(registry.snapshot(), ensure_ascii=False).encode("utf-8")
+                content_type = "application/json"
+            else:
+                self.send_response(404)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return MetricsHandler
+
+def start_metrics_server(port, host="127.0.0.1", registry=REGISTRY):
+    """在后台线程中启动 /metrics (Prometheus) 和 /metrics.json 端点"""
+    from http.server import ThreadingHTTPServer
+
+    server = ThreadingHTTPServer((host, port), _make_handler(registry))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    print(f"指标端点: http://{host}:{server.server_port}/metrics")
+    return server
+
+def start_json_logger(path=None, interval=30, registry=REGISTRY):
+    """每隔interval秒把指标快照以一行JSON追加到path (为None时输出到标准错误)
+
+    返回一个停止函数，调用后会写入最后一次快照并等待日志线程结束。
+    """
+    stop_event = threading.Event()
+
+    def write_snapshot():
+        line = json.dumps(registry.snapshot(), ensure_ascii=False)
+        if path:
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        else:
+            print(line, file=sys.stderr)
+
+    def run():
+        while not stop_event.wait(interval):
+            write_snapshot()
+        # 停止时写入最后一次快照
+        write_snapshot()
+
+    thread = threading.Thread(target=run, name="metrics-json-logger", daemon=True)
+    thread.start()
+
+    def stop():
+        stop_event.set()
+        thread.join()
+
+    return stop
@@ -3,13 +3,21 @@
 
 import os
 import json
-import requests
+import threading
 import time
+import requests
+import concurrent.futures
+from urllib.parse import urlparse
 from msal import PublicClientApplication, SerializableTokenCache
+from token_broker import TokenCacheFile
 from config import (
     CLIENT_ID, AUTHORITY, SCOPE, 
-    DOWNLOAD_PATH, TOKEN_CACHE_FILE
+    DOWNLOAD_PATH, TOKEN_CACHE_FILE, GRAPH_API_BASE, DEDUP_MODE, CONTENT_INDEX_FILE,
+    SHARD_CACHE, SHARD_CACHE_MAX_BYTES
 )
+from rate_limiter import get_global_limiter, parse_rate
+from content_index import ContentIndex, ContentDeduplicator
+from shard_cache import open_shard_cache
 
 class OneDriveDownloader:
     def __init__(self):
@@ -34,10 +42,39 @@ class OneDriveDownloader:
         # 获取访问令牌
         self.access_token = self._get_access_token()
         
+        # 并行设置
+        self.max_workers = 5  # 最大并行下载数量
+        self.max_list_workers = 4  # 最大并行列目录数量
+        
+        # Graph API遇到限流(429/503)或网络错误时的最大重试次数
+        self.max_api_retries = 3
+        
+        # 多个线程同时下载，进度按整行输出，互相不会覆盖
+        self._print_lock = threading.Lock()
+        
+        # 带宽限制，同一进程中的所有下载器共用
+        self.limiter = get_global_limiter()
+        
+        # 复用HTTP连接，连接池大小与并行数量匹配
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=self.max_workers + self.max_list_workers
+        )
+        self.session.mount("https://", adapter)
+        
+        # 按内容去重，内容相同的文件用硬链接/reflink代替下载
+        self.dedup = ContentDeduplicator(ContentIndex(CONTENT_INDEX_FILE), DEDUP_MODE)
+        
+        # 多个节点共享的分片缓存，下载前先查缓存，下载完成后写入缓存
+        self.shard_cache = open_shard_cache(SHARD_CACHE, int(parse_rate(SHARD_CACHE_MAX_BYTES) or 0) or None)
+        self._fetch_file = self.shard_cache.wrap(self.download_file) if self.shard_cache else self.download_file
+        
     def _save_token_cache(self):
-        """保存令牌缓存到文件"""
-        with open(TOKEN_CACHE_FILE, "w") as f:
-            f.write(self.token_cache.serialize())
+        """保存令牌缓存到文件 (加锁并原子替换，和同时运行的其他下载进程不冲突)"""
+        cache_file = TokenCacheFile(TOKEN_CACHE_FILE)
+        with cache_file.locked():
+            cache_file.save(self.token_cache)
     
     def _get_access_token(self):
         """获取访问令牌，如果需要则进行交互式登录"""
@@ -68,25 +105,53 @@ class OneDriveDownloader:
         return result["access_token"]
     
     def _make_api_request(self, endpoint, params=None):
-        """向Microsoft Graph API发送请求"""
+        """向Microsoft Graph API发送请求
+        
+        遇到限流(429/503)时按Retry-After等待后重试，网络错误时等待后重试，最多重试max_api_retries次。
+        """
         headers = {
             "Authorization": f"Bearer {self.access_token}",
             "Accept": "application/json"
         }
         
-        response = requests.get(
-            f"https://graph.microsoft.com/v1.0{endpoint}",
-            headers=headers,
-            params=params
-        )
-        
-        if response.status_code == 200:
-            return response.json()
+        # 分页链接(@odata.nextLink)是完整URL，直接使用
+        if endpoint.startswith(("https://", "http://")):
+            url = endpoint
         else:
+            url = f"{GRAPH_API_BASE}{endpoint}"
+        
+        for attempt in range(self.max_api_retries + 1):
+            try:
+                response = self.session.get(
+                    url,
+                    headers=headers,
+                    params=params,
+                    timeout=60
+                )
+            except requests.exceptions.RequestException as e:
+                if attempt < self.max_api_retries:
+                    time.sleep(2 ** attempt)
+                    continue
+                print(f"API请求失败: {str(e)}")
+                return None
+            
+            if response.status_code == 200:
+                return response.json()
+            
+            if response.status_code in (429, 503) and attempt < self.max_api_retries:
+                retry_after = response.headers.get("Retry-After", "")
+                time.sleep(float(retry_after) if retry_after.isdigit() else 2 ** attempt)
+                continue
+            
             print(f"API请求失败: {response.status_code}")
             print(response.text)
             return None
     
+    def _report(self, message):
+        """输出一整行 (多个下载线程的输出不会交错)"""
+        with self._print_lock:
+            print(message)
+    
     def list_items(self, folder_path):
         """列出指定文件夹中的所有项目"""
         if folder_path.startswith("/"):
@@ -97,7 +162,24 @@ class OneDriveDownloader:
         else:
             endpoint = "/me/drive/root/children"
         
-        return self._make_api_request(endpoint)
+        return self._list_all_pages(endpoint)
+    
+    def _list_all_pages(self, endpoint):
+        """获取列表接口的全部分页结果，合并到同一个value列表中"""
+        result = self._make_api_request(endpoint)
+        if not result or "value" not in result:
+            return result
+        
+        items = result["value"]
+        next_link = result.get("@odata.nextLink")
+        while next_link:
+            page = self._make_api_request(next_link)
+            if not page or "value" not in page:
+                return None
+            items.extend(page["value"])
+            next_link = page.get("@odata.nextLink")
+        
+        return {"value": items}
     
     def download_file(self, item, local_path):
         """下载单个文件"""
@@ -116,27 +198,40 @@ class OneDriveDownloader:
         os.makedirs(os.path.dirname(local_path), exist_ok=True)
         
         # 下载文件
+        # 先写入 .part 文件再原子替换: 目标文件可能是去重时建立的硬链接，
+        # 直接以 "wb" 打开会把其它副本一起截断改写
+        part_path = local_path + ".part"
         try:
-            response = requests.get(download_url, stream=True)
+            response = self.session.get(download_url, stream=True)
             response.raise_for_status()
             
             file_size = int(response.headers.get("Content-Length", 0))
-            print(f"正在下载: {item['name']} ({self._format_size(file_size)})")
+            self._report(f"正在下载: {item['name']} ({self._format_size(file_size)})")
             
-            with open(local_path, "wb") as f:
+            download_host = urlparse(download_url).hostname or ""
+            with open(part_path, "wb") as f:
                 downloaded = 0
+                next_report = 25
                 for chunk in response.iter_content(chunk_size=8192):
                     if chunk:
                         f.write(chunk)
                         downloaded += len(chunk)
-                        # 显示下载进度
+                        self.limiter.throttle(download_host, len(chunk))
+                        # 每完成25%输出一行进度
                         progress = (downloaded / file_size) * 100 if file_size > 0 else 0
-                        print(f"\r进度: {progress:.1f}%", end="")
+                        if progress >= next_report and progress < 100:
+                            self._report(f"{item['name']}: 进度 {progress:.0f}%")
+                            next_report = (int(progress) // 25 + 1) * 25
+            os.replace(part_path, local_path)
             
-            print("\n下载完成")
+            self._report(f"{item['name']} 下载完成")
             return True
         except Exception as e:
-            print(f"\n下载失败: {str(e)}")
+            self._report(f"{item['name']} 下载失败: {str(e)}")
+            try:
+                os.remove(part_path)
+            except OSError:
+                pass
             return False
     
     def _format_size(self, size_bytes):
@@ -148,34 +243,82 @@ class OneDriveDownloader:
         return f"{size_bytes:.2f} PB"
     
     def download_folder(self, folder_path, local_base_path=None):
-        """递归下载文件夹中的所有内容"""
+        """并行遍历文件夹树并下载所有内容
+        
+        列目录任务在一个线程池中并行执行，发现的文件直接提交到下载线程池，
+        不必等整棵树遍历完成。
+        """
         if local_base_path is None:
             local_base_path = DOWNLOAD_PATH
         
-        print(f"正在处理文件夹: {folder_path}")
-        items = self.list_items(folder_path)
+        download_futures = {}
+        failed_folders = []
         
-        if not items or "value" not in items:
-            print(f"无法获取文件夹内容: {folder_path}")
-            return
-        
-        for item in items["value"]:
-            item_name = item["name"]
-            item_path = os.path.join(folder_path, item_name) if folder_path else item_name
-            local_path = os.path.join(local_base_path, item_path)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_list_workers) as list_executor, \
+             concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as download_executor:
+            # 待完成的列目录任务: future -> 文件夹路径
+            pending_folders = {list_executor.submit(self.list_items, folder_path): folder_path}
             
-            if item.get("folder"):
-                # 如果是文件夹，递归下载
-                self.download_folder(item_path, local_base_path)
-            else:
-                # 如果是文件，直接下载
-                if os.path.exists(local_path):
-                    print(f"文件已存在，跳过: {item_path}")
-                    continue
-                
-                self.download_file(item, local_path)
-                # 添加短暂延迟以避免API限制
-                time.sleep(0.5)
+            while pending_folders:
+                done, _ = concurrent.futures.wait(
+                    pending_folders, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    current_path = pending_folders.pop(future)
+                    try:
+                        items = future.result()
+                    except Exception as e:
+                        self._report(f"获取文件夹内容时发生错误: {current_path}, 错误: {str(e)}")
+                        items = None
+                    
+                    if not items or "value" not in items:
+                        self._report(f"无法获取文件夹内容: {current_path}")
+                        failed_folders.append(current_path)
+                        continue
+                    
+                    self._report(f"正在处理文件夹: {current_path or '/'} ({len(items['value'])} 个项目)")
+                    
+                    for item in items["value"]:
+                        item_name = item["name"]
+                        item_path = os.path.join(current_path, item_name) if current_path else item_name
+                        local_path = os.path.join(local_base_path, item_path)
+                        
+                        if item.get("folder"):
+                            # 如果是文件夹，提交新的列目录任务
+                            pending_folders[list_executor.submit(self.list_items, item_path)] = item_path
+                        else:
+                            # 如果是文件，直接提交下载
+                            if os.path.exists(local_path):
+                                self._report(f"文件已存在，跳过: {item_path}")
+                                if os.path.getsize(local_path) == item.get("size"):
+                                    self.dedup.record(item, local_path)
+                                continue
+                            
+                            future_download = download_executor.submit(
+                                self.dedup.fetch, item, local_path, self._fetch_file
+                            )
+                            download_futures[future_download] = item_path
+            
+            # 等待所有下载任务完成
+            failed_files = []
+            for future in concurrent.futures.as_completed(download_futures):
+                item_path = download_futures[future]
+                try:
+                    if not future.result():
+                        failed_files.append(item_path)
+                except Exception as e:
+                    self._report(f"{item_path} 下载时发生错误: {str(e)}")
+                    failed_files.append(item_path)
+        
+        if self.shard_cache:
+            # 等待后台写入分片缓存完成
+            self.shard_cache.wait()
+        self._report(f"\n共提交 {len(download_futures)} 个文件，失败 {len(failed_files)} 个，"
+              f"无法列出的文件夹 {len(failed_folders)} 个")
+        for item_path in failed_files:
+            self._report(f"  下载失败: {item_path}")
+        
+        return not failed_files and not failed_folders
 
 def main():
     try:
@@ -3,14 +3,23 @@
 
 import os
 import json
-import requests
+import threading
 import time
+import requests
+import concurrent.futures
 import sys
+from urllib.parse import urlparse
 from msal import PublicClientApplication, SerializableTokenCache
+from token_broker import TokenCacheFile
 from config import (
     CLIENT_ID, AUTHORITY, SCOPE, 
-    DOWNLOAD_PATH, TOKEN_CACHE_FILE
+    DOWNLOAD_PATH, TOKEN_CACHE_FILE, GRAPH_API_BASE, SYNC_STATE_FILE, DEDUP_MODE, CONTENT_INDEX_FILE,
+    SHARD_CACHE, SHARD_CACHE_MAX_BYTES
 )
+from rate_limiter import get_global_limiter, parse_rate
+from sync_state import SyncState
+from content_index import ContentIndex, ContentDeduplicator
+from shard_cache import open_shard_cache
 
 class OneDriveSharedDownloader:
     def __init__(self):
@@ -35,10 +44,39 @@ class OneDriveSharedDownloader:
         # 获取访问令牌
         self.access_token = self._get_access_token()
         
+        # 并行设置
+        self.max_workers = 5  # 最大并行下载数量
+        self.max_list_workers = 4  # 最大并行列目录数量
+        
+        # Graph API遇到限流(429/503)或网络错误时的最大重试次数
+        self.max_api_retries = 3
+        
+        # 多个线程同时下载，进度按整行输出，互相不会覆盖
+        self._print_lock = threading.Lock()
+        
+        # 带宽限制，同一进程中的所有下载器共用
+        self.limiter = get_global_limiter()
+        
+        # 复用HTTP连接，连接池大小与并行数量匹配
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=self.max_workers + self.max_list_workers
+        )
+        self.session.mount("https://", adapter)
+        
+        # 按内容去重，内容相同的文件用硬链接/reflink代替下载
+        self.dedup = ContentDeduplicator(ContentIndex(CONTENT_INDEX_FILE), DEDUP_MODE)
+        
+        # 多个节点共享的分片缓存，下载前先查缓存，下载完成后写入缓存
+        self.shard_cache = open_shard_cache(SHARD_CACHE, int(parse_rate(SHARD_CACHE_MAX_BYTES) or 0) or None)
+        self._fetch_file = self.shard_cache.wrap(self.download_file) if self.shard_cache else self.download_file
+        
     def _save_token_cache(self):
-        """保存令牌缓存到文件"""
-        with open(TOKEN_CACHE_FILE, "w") as f:
-            f.write(self.token_cache.serialize())
+        """保存令牌缓存到文件 (加锁并原子替换，和同时运行的其他下载进程不冲突)"""
+        cache_file = TokenCacheFile(TOKEN_CACHE_FILE)
+        with cache_file.locked():
+            cache_file.save(self.token_cache)
     
     def _get_access_token(self):
         """获取访问令牌，如果需要则进行交互式登录"""
@@ -69,25 +107,53 @@ class OneDriveSharedDownloader:
         return result["access_token"]
     
     def _make_api_request(self, endpoint, params=None):
-        """向Microsoft Graph API发送请求"""
+        """向Microsoft Graph API发送请求
+        
+        遇到限流(429/503)时按Retry-After等待后重试，网络错误时等待后重试，最多重试max_api_retries次。
+        """
         headers = {
             "Authorization": f"Bearer {self.access_token}",
             "Accept": "application/json"
         }
         
-        response = requests.get(
-            f"https://graph.microsoft.com/v1.0{endpoint}",
-            headers=headers,
-            params=params
-        )
-        
-        if response.status_code == 200:
-            return response.json()
+        # 分页链接(@odata.nextLink)是完整URL，直接使用
+        if endpoint.startswith(("https://", "http://")):
+            url = endpoint
         else:
+            url = f"{GRAPH_API_BASE}{endpoint}"
+        
+        for attempt in range(self.max_api_retries + 1):
+            try:
+                response = self.session.get(
+                    url,
+                    headers=headers,
+                    params=params,
+                    timeout=60
+                )
+            except requests.exceptions.RequestException as e:
+                if attempt < self.max_api_retries:
+                    time.sleep(2 ** attempt)
+                    continue
+                print(f"API请求失败: {str(e)}")
+                return None
+            
+            if response.status_code == 200:
+                return response.json()
+            
+            if response.status_code in (429, 503) and attempt < self.max_api_retries:
+                retry_after = response.headers.get("Retry-After", "")
+                time.sleep(float(retry_after) if retry_after.isdigit() else 2 ** attempt)
+                continue
+            
             print(f"API请求失败: {response.status_code}")
             print(response.text)
             return None
     
+    def _report(self, message):
+        """输出一整行 (多个下载线程的输出不会交错)"""
+        with self._print_lock:
+            print(message)
+    
     def list_shared_items(self):
         """列出所有共享项目"""
         endpoint = "/me/drive/sharedWithMe"
@@ -101,7 +167,24 @@ class OneDriveSharedDownloader:
         else:
             # 否则使用默认驱动器
             endpoint = f"/me/drive/items/{item_id}/children"
-        return self._make_api_request(endpoint)
+        return self._list_all_pages(endpoint)
+    
+    def _list_all_pages(self, endpoint):
+        """获取列表接口的全部分页结果，合并到同一个value列表中"""
+        result = self._make_api_request(endpoint)
+        if not result or "value" not in result:
+            return result
+        
+        items = result["value"]
+        next_link = result.get("@odata.nextLink")
+        while next_link:
+            page = self._make_api_request(next_link)
+            if not page or "value" not in page:
+                return None
+            items.extend(page["value"])
+            next_link = page.get("@odata.nextLink")
+        
+        return {"value": items}
     
     def get_item_info(self, item_id, drive_id=None):
         """获取项目信息"""
@@ -136,27 +219,40 @@ class OneDriveSharedDownloader:
         os.makedirs(os.path.dirname(local_path), exist_ok=True)
         
         # 下载文件
+        # 先写入 .part 文件再原子替换: 目标文件可能是去重时建立的硬链接，
+        # 直接以 "wb" 打开会把其它副本一起截断改写
+        part_path = local_path + ".part"
         try:
-            response = requests.get(download_url, stream=True)
+            response = self.session.get(download_url, stream=True)
             response.raise_for_status()
             
             file_size = int(response.headers.get("Content-Length", 0))
-            print(f"正在下载: {item['name']} ({self._format_size(file_size)})")
+            self._report(f"正在下载: {item['name']} ({self._format_size(file_size)})")
             
-            with open(local_path, "wb") as f:
+            download_host = urlparse(download_url).hostname or ""
+            with open(part_path, "wb") as f:
                 downloaded = 0
+                next_report = 25
                 for chunk in response.iter_content(chunk_size=8192):
                     if chunk:
                         f.write(chunk)
                         downloaded += len(chunk)
-                        # 显示下载进度
+                        self.limiter.throttle(download_host, len(chunk))
+                        # 每完成25%输出一行进度
                         progress = (downloaded / file_size) * 100 if file_size > 0 else 0
-                        print(f"\r进度: {progress:.1f}%", end="")
+                        if progress >= next_report and progress < 100:
+                            self._report(f"{item['name']}: 进度 {progress:.0f}%")
+                            next_report = (int(progress) // 25 + 1) * 25
+            os.replace(part_path, local_path)
             
-            print("\n下载完成")
+            self._report(f"{item['name']} 下载完成")
             return True
         except Exception as e:
-            print(f"\n下载失败: {str(e)}")
+            self._report(f"{item['name']} 下载失败: {str(e)}")
+            try:
+                os.remove(part_path)
+            except OSError:
+                pass
             return False
     
     def _format_size(self, size_bytes):
@@ -171,7 +267,11 @@ class OneDriveSharedDownloader:
         return f"{size_bytes:.2f} PB"
     
     def download_folder(self, item_id, drive_id=None, folder_path="", local_base_path=None):
-        """递归下载文件夹中的所有内容"""
+        """并行遍历文件夹树并下载所有内容
+        
+        只有根项目需要调用get_item_info，子文件夹的名称直接取自父目录的列表结果。
+        列目录任务在一个线程池中并行执行，发现的文件直接提交到下载线程池。
+        """
         if local_base_path is None:
             local_base_path = DOWNLOAD_PATH
         
@@ -179,7 +279,7 @@ class OneDriveSharedDownloader:
         item_info = self.get_item_info(item_id, drive_id)
         if not item_info:
             print(f"无法获取项目信息: {item_id}")
-            return
+            return False
         
         item_name = item_info.get("name", "未命名项目")
         if drive_id:
@@ -187,34 +287,185 @@ class OneDriveSharedDownloader:
         else:
             print(f"正在处理共享项目: {item_name} (项目ID: {item_id})")
         
-        # 创建本地文件夹
-        local_folder = os.path.join(local_base_path, folder_path, item_name)
-        os.makedirs(local_folder, exist_ok=True)
+        root_folder = os.path.join(local_base_path, folder_path, item_name)
+        _, failed_files, failed_folders = self._walk_and_download(item_id, drive_id, root_folder)
+        return not failed_files and not failed_folders
+    
+    def sync_folder(self, item_id, drive_id=None, delete_removed=False, local_base_path=None):
+        """增量同步文件夹: 只传输新增或变化的文件，可选删除远程已移除的文件
         
-        # 获取子项目
-        items = self.list_items(item_id, drive_id)
+        同步状态保存在SYNC_STATE_FILE中。如果驱动器支持该文件夹的delta查询且自上次同步后
+        没有任何变化，只需一次请求即可结束同步。
+        """
+        if local_base_path is None:
+            local_base_path = DOWNLOAD_PATH
         
-        if not items or "value" not in items:
-            print(f"无法获取项目内容: {item_id}")
-            return
+        item_info = self.get_item_info(item_id, drive_id)
+        if not item_info:
+            print(f"无法获取项目信息: {item_id}")
+            return False
+        
+        item_name = item_info.get("name", "未命名项目")
+        root_folder = os.path.join(local_base_path, item_name)
+        root_key = f"{drive_id or 'me'}:{item_id}"
+        state = SyncState(SYNC_STATE_FILE)
         
-        for item in items["value"]:
-            item_name = item["name"]
-            item_path = os.path.join(local_folder, item_name)
+        try:
+            # 快速路径: delta显示没有变化时直接结束
+            delta_link = state.get_delta_link(root_key)
+            if delta_link and state.items_under(root_key):
+                changes, new_delta_link = self._fetch_delta(delta_link)
+                if changes is not None:
+                    changes = [c for c in changes if c.get("id") != item_id]
+                    if not changes:
+                        state.set_delta_link(root_key, new_delta_link)
+                        print(f"{item_name} 自上次同步以来没有变化")
+                        return True
+                    print(f"{item_name} 有 {len(changes)} 个项目发生变化，开始比对")
             
-            if item.get("folder"):
-                # 如果是文件夹，递归下载
-                child_drive_id = item.get("parentReference", {}).get("driveId", drive_id)
-                self.download_folder(item["id"], child_drive_id, os.path.join(folder_path, item_info["name"]), local_base_path)
-            else:
-                # 如果是文件，直接下载
-                if os.path.exists(item_path):
-                    print(f"文件已存在，跳过: {item_name}")
-                    continue
+            # 在遍历之前获取最新的delta链接，遍历期间发生的变化会在下次同步时被发现
+            new_delta_link = self._get_latest_delta_link(item_id, drive_id)
+            
+            seen_ids, failed_files, failed_folders = self._walk_and_download(
+                item_id, drive_id, root_folder, sync_state=state, root_key=root_key
+            )
+            
+            # 只有完整遍历成功时，才能判断哪些项目已在远程被删除
+            if not failed_folders:
+                removed = [r for r in state.items_under(root_key) if r["item_id"] not in seen_ids]
+                for record in removed:
+                    if delete_removed:
+                        try:
+                            if os.path.exists(record["local_path"]):
+                                os.remove(record["local_path"])
+                            state.remove(record["item_id"])
+                            print(f"已删除远程不存在的文件: {record['local_path']}")
+                        except Exception as e:
+                            print(f"删除文件失败: {record['local_path']}, 错误: {str(e)}")
+                    else:
+                        print(f"远程已删除 (本地保留): {record['local_path']}")
+            
+            if new_delta_link and not failed_files and not failed_folders:
+                state.set_delta_link(root_key, new_delta_link)
+            
+            return not failed_files and not failed_folders
+        finally:
+            state.close()
+    
+    def _get_latest_delta_link(self, item_id, drive_id=None):
+        """获取指向当前时刻的delta链接，不支持delta时返回None"""
+        if drive_id:
+            endpoint = f"/drives/{drive_id}/items/{item_id}/delta"
+        else:
+            endpoint = f"/me/drive/items/{item_id}/delta"
+        result = self._make_api_request(endpoint, params={"token": "latest"})
+        if not result:
+            return None
+        return result.get("@odata.deltaLink")
+    
+    def _fetch_delta(self, delta_link):
+        """从delta链接获取全部变化，返回(变化列表, 新的delta链接)；失败时返回(None, None)"""
+        changes = []
+        endpoint = delta_link
+        while endpoint:
+            page = self._make_api_request(endpoint)
+            if not page or "value" not in page:
+                return None, None
+            changes.extend(page["value"])
+            if "@odata.deltaLink" in page:
+                return changes, page["@odata.deltaLink"]
+            endpoint = page.get("@odata.nextLink")
+        return None, None
+    
+    def _walk_and_download(self, item_id, drive_id, root_folder, sync_state=None, root_key=None):
+        """并行遍历文件夹树并下载文件
+        
+        未提供sync_state时按本地文件是否存在跳过；提供时按同步状态判断是否需要传输，
+        并在下载成功后更新状态。返回(遍历到的文件ID集合, 下载失败的文件, 无法列出的文件夹)。
+        """
+        seen_ids = set()
+        download_futures = {}
+        failed_folders = []
+        
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_list_workers) as list_executor, \
+             concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as download_executor:
+            # 待完成的列目录任务: future -> (项目ID, 驱动器ID, 本地文件夹)
+            pending_folders = {
+                list_executor.submit(self.list_items, item_id, drive_id): (item_id, drive_id, root_folder)
+            }
+            
+            while pending_folders:
+                done, _ = concurrent.futures.wait(
+                    pending_folders, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    folder_id, folder_drive_id, local_folder = pending_folders.pop(future)
+                    try:
+                        items = future.result()
+                    except Exception as e:
+                        self._report(f"获取项目内容时发生错误: {folder_id}, 错误: {str(e)}")
+                        items = None
+                    
+                    if not items or "value" not in items:
+                        self._report(f"无法获取项目内容: {folder_id}")
+                        failed_folders.append(local_folder)
+                        continue
+                    
+                    # 创建本地文件夹
+                    os.makedirs(local_folder, exist_ok=True)
+                    self._report(f"正在处理文件夹: {local_folder} ({len(items['value'])} 个项目)")
+                    
+                    for item in items["value"]:
+                        child_name = item["name"]
+                        item_path = os.path.join(local_folder, child_name)
+                        
+                        if item.get("folder"):
+                            # 如果是文件夹，提交新的列目录任务
+                            child_drive_id = item.get("parentReference", {}).get("driveId", folder_drive_id)
+                            child_future = list_executor.submit(self.list_items, item["id"], child_drive_id)
+                            pending_folders[child_future] = (item["id"], child_drive_id, item_path)
+                            continue
+                        
+                        seen_ids.add(item["id"])
+                        if sync_state is not None:
+                            if not sync_state.needs_download(item, item_path, root_key):
+                                continue
+                        elif os.path.exists(item_path):
+                            self._report(f"文件已存在，跳过: {child_name}")
+                            if os.path.getsize(item_path) == item.get("size"):
+                                self.dedup.record(item, item_path)
+                            continue
+                        
+                        # 如果是文件，直接提交下载 (内容与本地已有文件相同时改为链接)
+                        future_download = download_executor.submit(
+                            self.dedup.fetch, item, item_path, self._fetch_file
+                        )
+                        download_futures[future_download] = (item, item_path)
+            
+            # 等待所有下载任务完成
+            failed_files = []
+            for future in concurrent.futures.as_completed(download_futures):
+                item, item_path = download_futures[future]
+                try:
+                    success = future.result()
+                except Exception as e:
+                    self._report(f"{item_path} 下载时发生错误: {str(e)}")
+                    success = False
                 
-                self.download_file(item, item_path)
-                # 添加短暂延迟以避免API限制
-                time.sleep(0.5)
+                if not success:
+                    failed_files.append(item_path)
+                elif sync_state is not None:
+                    sync_state.mark_synced(item, item_path, root_key)
+        
+        if self.shard_cache:
+            # 等待后台写入分片缓存完成
+            self.shard_cache.wait()
+        self._report(f"\n共提交 {len(download_futures)} 个文件，失败 {len(failed_files)} 个，"
+              f"无法列出的文件夹 {len(failed_folders)} 个")
+        for item_path in failed_files:
+            self._report(f"  下载失败: {item_path}")
+        
+        return seen_ids, failed_files, failed_folders
     
     def find_shared_item_by_id(self, item_id):
         """根据ID查找共享项目"""
@@ -244,7 +495,11 @@ def main():
             return
         
         # 开始下载
-        downloader.download_folder(item_id, drive_id)
+        if len(sys.argv) > 1 and sys.argv[1] == "sync":
+            # 增量同步模式: python onedrive_downloader_shared.py sync [--delete]
+            downloader.sync_folder(item_id, drive_id, delete_removed="--delete" in sys.argv)
+        else:
+            downloader.download_folder(item_id, drive_id)
         
         print("所有文件下载完成！")
     except Exception as e:
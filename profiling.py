@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import collections
+import contextlib
+import io
+import json
+import os
+import sys
+import threading
+import time
+
+class Profiler:
+    """按阶段记录耗时的性能分析器
+
+    每个阶段记录墙钟时间和当前线程的CPU时间(thread_time)，可以带上文件名等参数。
+    未启用时phase()返回空的上下文管理器，几乎没有开销。
+    结果可以输出为Chrome/Perfetto可以打开的trace文件，以及按阶段汇总的表格。
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._events = []  # Chrome trace的"X"事件
+        self._totals = collections.defaultdict(lambda: [0, 0.0, 0.0, 0.0])  # 阶段 -> [次数, 墙钟, CPU, 最大墙钟]
+        self._file_totals = collections.defaultdict(lambda: collections.defaultdict(float))  # 文件 -> 阶段 -> 墙钟
+        self._thread_names = {}
+        self._origin = time.perf_counter()
+        self._started_at = None
+        self._stopped_at = None
+
+    def start(self):
+        self.enabled = True
+        self._origin = time.perf_counter()
+        self._started_at = self._origin
+        self._stopped_at = None
+
+    def stop(self):
+        self.enabled = False
+        self._stopped_at = time.perf_counter()
+
+    def phase(self, name, file=None, **args):
+        """记录一个阶段的上下文管理器，file为所属的文件名"""
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return _Phase(self, name, file, args, True)
+
+    def span(self, name, file=None, **args):
+        """只写入trace、不计入汇总的外层区间 (例如整个下载过程)，避免汇总中重复计算内部阶段"""
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return _Phase(self, name, file, args, False)
+
+    def add(self, name, wall, cpu=0.0, file=None, count=1):
+        """直接累加一段不连续的耗时 (例如一个分段中所有写磁盘的时间)，只计入汇总，不写入trace"""
+        if not self.enabled:
+            return
+        with self._lock:
+            totals = self._totals[name]
+            totals[0] += count
+            totals[1] += wall
+            totals[2] += cpu
+            totals[3] = max(totals[3], wall)
+            if file is not None:
+                self._file_totals[file][name] += wall
+
+    def trace(self, name, start, wall, cpu=0.0, file=None, **args):
+        """只写入trace、不计入汇总的事件，用于包含多个阶段的外层区间 (例如一个下载分段)"""
+        if self.enabled:
+            self._record(name, file, args, start, wall, cpu, summarize=False)
+
+    def _record(self, name, file, args, start, wall, cpu, summarize=True):
+        thread = threading.current_thread()
+        event = {
+            "name": name,
+            "cat": "phase",
+            "ph": "X",
+            "ts": (start - self._origin) * 1e6,
+            "dur": wall * 1e6,
+            "pid": os.getpid(),
+            "tid": thread.ident,
+            "args": dict(args, cpu_ms=round(cpu * 1000, 3)),
+        }
+        if file is not None:
+            event["args"]["file"] = file
+        with self._lock:
+            self._thread_names[thread.ident] = thread.name
+            self._events.append(event)
+        if summarize:
+            self.add(name, wall, cpu, file)
+
+    def write_chrome_trace(self, path):
+        """写入Chrome Trace Event格式的JSON，可以用chrome://tracing或ui.perfetto.dev打开"""
+        with self._lock:
+            events = list(self._events)
+            thread_names = dict(self._thread_names)
+        for tid, name in thread_names.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}})
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+
+    def summary(self, top_files=10):
+        """按阶段汇总的表格文本，以及总耗时最长的几个文件的阶段分布"""
+        end = self._stopped_at or time.perf_counter()
+        run_seconds = end - (self._started_at or self._origin)
+        with self._lock:
+            totals = {name: list(values) for name, values in self._totals.items()}
+            file_totals = {name: dict(phases) for name, phases in self._file_totals.items()}
+
+        lines = []
+        lines.append("=" * 86)
+        lines.append(f"阶段耗时汇总 (运行时间 {run_seconds:.2f} 秒；并行阶段的累计时间可能超过运行时间)")
+        lines.append("=" * 86)
+        lines.append(f"{'阶段':<20}{'次数':>8}{'墙钟(秒)':>12}{'CPU(秒)':>12}{'平均(毫秒)':>12}{'最大(毫秒)':>12}{'占比':>8}")
+        lines.append("-" * 86)
+        total_wall = sum(values[1] for values in totals.values()) or 1.0
+        for name, (count, wall, cpu, longest) in sorted(totals.items(), key=lambda kv: -kv[1][1]):
+            average = wall / count * 1000 if count else 0.0
+            lines.append(f"{name:<20}{count:>8}{wall:>12.3f}{cpu:>12.3f}{average:>12.1f}"
+                         f"{longest * 1000:>12.1f}{wall / total_wall * 100:>7.1f}%")
+
+        if file_totals and top_files:
+            lines.append("-" * 86)
+            lines.append(f"耗时最长的 {min(top_files, len(file_totals))} 个文件:")
+            slowest = sorted(file_totals.items(), key=lambda kv: -sum(kv[1].values()))[:top_files]
+            for name, phases in slowest:
+                breakdown = ", ".join(f"{phase} {seconds:.2f}s"
+                                      for phase, seconds in sorted(phases.items(), key=lambda kv: -kv[1]))
+                lines.append(f"  {name}: {sum(phases.values()):.2f}s ({breakdown})")
+        lines.append("=" * 86)
+        return "\n".join(lines)
+
+class _Phase:
+    __slots__ = ("profiler", "name", "file", "args", "summarize", "start", "cpu_start")
+
+    def __init__(self, profiler, name, file, args, summarize):
+        self.profiler = profiler
+        self.name = name
+        self.file = file
+        self.args = args
+        self.summarize = summarize
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.cpu_start = time.thread_time()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.start
+        cpu = time.thread_time() - self.cpu_start
+        self.profiler._record(self.name, self.file, self.args, self.start, wall, cpu, self.summarize)
+        return False
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+# 进程内共享的分析器，下载器和调度器都通过它记录阶段
+PROFILER = Profiler()
+
+def phase(name, file=None, **args):
+    return PROFILER.phase(name, file, **args)
+
+def span(name, file=None, **args):
+    return PROFILER.span(name, file, **args)
+
+class ThreadedCProfile:
+    """对所有线程运行cProfile (cProfile本身只分析启用它的线程)
+
+    通过threading.setprofile让之后新建的线程各自启用一个cProfile，结束后合并统计结果。
+    Python 3.12起cProfile基于sys.monitoring，同一时间只能启用一个，不能这样使用 (见profile_run)。
+    """
+
+    def __init__(self):
+        # cProfile和pstats只在--profile=cprofile时导入，不影响命令的启动时间
+        import cProfile
+        self._profile_class = cProfile.Profile
+        self._profiles = []
+        self._lock = threading.Lock()
+        self._main = cProfile.Profile()
+
+    def _thread_hook(self, frame, event, arg):
+        sys.setprofile(None)
+        profile = self._profile_class()
+        try:
+            profile.enable()
+        except ValueError:
+            # 已经有其他分析工具在运行，这个线程不分析
+            return
+        with self._lock:
+            self._profiles.append(profile)
+
+    def start(self):
+        threading.setprofile(self._thread_hook)
+        self._main.enable()
+
+    def stop(self):
+        self._main.disable()
+        threading.setprofile(None)
+
+    def stats(self):
+        import pstats
+        stats = pstats.Stats(self._main)
+        with self._lock:
+            profiles = list(self._profiles)
+        for profile in profiles:
+            try:
+                stats.add(profile)
+            except TypeError:
+                # 线程尚未产生任何统计
+                pass
+        return stats
+
+    def write(self, path, top=40):
+        """写入.prof文件(可用snakeviz等工具查看)，并返回按累计时间排序的前top项文本"""
+        stats = self.stats()
+        stats.dump_stats(path)
+        output = io.StringIO()
+        stats.stream = output
+        stats.sort_stats("cumulative").print_stats(top)
+        return output.getvalue()
+
+class SamplingProfiler:
+    """定时采样所有线程调用栈的分析器，输出火焰图工具使用的折叠栈格式"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._stacks = collections.Counter()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)).rstrip("0123456789-"))
+                self._stacks[";".join(reversed(stack))] += 1
+
+    def write(self, path):
+        """写入折叠栈文件，可以用flamegraph.pl或speedscope打开"""
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self._stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return sum(self._stacks.values())
+
+@contextlib.contextmanager
+def profile_run(mode, output_dir):
+    """在--profile模式下运行一段代码
+
+    mode为"phases"(只记录阶段)、"cprofile"或"sample"，结果写入output_dir:
+    trace.json(Chrome/Perfetto)、summary.txt、以及cprofile.prof/cprofile.txt或samples.folded。
+    """
+    if mode not in ("phases", "cprofile", "sample"):
+        raise ValueError(f"未知的分析模式: {mode}，可选: phases / cprofile / sample")
+
+    if mode == "cprofile" and sys.version_info >= (3, 12):
+        print("Python 3.12及以上同一时间只能启用一个cProfile，无法分析所有下载线程，改用采样分析 (--profile=sample)")
+        mode = "sample"
+
+    os.makedirs(output_dir, exist_ok=True)
+    extra = ThreadedCProfile() if mode == "cprofile" else SamplingProfiler() if mode == "sample" else None
+
+    PROFILER.start()
+    if extra:
+        try:
+            extra.start()
+        except ValueError as e:
+            # 已经有其他分析工具 (例如coverage或调试器) 在运行
+            extra.stop()
+            print(f"无法启动cProfile ({e})，改用采样分析")
+            extra = SamplingProfiler()
+            extra.start()
+    try:
+        yield PROFILER
+    finally:
+        if extra:
+            extra.stop()
+        PROFILER.stop()
+
+        trace_path = os.path.join(output_dir, "trace.json")
+        PROFILER.write_chrome_trace(trace_path)
+        summary = PROFILER.summary()
+        with open(os.path.join(output_dir, "summary.txt"), "w", encoding="utf-8") as f:
+            f.write(summary + "\n")
+        print("\n" + summary)
+        print(f"trace文件: {trace_path} (用 chrome://tracing 或 https://ui.perfetto.dev 打开)")
+
+        if isinstance(extra, ThreadedCProfile):
+            prof_path = os.path.join(output_dir, "cprofile.prof")
+            text = extra.write(prof_path)
+            with open(os.path.join(output_dir, "cprofile.txt"), "w", encoding="utf-8") as f:
+                f.write(text)
+            print(f"cProfile结果: {prof_path}")
+        elif isinstance(extra, SamplingProfiler):
+            folded_path = os.path.join(output_dir, "samples.folded")
+            samples = extra.write(folded_path)
+            print(f"采样结果: {folded_path} ({samples} 个样本，可用speedscope或flamegraph.pl查看)")
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import fnmatch
+import threading
+import time
+from urllib.parse import urlparse
+
+from config import DOWNLOAD_RATE_LIMIT, DOWNLOAD_RATE_SCHEDULE, HOST_RATE_LIMITS
+
+_UNITS = {"": 1, "B": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+def parse_rate(text):
+    """解析带宽字符串，例如 "500K"、"50M"、"1.5G" 或纯字节数，返回字节/秒
+
+    空字符串、"0"或"none"表示不限速，返回None。
+    """
+    if text is None:
+        return None
+    text = str(text).strip().upper()
+    if text.endswith("/S"):
+        text = text[:-2]
+    if text.endswith("B") and len(text) > 1 and text[-2] in _UNITS:
+        text = text[:-1]
+    if not text or text in ("0", "NONE", "UNLIMITED"):
+        return None
+
+    unit = text[-1] if text[-1] in _UNITS else ""
+    number = text[:-1] if unit else text
+    rate = float(number) * _UNITS[unit]
+    return rate if rate > 0 else None
+
+def parse_schedule(text):
+    """解析分时段限速，例如 "09:00-18:00=20M,18:00-09:00=0"
+
+    返回[(开始分钟, 结束分钟, 字节/秒或None), ...]，时段可以跨越午夜。
+    """
+    schedule = []
+    if not text:
+        return schedule
+    for part in text.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        window, rate = part.split("=", 1)
+        start, end = window.split("-", 1)
+        schedule.append((_parse_minutes(start), _parse_minutes(end), parse_rate(rate)))
+    return schedule
+
+def _parse_minutes(hhmm):
+    hours, minutes = hhmm.strip().split(":")
+    return int(hours) * 60 + int(minutes)
+
+def parse_host_rates(text):
+    """解析按主机限速，例如 "*.sharepoint.com=40M,example.com=5M"，返回{主机模式: 字节/秒}"""
+    host_rates = {}
+    if not text:
+        return host_rates
+    for part in text.split(","):
+        part = part.strip()
+        if part:
+            pattern, rate = part.split("=", 1)
+            host_rates[pattern.strip().lower()] = parse_rate(rate)
+    return host_rates
+
+class TokenBucket:
+    """令牌桶限速器
+
+    使用虚拟时钟实现: 每次取令牌都在时间轴上预约一段传输时间，按取令牌的先后顺序排队。
+    所有下载线程每读取一块数据就取一次令牌，因此各个活跃下载轮流获得带宽，
+    小文件不会被大文件长期占满带宽。
+    """
+
+    def __init__(self, rate=None, burst_seconds=0.5):
+        self._lock = threading.Lock()
+        self._rate = rate
+        self._burst_seconds = burst_seconds
+        self._next_free = time.monotonic()
+
+    @property
+    def rate(self):
+        return self._rate
+
+    def set_rate(self, rate):
+        """修改限速(字节/秒)，None表示不限速，立即对后续请求生效"""
+        with self._lock:
+            self._rate = rate
+            self._next_free = min(self._next_free, time.monotonic())
+
+    def reserve(self, nbytes):
+        """预约nbytes字节的传输时间，返回需要等待的秒数"""
+        with self._lock:
+            rate = self._rate
+            if not rate:
+                return 0.0
+            now = time.monotonic()
+            self._next_free = max(self._next_free, now) + nbytes / rate
+            # 允许最多burst_seconds的突发，超出部分需要等待
+            return max(0.0, self._next_free - now - self._burst_seconds)
+
+class BandwidthLimiter:
+    """下载带宽限制: 全局限速、按主机限速以及按时间段自动切换的限速
+
+    下载线程每收到一块数据调用一次throttle，限速配置可以在运行期间随时修改。
+    """
+
+    def __init__(self, rate=None, host_rates=None, schedule=None):
+        self._global = TokenBucket(rate)
+        self._base_rate = rate
+        self._schedule = schedule or []
+        self._host_rates = dict(host_rates or {})
+        self._host_buckets = {}
+        self._lock = threading.Lock()
+        self._schedule_checked_minute = None
+
+    def set_rate(self, rate):
+        """修改全局限速(字节/秒)，None表示不限速"""
+        with self._lock:
+            self._base_rate = rate
+            self._schedule_checked_minute = None
+        self._global.set_rate(rate)
+
+    def set_schedule(self, schedule):
+        """修改分时段限速，格式见parse_schedule"""
+        with self._lock:
+            self._schedule = schedule or []
+            self._schedule_checked_minute = None
+
+    def set_host_rate(self, pattern, rate):
+        """修改某个主机(支持通配符)的限速"""
+        pattern = pattern.lower()
+        with self._lock:
+            self._host_rates[pattern] = rate
+            for host, bucket in self._host_buckets.items():
+                if bucket is not None and bucket[0] == pattern:
+                    bucket[1].set_rate(rate)
+            # 之前没有匹配规则的主机需要重新匹配
+            self._host_buckets = {h: b for h, b in self._host_buckets.items() if b is not None}
+
+    def current_rate(self):
+        """当前生效的全局限速(字节/秒)"""
+        self._apply_schedule()
+        return self._global.rate
+
+    def _apply_schedule(self):
+        """按当前时间选择生效的限速，每分钟最多检查一次"""
+        if not self._schedule:
+            return
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        with self._lock:
+            if minute == self._schedule_checked_minute:
+                return
+            self._schedule_checked_minute = minute
+            rate = self._base_rate
+            for start, end, window_rate in self._schedule:
+                in_window = start <= minute < end if start <= end else (minute >= start or minute < end)
+                if in_window:
+                    rate = window_rate
+                    break
+        if rate != self._global.rate:
+            self._global.set_rate(rate)
+
+    def _host_bucket(self, host):
+        with self._lock:
+            if host not in self._host_buckets:
+                entry = None
+                for pattern, rate in self._host_rates.items():
+                    if fnmatch.fnmatch(host, pattern):
+                        entry = (pattern, self._shared_pattern_bucket(pattern, rate))
+                        break
+                self._host_buckets[host] = entry
+            entry = self._host_buckets[host]
+        return entry[1] if entry else None
+
+    def _shared_pattern_bucket(self, pattern, rate):
+        """同一个主机模式匹配到的所有主机共用一个令牌桶"""
+        for entry in self._host_buckets.values():
+            if entry is not None and entry[0] == pattern:
+                return entry[1]
+        return TokenBucket(rate)
+
+    def throttle(self, url_or_host, nbytes):
+        """收到nbytes字节后调用，必要时休眠以满足全局和主机限速"""
+        self._apply_schedule()
+        delay = self._global.reserve(nbytes)
+
+        host = urlparse(url_or_host).hostname if "://" in url_or_host else url_or_host
+        if host:
+            bucket = self._host_bucket(host.lower())
+            if bucket is not None:
+                delay = max(delay, bucket.reserve(nbytes))
+
+        if delay > 0:
+            time.sleep(delay)
+
+_global_limiter = None
+_global_limiter_lock = threading.Lock()
+
+def get_global_limiter():
+    """返回进程内共享的带宽限制器，所有下载器共用，使限速对整个进程生效"""
+    global _global_limiter
+    with _global_limiter_lock:
+        if _global_limiter is None:
+            _global_limiter = BandwidthLimiter(
+                rate=parse_rate(DOWNLOAD_RATE_LIMIT),
+                host_rates=parse_host_rates(HOST_RATE_LIMITS),
+                schedule=parse_schedule(DOWNLOAD_RATE_SCHEDULE)
+            )
+        return _global_limiter
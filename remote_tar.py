@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import fnmatch
+import io
+import os
+import tarfile
+from urllib.parse import urlparse
+
+# 扫描远程tar头部时每次Range请求读取的大小: 足够容纳pax/长文件名头部，小成员的相邻头部通常也在同一块中
+HEADER_BLOCK_SIZE = 16 * 1024
+# 相邻的两个所需成员之间间隔小于该值时合并成一个Range请求 (多读一点比多一次往返更快)
+COALESCE_GAP = 1024 * 1024
+# 单个Range请求最多覆盖的字节数
+MAX_RANGE_BYTES = 64 * 1024 * 1024
+# 下载链接过期时服务器返回的状态码，重新获取链接后重试
+_EXPIRED_STATUS = (401, 403, 404, 410)
+
+def remote_source(drive_id, item_id):
+    """远程分片在成员索引 (tar_index.TarIndex) 中的名称"""
+    return f"onedrive:{drive_id}/{item_id}"
+
+class RemoteFile(io.RawIOBase):
+    """通过HTTP Range请求读取远程文件的只读文件对象，供tarfile扫描头部
+
+    每次从读取位置开始请求block_size字节并缓存最近的几块，tarfile跳过成员内容时不会下载这些数据。
+    """
+
+    def __init__(self, session, url_provider, size, block_size=HEADER_BLOCK_SIZE, limiter=None, cached_blocks=4):
+        self.session = session
+        self.url_provider = url_provider  # 返回下载链接，refresh=True时重新获取
+        self.size = size
+        self.block_size = block_size
+        self.limiter = limiter
+        self.cached_blocks = cached_blocks
+        self.requests = 0
+        self.bytes_read = 0  # 扫描头部读取的字节数
+        self._pos = 0
+        self._blocks = {}
+        self._url = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self._pos = max(0, offset)
+        return self._pos
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self._pos
+        end = min(self.size, self._pos + size)
+        out = bytearray()
+        while self._pos < end:
+            block_start, block = self._block(self._pos)
+            offset = self._pos - block_start
+            take = min(len(block) - offset, end - self._pos)
+            if take <= 0:
+                break
+            out += block[offset:offset + take]
+            self._pos += take
+        return bytes(out)
+
+    def _block(self, pos):
+        """返回包含pos的缓存块 (start, data)，没有时从pos开始读取一块"""
+        for start, data in self._blocks.items():
+            if start <= pos < start + len(data):
+                return start, data
+        if len(self._blocks) >= self.cached_blocks:
+            self._blocks.pop(next(iter(self._blocks)))
+        data = self.read_range(pos, min(self.size, pos + self.block_size))
+        self._blocks[pos] = data
+        return pos, data
+
+    def open_range(self, start, end):
+        """发出 [start, end) 的Range请求，返回流式响应，下载链接过期时重新获取一次"""
+        for attempt in range(2):
+            if self._url is None or attempt:
+                self._url = self.url_provider(refresh=attempt > 0)
+                if not self._url:
+                    raise Exception("无法获取下载链接")
+            self.requests += 1
+            response = self.session.get(self._url, headers={"Range": f"bytes={start}-{end - 1}"},
+                                        stream=True, timeout=(30, 300))
+            if response.status_code in _EXPIRED_STATUS and attempt == 0:
+                response.close()
+                continue
+            response.raise_for_status()
+            if response.status_code != 206 and start > 0:
+                response.close()
+                raise Exception("服务器不支持Range请求，无法只下载部分成员")
+            return response
+
+    def read_range(self, start, end):
+        response = self.open_range(start, end)
+        try:
+            data = response.content[:end - start]
+        finally:
+            response.close()
+        self.bytes_read += len(data)
+        if self.limiter is not None:
+            self.limiter.throttle(urlparse(self._url).hostname or "", len(data))
+        if len(data) != end - start:
+            raise EOFError(f"Range请求返回的数据不完整 ({len(data)} != {end - start})")
+        return data
+
+def scan_members(remote_file):
+    """通过Range请求读取远程tar的所有头部，返回TarInfo列表 (不下载成员内容)"""
+    with tarfile.open(fileobj=remote_file, mode="r:") as tar:
+        return tar.getmembers()
+
+def select_members(members, patterns=(), names=None):
+    """按通配符和名单选择成员，通配符和名单都可以匹配完整路径或文件名
+
+    members为[(name, offset, size), ...]，没有任何条件时返回全部成员。
+    """
+    if not patterns and not names:
+        return list(members)
+    names = set(names or ())
+    selected = []
+    for member in members:
+        name = member[0]
+        base = os.path.basename(name)
+        if name in names or base in names or any(
+                fnmatch.fnmatchcase(name, p) or fnmatch.fnmatchcase(base, p) for p in patterns):
+            selected.append(member)
+    return selected
+
+def read_manifest(path):
+    """读取成员名单: 每行一个成员名或文件名，忽略空行和 # 开头的行"""
+    with open(path, "r", encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+def plan_ranges(members, gap=COALESCE_GAP, max_bytes=MAX_RANGE_BYTES):
+    """把成员合并成尽量少的Range请求，返回 [(start, end, [成员, ...]), ...]"""
+    ranges = []
+    for member in sorted(members, key=lambda m: m[1]):
+        _, offset, size = member
+        if ranges:
+            start, end, group = ranges[-1]
+            if offset - end <= gap and offset + size - start <= max_bytes:
+                ranges[-1] = (start, max(end, offset + size), group + [member])
+                continue
+        ranges.append((offset, offset + size, [member]))
+    return ranges
+
+def _member_path(output_dir, name):
+    root = os.path.abspath(output_dir)
+    target = os.path.abspath(os.path.join(root, name))
+    if os.path.isabs(name) or not target.startswith(root + os.sep):
+        return None
+    return target
+
+def fetch_members(remote_file, members, output_dir, chunk_size=1024 * 1024):
+    """按合并后的Range请求下载成员，写入 output_dir/<成员名>，返回 (下载的成员数, 下载的字节数)
+
+    目标已存在且大小一致的成员会跳过，中断后重新运行只下载剩余的成员。
+    """
+    pending = []
+    for member in members:
+        name, _, size = member
+        target = _member_path(output_dir, name)
+        if target is None:
+            print(f"跳过不安全的路径: {name}")
+            continue
+        if os.path.exists(target) and os.path.getsize(target) == size:
+            continue
+        pending.append(member)
+
+    fetched = transferred = 0
+    for start, end, group in plan_ranges(pending):
+        response = remote_file.open_range(start, end)
+        host = urlparse(response.url).hostname or ""
+        try:
+            stream = response.iter_content(chunk_size=chunk_size)
+            buffer = b""
+            pos = start
+            for name, offset, size in group:
+                target = _member_path(output_dir, name)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                part_path = target + ".part"
+                with open(part_path, "wb") as f:
+                    remaining = size
+                    while remaining > 0 or pos < offset:
+                        if not buffer:
+                            buffer = next(stream, b"")
+                            if not buffer:
+                                raise EOFError(f"Range请求提前结束: {name}")
+                            transferred += len(buffer)
+                            if remote_file.limiter is not None:
+                                remote_file.limiter.throttle(host, len(buffer))
+                        if pos < offset:
+                            # 跳过两个成员之间的数据 (下一个头部和填充)
+                            skip = min(offset - pos, len(buffer))
+                        else:
+                            skip = min(remaining, len(buffer))
+                            f.write(buffer[:skip])
+                            remaining -= skip
+                        buffer = buffer[skip:]
+                        pos += skip
+                os.replace(part_path, target)
+                fetched += 1
+        finally:
+            response.close()
+    return fetched, transferred
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import glob
+import json
+import tarfile
+import concurrent.futures
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    # 没有安装pyarrow时只能输出tar (WebDataset) 分片
+    pyarrow = None
+
+from step1_unzip import load_processed_files, save_processed_file, parse_sources, READ_BUFFER_SIZE
+
+REPACK_RECORD = "repacked_record.txt"
+FORMATS = ("tar", "parquet")
+# Parquet分片中每个行组的大小
+PARQUET_ROW_GROUP_BYTES = 64 * 1024 * 1024
+
+def sample_key(name):
+    """WebDataset的样本键: 目录 + 文件名中第一个点之前的部分，同一个样本的 .flac 和 .json 键相同"""
+    directory, base = os.path.split(name)
+    return os.path.join(directory, base.split(".", 1)[0])
+
+class _TarShardWriter:
+    def __init__(self, path):
+        self.path = path
+        self._tar = tarfile.open(path, "w", format=tarfile.PAX_FORMAT)
+
+    def add(self, member, fileobj):
+        self._tar.addfile(member, fileobj)
+
+    def tell(self):
+        return self._tar.offset
+
+    def close(self):
+        self._tar.close()
+
+class _ParquetShardWriter:
+    """每个成员一行: __key__ (样本键)、name、data"""
+
+    def __init__(self, path):
+        self.path = path
+        self._writer = pyarrow.parquet.ParquetWriter(path, pyarrow.schema([
+            ("__key__", pyarrow.string()), ("name", pyarrow.string()), ("data", pyarrow.binary()),
+        ]))
+        self._rows = {"__key__": [], "name": [], "data": []}
+        self._buffered = 0
+        self._written = 0
+
+    def add(self, member, fileobj):
+        data = fileobj.read()
+        self._rows["__key__"].append(sample_key(member.name))
+        self._rows["name"].append(member.name)
+        self._rows["data"].append(data)
+        self._buffered += len(data)
+        if self._buffered >= PARQUET_ROW_GROUP_BYTES:
+            self._flush()
+
+    def _flush(self):
+        if self._rows["name"]:
+            self._writer.write_table(pyarrow.table(self._rows))
+        self._rows = {"__key__": [], "name": [], "data": []}
+        self._written += self._buffered
+        self._buffered = 0
+
+    def tell(self):
+        return self._written + self._buffered
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+
+def repack_task(sources, output_dir, prefix, fmt="tar", shard_bytes=1024 ** 3):
+    """把一组源tar文件的成员按顺序流式写入大小约为shard_bytes的输出分片
+
+    只在样本键变化时切换分片，同一个样本的文件总在同一个分片里。分片先写成 .part，写完后改名；
+    任务失败时删除本任务的 .part 文件。同样的输入总是得到同样的分片名，重新运行会覆盖而不是重复。
+    返回 [{"url": 分片文件名, "nsamples": 样本数, "filesize": 字节数}, ...]。
+    """
+    extension = ".tar" if fmt == "tar" else ".parquet"
+    writer_class = _TarShardWriter if fmt == "tar" else _ParquetShardWriter
+    shards = []
+    writer = None
+    nsamples = 0
+    last_key = None
+
+    def finish(writer, nsamples):
+        writer.close()
+        final_path = writer.path[:-len(".part")]
+        os.replace(writer.path, final_path)
+        shards.append({"url": os.path.basename(final_path), "nsamples": nsamples,
+                       "filesize": os.path.getsize(final_path)})
+
+    try:
+        for source in sources:
+            with open(source, "rb", buffering=READ_BUFFER_SIZE) as f:
+                # 流式读取: 按顺序读取头部和内容，不需要来回跳转
+                with tarfile.open(fileobj=f, mode="r|") as tar:
+                    for member in tar:
+                        if not member.isreg():
+                            continue
+                        key = sample_key(member.name)
+                        if key != last_key:
+                            if writer is not None and writer.tell() >= shard_bytes:
+                                finish(writer, nsamples)
+                                writer = None
+                            if writer is None:
+                                path = os.path.join(output_dir, f"{prefix}-{len(shards):05d}{extension}.part")
+                                writer = writer_class(path)
+                                nsamples = 0
+                            nsamples += 1
+                            last_key = key
+                        writer.add(member, tar.extractfile(member))
+        if writer is not None:
+            finish(writer, nsamples)
+            writer = None
+    except Exception:
+        if writer is not None:
+            try:
+                writer.close()
+            except Exception:
+                pass
+            if os.path.exists(writer.path):
+                os.remove(writer.path)
+        raise
+    return shards
+
+def plan_tasks(sources, shard_bytes):
+    """按顺序把源文件分组，每组至少凑够一个输出分片，组之间可以并行处理"""
+    tasks = []
+    group, total = [], 0
+    for source in sources:
+        group.append(source)
+        total += os.path.getsize(source)
+        if total >= shard_bytes:
+            tasks.append(group)
+            group, total = [], 0
+    if group:
+        tasks.append(group)
+    return tasks
+
+def _update_shard_list(output_dir, new_shards):
+    """更新输出目录中的 shards.json (wids格式的分片列表，训练时可以按样本随机访问)"""
+    list_path = os.path.join(output_dir, "shards.json")
+    shard_list = {"__kind__": "wids-shard-index-v1", "wids_version": 1, "shardlist": []}
+    if os.path.exists(list_path):
+        with open(list_path, "r", encoding="utf-8") as f:
+            shard_list = json.load(f)
+    shards = {shard["url"]: shard for shard in shard_list["shardlist"]}
+    shards.update((shard["url"], shard) for shard in new_shards)
+    shard_list["shardlist"] = [shards[url] for url in sorted(shards)]
+    temp_path = list_path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(shard_list, f, ensure_ascii=False, indent=1)
+    os.replace(temp_path, list_path)
+
+def repack_directory(tar_paths, output_dir, fmt="tar", shard_bytes=1024 ** 3, workers=None,
+                     record_file=REPACK_RECORD, index=None):
+    """把tar文件重新打包到output_dir，用多个进程并行处理，已处理的源文件记录在record_file中"""
+    if fmt == "parquet" and pyarrow is None:
+        raise ValueError("输出Parquet分片需要安装pyarrow (pip install pyarrow)")
+    processed_files = load_processed_files(record_file)
+    sources = sorted(p for p in tar_paths if p not in processed_files)
+    if not sources:
+        print(f"没有新的 tar 文件需要打包到 {output_dir}。")
+        return
+    os.makedirs(output_dir, exist_ok=True)
+
+    tasks = plan_tasks(sources, shard_bytes)
+    workers = workers or os.cpu_count() or 1
+    print(f"正在打包 {len(sources)} 个文件 -> {output_dir} ({len(tasks)} 个任务，{workers} 个进程)")
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for group in tasks:
+            # 用第一个源文件的名字作为分片名前缀，新增文件后已有分片的名字不变
+            prefix = os.path.splitext(os.path.basename(group[0]))[0]
+            futures[executor.submit(repack_task, group, output_dir, prefix, fmt, shard_bytes)] = group
+        for future in concurrent.futures.as_completed(futures):
+            group = futures[future]
+            try:
+                shards = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"打包 {', '.join(os.path.basename(p) for p in group)} 时出错: {e}")
+                continue
+            _update_shard_list(output_dir, shards)
+            if index is not None and fmt == "tar":
+                for shard in shards:
+                    index.build(os.path.join(output_dir, shard["url"]), force=True)
+            # 分片全部写完后才记录源文件，中途退出时整组重新打包
+            for source in group:
+                save_processed_file(record_file, source)
+            print(f"完成 {', '.join(os.path.basename(p) for p in group)}: {len(shards)} 个分片，"
+                  f"{sum(s['nsamples'] for s in shards)} 个样本")
+    if failed:
+        print(f"{failed} 个任务失败，重新运行会继续处理")
+
+def process_directories(base_directory, output_base, sources=None, **options):
+    """
+    打包 train, test 和 valid 目录中的 tar 文件到 <output_base>/<子目录>。
+    sources 的格式和 step1_unzip.py 相同，可以直接打包下载器写入的位置 (例如 downloads/batch_*)。
+    """
+    sources = sources or {}
+    for sub_dir in ['train', 'test', 'valid']:
+        tar_paths = sorted(glob.glob(os.path.join(base_directory, sub_dir, "*.tar")))
+        for pattern in sources.get(sub_dir, []):
+            for source_dir in sorted(glob.glob(pattern)):
+                tar_paths.extend(sorted(glob.glob(os.path.join(source_dir, "*.tar"))))
+        if not tar_paths:
+            print(f"目录 {os.path.join(base_directory, sub_dir)} 中没有 tar 文件。")
+            continue
+        repack_directory(tar_paths, os.path.join(output_base, sub_dir), **options)
+
+if __name__ == "__main__":
+    # python repack_shards.py [数据集目录] --output=shards [--format=tar|parquet] [--shard-size=1G] [--workers=N]
+    # 直接从下载的 tar 文件流式打包成大小固定的训练分片，不需要先解压；--source 的用法和 step1_unzip.py 相同
+    # --index=downloads/tar_index.db 为输出的 tar 分片建立成员索引 (见 tar_index.py)
+    positional = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    base_dir = positional[0] if positional else "./"
+    output_base = "shards"
+    options = {}
+    for arg in sys.argv[1:]:
+        name, _, value = arg.partition("=")
+        if name == "--output":
+            output_base = value
+        elif name == "--format":
+            if value not in FORMATS:
+                raise ValueError(f"无效的 --format 参数: {value}，可选: {', '.join(FORMATS)}")
+            options["fmt"] = value
+        elif name == "--shard-size":
+            from rate_limiter import parse_rate
+            options["shard_bytes"] = int(parse_rate(value))
+        elif name == "--workers":
+            options["workers"] = int(value)
+        elif name == "--index":
+            from tar_index import TarIndex
+            options["index"] = TarIndex(value)
+
+    process_directories(base_dir, output_base, sources=parse_sources(sys.argv[1:]), **options)
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import socket
+import sqlite3
+import statistics
+import threading
+import time
+import uuid
+
+def _load_pyarrow():
+    """pyarrow导入很慢，只在保存Parquet记录时导入；没有安装时返回None (只写JSON记录)"""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        return None
+    return pyarrow
+
+# 每个文件记录包含的字段
+FILE_FIELDS = ["name", "item_id", "size", "status", "duration", "throughput",
+               "retries", "segments", "error_class", "error", "node"]
+
+class RunRecord:
+    """一次批量运行(下载、补齐、同步或验证)的结构化记录
+
+    每个文件记录大小、耗时、吞吐量、重试次数、错误类别和运行节点，
+    结束后由RunHistory保存为JSON(安装pyarrow时同时保存Parquet)并写入历史数据库。
+    """
+
+    def __init__(self, command, batch_number=None, max_workers=None, order_policy=None, node=None):
+        self.node = node or socket.gethostname()
+        self.command = command
+        self.batch_number = batch_number
+        self.max_workers = max_workers
+        self.order_policy = order_policy
+        self.started_at = time.time()
+        self.finished_at = None
+        self.transfer_seconds = 0.0
+        self.run_id = f"{time.strftime('%Y%m%d_%H%M%S', time.localtime(self.started_at))}_{command}_{uuid.uuid4().hex[:6]}"
+        self.files = []
+        self._lock = threading.Lock()
+
+    def add_file(self, file_item, status, duration=0.0, retries=0, segments=0, error_class=None, error=None):
+        """添加一个文件的结果，status为success/failed/skipped/cached/deduplicated/ok/missing/size_mismatch"""
+        size = file_item.get("size")
+        record = {
+            "name": file_item.get("name"),
+            "item_id": file_item.get("id"),
+            "size": size,
+            "status": status,
+            "duration": round(duration, 3),
+            "throughput": round(size / duration, 1) if size and duration and status == "success" else None,
+            "retries": retries,
+            "segments": segments,
+            "error_class": error_class,
+            "error": str(error) if error else None,
+            "node": self.node,
+        }
+        with self._lock:
+            self.files.append(record)
+
+    def add_transfers(self, transfer_records, transfer_seconds):
+        """添加调度器返回的传输记录 (见DownloadScheduler.records)"""
+        self.transfer_seconds += transfer_seconds
+        for transfer in transfer_records:
+            self.add_file(
+                transfer["file_item"],
+                "success" if transfer["success"] else "failed",
+                duration=transfer["duration"],
+                retries=transfer["retries"],
+                segments=transfer["segments"],
+                error_class=transfer["error_class"],
+                error=transfer["error"]
+            )
+
+    def finish(self):
+        self.finished_at = time.time()
+
+    def summary(self):
+        """运行级别的汇总"""
+        counts = {}
+        for record in self.files:
+            counts[record["status"]] = counts.get(record["status"], 0) + 1
+        transferred = sum(record["size"] or 0 for record in self.files if record["status"] == "success")
+        return {
+            "run_id": self.run_id,
+            "command": self.command,
+            "batch": self.batch_number,
+            "node": self.node,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at or time.time(),
+            "max_workers": self.max_workers,
+            "order_policy": self.order_policy,
+            "files": len(self.files),
+            "successful": counts.get("success", 0),
+            "failed": counts.get("failed", 0),
+            "skipped": counts.get("skipped", 0),
+            "problems": counts.get("missing", 0) + counts.get("size_mismatch", 0),
+            "bytes": transferred,
+            "transfer_seconds": round(self.transfer_seconds, 3),
+            "throughput": round(transferred / self.transfer_seconds, 1) if self.transfer_seconds else None,
+            "retries": sum(record["retries"] or 0 for record in self.files),
+        }
+
+    def to_dict(self):
+        return {"run": self.summary(), "files": list(self.files)}
+
+class RunHistory:
+    """历史运行记录数据库 (SQLite)，用于比较不同运行的吞吐量"""
+
+    def __init__(self, db_path, records_dir=None):
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+
+        self.db_path = db_path
+        self.records_dir = records_dir
+        self._conn = sqlite3.connect(db_path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (
+                run_id TEXT PRIMARY KEY,
+                command TEXT,
+                batch INTEGER,
+                node TEXT,
+                started_at REAL,
+                finished_at REAL,
+                max_workers INTEGER,
+                order_policy TEXT,
+                files INTEGER,
+                successful INTEGER,
+                failed INTEGER,
+                skipped INTEGER,
+                problems INTEGER,
+                bytes INTEGER,
+                transfer_seconds REAL,
+                throughput REAL,
+                retries INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS files (
+                run_id TEXT NOT NULL,
+                name TEXT,
+                item_id TEXT,
+                size INTEGER,
+                status TEXT,
+                duration REAL,
+                throughput REAL,
+                retries INTEGER,
+                segments INTEGER,
+                error_class TEXT,
+                error TEXT,
+                node TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_files_run ON files(run_id);
+        """)
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+    def save(self, record):
+        """保存一次运行: 写入数据库，并在records_dir中写入 <run_id>.json (以及 .parquet)
+
+        返回写入的JSON文件路径。
+        """
+        summary = record.summary()
+        columns = list(summary.keys())
+        self._conn.execute(
+            f"INSERT OR REPLACE INTO runs ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+            [summary[c] for c in columns]
+        )
+        self._conn.execute("DELETE FROM files WHERE run_id = ?", (record.run_id,))
+        self._conn.executemany(
+            f"INSERT INTO files (run_id, {', '.join(FILE_FIELDS)}) VALUES (?, {', '.join('?' * len(FILE_FIELDS))})",
+            [[record.run_id] + [f[c] for c in FILE_FIELDS] for f in record.files]
+        )
+        self._conn.commit()
+
+        if not self.records_dir:
+            return None
+        os.makedirs(self.records_dir, exist_ok=True)
+        json_path = os.path.join(self.records_dir, f"{record.run_id}.json")
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(record.to_dict(), f, ensure_ascii=False, indent=2)
+        pyarrow = _load_pyarrow() if record.files else None
+        if pyarrow is not None:
+            table = pyarrow.Table.from_pylist([dict(f, run_id=record.run_id) for f in record.files])
+            pyarrow.parquet.write_table(table, os.path.join(self.records_dir, f"{record.run_id}.parquet"))
+        return json_path
+
+    def runs(self, batch_number=None, commands=None, limit=20):
+        """最近的运行记录(新的在前)"""
+        query = "SELECT * FROM runs"
+        conditions, args = [], []
+        if batch_number is not None:
+            conditions.append("batch = ?")
+            args.append(batch_number)
+        if commands:
+            conditions.append(f"command IN ({', '.join('?' * len(commands))})")
+            args.extend(commands)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY started_at DESC LIMIT ?"
+        args.append(limit)
+        cursor = self._conn.execute(query, args)
+        names = [d[0] for d in cursor.description]
+        return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def error_classes(self, run_ids):
+        """指定运行中各错误类别的文件数"""
+        if not run_ids:
+            return []
+        return self._conn.execute(
+            f"SELECT error_class, COUNT(*) FROM files WHERE run_id IN ({', '.join('?' * len(run_ids))}) "
+            "AND status = 'failed' GROUP BY error_class ORDER BY COUNT(*) DESC",
+            list(run_ids)
+        ).fetchall()
+
+def _mb(value):
+    return f"{value / 1024 / 1024:.1f}" if value else "-"
+
+def print_stats(history, batch_number=None, last=10):
+    """打印最近的运行、按节点和并行数的吞吐量对比，以及最近一次运行是否明显变慢"""
+    download_commands = ["download", "missing", "sync"]
+    runs = history.runs(batch_number, download_commands, limit=max(last, 200))
+    if not runs:
+        print("没有历史运行记录")
+        return
+
+    print("\n" + "=" * 96)
+    print(f"最近 {min(last, len(runs))} 次运行" + (f" (批次 {batch_number})" if batch_number else ""))
+    print("=" * 96)
+    print(f"{'开始时间':<20}{'节点':<16}{'命令':<10}{'批次':>4}{'并行':>6}{'成功/失败':>12}{'数据量(MB)':>12}{'MB/s':>8}{'重试':>6}")
+    print("-" * 96)
+    for run in runs[:last]:
+        started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(run["started_at"]))
+        print(f"{started:<20}{run['node'][:15]:<16}{run['command']:<10}{run['batch'] or '-':>4}"
+              f"{run['max_workers'] or '-':>6}{str(run['successful']) + '/' + str(run['failed']):>12}"
+              f"{_mb(run['bytes']):>12}{_mb(run['throughput']):>8}{run['retries'] or 0:>6}")
+
+    # 按节点和并行数分组，比较吞吐量，用于为每个站点调整max_workers
+    groups = {}
+    for run in runs:
+        if run["throughput"]:
+            groups.setdefault((run["node"], run["max_workers"]), []).append(run)
+    if groups:
+        print("-" * 96)
+        print("按节点和并行数汇总:")
+        print(f"  {'节点':<16}{'并行':>6}{'次数':>6}{'平均MB/s':>10}{'最高MB/s':>10}{'失败率':>8}")
+        for (node, workers), group in sorted(groups.items(), key=lambda kv: (kv[0][0], kv[0][1] or 0)):
+            throughputs = [run["throughput"] for run in group]
+            attempted = sum(run["successful"] + run["failed"] for run in group) or 1
+            failure_rate = sum(run["failed"] for run in group) / attempted * 100
+            print(f"  {node[:15]:<16}{workers or '-':>6}{len(group):>6}{_mb(statistics.mean(throughputs)):>10}"
+                  f"{_mb(max(throughputs)):>10}{failure_rate:>7.1f}%")
+
+    # 最近一次运行与同一节点、同一并行数的历史中位数比较
+    latest = next((run for run in runs if run["throughput"]), None)
+    if latest:
+        previous = [run["throughput"] for run in groups.get((latest["node"], latest["max_workers"]), [])
+                    if run["run_id"] != latest["run_id"]]
+        if previous:
+            baseline = statistics.median(previous)
+            change = (latest["throughput"] - baseline) / baseline * 100
+            print("-" * 96)
+            print(f"最近一次运行 {_mb(latest['throughput'])} MB/s，历史中位数 {_mb(baseline)} MB/s ({change:+.1f}%)")
+            if change < -20:
+                print("警告: 吞吐量明显下降")
+
+    errors = history.error_classes([run["run_id"] for run in runs[:last]])
+    if errors:
+        print("-" * 96)
+        print("失败原因:")
+        for error_class, count in errors:
+            print(f"  {error_class or '未知'}: {count} 个文件")
+    print("=" * 96)
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+import threading
+import time
+
+from item_records import FileRecord
+
+# 文件状态: 已计划 -> 下载中(记录每个分段已落盘的位置) -> 已下载 -> 已验证 -> 已解压；失败的文件保留分段位置
+STATES = ("queued", "in_flight", "downloaded", "verified", "extracted", "failed")
+# 重启后需要继续处理的状态
+UNFINISHED_STATES = ("queued", "in_flight", "failed")
+
+class RunJournal:
+    """运行日志: 记录每个批次中每个文件的状态和分段下载位置 (SQLite WAL)
+
+    进程被杀或节点重启后，直接从日志恢复文件列表、本地路径和断点，不需要重新列出远程目录，
+    也不需要逐个检查本地文件。分段位置只在 .part 文件数据落盘(fdatasync)之后才写入，
+    所以记录的位置之前的数据一定是完整的。
+    """
+
+    def __init__(self, db_path):
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # 断电时最多丢失最后几次提交，恢复时只会多下载一小段
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS batches (
+                batch_key TEXT PRIMARY KEY,
+                drive_id TEXT,
+                folder_id TEXT,
+                created_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS files (
+                batch_key TEXT NOT NULL,
+                item_id TEXT NOT NULL,
+                name TEXT,
+                size INTEGER,
+                etag TEXT,
+                ctag TEXT,
+                last_modified TEXT,
+                quick_xor_hash TEXT,
+                sha1_hash TEXT,
+                local_path TEXT,
+                state TEXT NOT NULL,
+                updated_at REAL,
+                PRIMARY KEY (batch_key, item_id)
+            );
+            CREATE INDEX IF NOT EXISTS idx_files_path ON files(local_path);
+            CREATE TABLE IF NOT EXISTS segments (
+                batch_key TEXT NOT NULL,
+                item_id TEXT NOT NULL,
+                start INTEGER NOT NULL,
+                pos INTEGER NOT NULL,
+                "end" INTEGER NOT NULL,
+                PRIMARY KEY (batch_key, item_id, start)
+            );
+        """)
+        # 旧版本的日志没有优先级和暂停标记
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(files)")}
+        if "priority" not in columns:
+            self._conn.execute("ALTER TABLE files ADD COLUMN priority INTEGER NOT NULL DEFAULT 0")
+        if "paused" not in columns:
+            self._conn.execute("ALTER TABLE files ADD COLUMN paused INTEGER NOT NULL DEFAULT 0")
+        self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def batch(self, batch_key):
+        """返回一个批次的日志视图"""
+        return BatchJournal(self, batch_key)
+
+    def _execute(self, sql, args=(), many=False):
+        with self._lock:
+            if many:
+                self._conn.executemany(sql, args)
+            else:
+                self._conn.execute(sql, args)
+            self._conn.commit()
+
+    def _query(self, sql, args=()):
+        with self._lock:
+            return self._conn.execute(sql, args).fetchall()
+
+    def mark_path(self, local_path, state):
+        """按本地路径更新状态 (例如step1_unzip.py解压完成后标记为extracted)"""
+        self._execute("UPDATE files SET state = ?, updated_at = ? WHERE local_path = ?",
+                      (state, time.time(), os.path.abspath(local_path)))
+
+class BatchJournal:
+    """一个批次的日志，提供给下载器和调度器使用"""
+
+    def __init__(self, journal, batch_key):
+        self.journal = journal
+        self.batch_key = batch_key
+
+    def begin(self, download_tasks, done_tasks=(), drive_id=None, folder_id=None, done_state="downloaded"):
+        """记录新的下载计划，替换该批次之前的日志
+
+        download_tasks为待下载的(file_item, local_path)，done_tasks为本地已存在的文件，状态为done_state。
+        本地路径保存为绝对路径，step1_unzip.py可以在其他工作目录下按路径标记解压状态。
+        之前设置过的优先级和暂停标记保留。
+        """
+        now = time.time()
+        options = self.queue_options()
+
+        def row(file_item, local_path, state):
+            priority, paused = options.get(file_item.id, (0, False))
+            return (self.batch_key, file_item.id, file_item.name, file_item.size, file_item.etag, file_item.ctag,
+                    file_item.last_modified, file_item.quick_xor_hash, file_item.sha1_hash,
+                    os.path.abspath(local_path), state, now, priority, int(paused))
+
+        rows = [row(f, p, "queued") for f, p in download_tasks] + [row(f, p, done_state) for f, p in done_tasks]
+        with self.journal._lock:
+            conn = self.journal._conn
+            # 同一个事务中替换，中途崩溃时保留旧的日志
+            with conn:
+                conn.execute("DELETE FROM files WHERE batch_key = ?", (self.batch_key,))
+                conn.execute("DELETE FROM segments WHERE batch_key = ?", (self.batch_key,))
+                conn.execute("INSERT OR REPLACE INTO batches (batch_key, drive_id, folder_id, created_at) "
+                             "VALUES (?, ?, ?, ?)", (self.batch_key, drive_id, folder_id, now))
+                conn.executemany(
+                    "INSERT INTO files (batch_key, item_id, name, size, etag, ctag, last_modified, "
+                    "quick_xor_hash, sha1_hash, local_path, state, updated_at, priority, paused) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+
+    def location(self):
+        """返回记录计划时的(drive_id, folder_id)，没有日志时返回None"""
+        rows = self.journal._query("SELECT drive_id, folder_id FROM batches WHERE batch_key = ?", (self.batch_key,))
+        return rows[0] if rows else None
+
+    def counts(self):
+        """各状态的文件数"""
+        rows = self.journal._query("SELECT state, COUNT(*) FROM files WHERE batch_key = ? GROUP BY state",
+                                   (self.batch_key,))
+        return dict(rows)
+
+    def unfinished(self):
+        """需要继续处理的文件: [(FileRecord, local_path, state), ...]"""
+        rows = self.journal._query(
+            "SELECT item_id, name, size, etag, ctag, last_modified, quick_xor_hash, sha1_hash, local_path, state "
+            f"FROM files WHERE batch_key = ? AND state IN ({', '.join('?' * len(UNFINISHED_STATES))}) "
+            "ORDER BY rowid",
+            (self.batch_key,) + UNFINISHED_STATES
+        )
+        return [(FileRecord(*row[:8]), row[8], row[9]) for row in rows]
+
+    def mark(self, item_id, state):
+        self.journal._execute(
+            "UPDATE files SET state = ?, updated_at = ? WHERE batch_key = ? AND item_id = ?",
+            (state, time.time(), self.batch_key, item_id)
+        )
+
+    def mark_many(self, item_ids, state):
+        now = time.time()
+        self.journal._execute(
+            "UPDATE files SET state = ?, updated_at = ? WHERE batch_key = ? AND item_id = ?",
+            [(state, now, self.batch_key, item_id) for item_id in item_ids],
+            many=True
+        )
+
+    def queue_options(self):
+        """各文件的优先级和暂停标记 {item_id: (priority, paused)}，只包含设置过的文件"""
+        rows = self.journal._query(
+            "SELECT item_id, priority, paused FROM files WHERE batch_key = ? AND (priority != 0 OR paused != 0)",
+            (self.batch_key,)
+        )
+        return {item_id: (priority, bool(paused)) for item_id, priority, paused in rows}
+
+    def set_priority(self, item_ids, priority):
+        self.journal._execute(
+            "UPDATE files SET priority = ? WHERE batch_key = ? AND item_id = ?",
+            [(priority, self.batch_key, item_id) for item_id in item_ids],
+            many=True
+        )
+
+    def set_paused(self, item_ids, paused):
+        self.journal._execute(
+            "UPDATE files SET paused = ? WHERE batch_key = ? AND item_id = ?",
+            [(int(paused), self.batch_key, item_id) for item_id in item_ids],
+            many=True
+        )
+
+    def downloaded(self, item_id):
+        """文件已经完整地出现在目标路径，不再需要分段记录"""
+        with self.journal._lock:
+            conn = self.journal._conn
+            with conn:
+                conn.execute("UPDATE files SET state = 'downloaded', updated_at = ? WHERE batch_key = ? AND item_id = ?",
+                             (time.time(), self.batch_key, item_id))
+                conn.execute("DELETE FROM segments WHERE batch_key = ? AND item_id = ?", (self.batch_key, item_id))
+
+    # 以下方法由DownloadScheduler调用
+
+    def resume_segments(self, item_id):
+        """上次记录的分段 [(start, pos, end), ...]，没有时返回空列表"""
+        return self.journal._query(
+            'SELECT start, pos, "end" FROM segments WHERE batch_key = ? AND item_id = ? ORDER BY start',
+            (self.batch_key, item_id)
+        )
+
+    def start(self, item_id, segments):
+        """开始(或重新开始)下载一个文件，segments为[(start, pos, end), ...]"""
+        with self.journal._lock:
+            conn = self.journal._conn
+            with conn:
+                conn.execute("UPDATE files SET state = 'in_flight', updated_at = ? WHERE batch_key = ? AND item_id = ?",
+                             (time.time(), self.batch_key, item_id))
+                conn.execute("DELETE FROM segments WHERE batch_key = ? AND item_id = ?", (self.batch_key, item_id))
+                conn.executemany(
+                    'INSERT INTO segments (batch_key, item_id, start, pos, "end") VALUES (?, ?, ?, ?, ?)',
+                    [(self.batch_key, item_id, start, pos, end) for start, pos, end in segments]
+                )
+
+    def split(self, item_id, start, middle, end):
+        """分段[start, end)在middle处拆分"""
+        with self.journal._lock:
+            conn = self.journal._conn
+            with conn:
+                conn.execute('UPDATE segments SET "end" = ? WHERE batch_key = ? AND item_id = ? AND start = ?',
+                             (middle, self.batch_key, item_id, start))
+                conn.execute('INSERT OR REPLACE INTO segments (batch_key, item_id, start, pos, "end") '
+                             'VALUES (?, ?, ?, ?, ?)', (self.batch_key, item_id, middle, middle, end))
+
+    def checkpoint(self, item_id, start, pos):
+        """分段中pos之前的数据已经落盘"""
+        self.journal._execute("UPDATE segments SET pos = ? WHERE batch_key = ? AND item_id = ? AND start = ?",
+                              (pos, self.batch_key, item_id, start))
@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import concurrent.futures
+import hashlib
+import hmac
+import os
+import shutil
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+from config import SHARD_CACHE_TOKEN
+from content_index import content_key, link_file, verify_content, DEDUP_METHODS
+from rate_limiter import parse_rate
+
+# 本机地址: 缓存服务器没有设置写入密钥时只接受来自这些地址的写入
+_LOOPBACK_HOSTS = ("127.0.0.1", "::1", "localhost")
+
+def cache_key(item):
+    """缓存键: 有文件哈希时按内容，否则按项目ID + cTag/eTag (内容变化时会改变)"""
+    key = content_key(item)
+    if key:
+        return key
+    tag = item.get("cTag") or item.get("eTag")
+    if not tag:
+        return None
+    return f"item:{item['id']}:{tag}"
+
+def _object_name(key):
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+def _accept(item, part_path, local_path):
+    """校验从缓存取得的 .part 文件 (大小和文件哈希)，一致时改名为local_path并返回True，否则删除"""
+    size = item.get("size")
+    try:
+        ok = (size is None or os.path.getsize(part_path) == size) and verify_content(item, part_path) is not False
+        if ok:
+            os.replace(part_path, local_path)
+            return True
+        print(f"分片缓存中的 {item.get('name')} 与文件哈希不一致，已忽略")
+    except OSError:
+        pass
+    if os.path.exists(part_path):
+        os.remove(part_path)
+    return False
+
+class DirectoryCache:
+    """位于共享目录(例如NFS)上的分片缓存，多个下载节点可以同时使用
+
+    对象以缓存键的sha256命名，先写入临时文件再原子重命名，其他节点不会读到不完整的对象。
+    对象是只读的，命中时用reflink或复制放到下载目录 (不用硬链接，下载目录中的修改不会影响缓存)，
+    并按文件哈希校验。命中时更新对象的修改时间，总大小超过max_bytes时按修改时间淘汰最久未使用的对象。
+    """
+
+    def __init__(self, root, max_bytes=None):
+        self.root = root
+        self.objects_dir = os.path.join(root, "objects")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._approx_bytes = None  # 上次扫描后估计的总大小
+        self._puts_since_scan = 0
+
+    def describe(self):
+        return self.root
+
+    def _path(self, name):
+        return os.path.join(self.objects_dir, name[:2], name)
+
+    def open_object(self, name, size=None):
+        """返回对象的路径并更新其使用时间；不存在或大小不符时返回None"""
+        path = self._path(name)
+        try:
+            if size is not None and os.path.getsize(path) != size:
+                return None
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def get(self, item, local_path):
+        """命中时把缓存对象放到local_path (reflink/复制) 并返回True"""
+        key = cache_key(item)
+        if not key:
+            return False
+        path = self.open_object(_object_name(key), item.get("size"))
+        if not path:
+            return False
+        part_path = local_path + ".part"
+        if link_file(path, part_path, DEDUP_METHODS["reflink"]) is None:
+            return False
+        return _accept(item, part_path, local_path)
+
+    def put(self, item, local_path):
+        """把下载完成的文件加入缓存"""
+        key = cache_key(item)
+        if not key:
+            return
+        with open(local_path, "rb") as f:
+            self.store(_object_name(key), f, item.get("size"))
+
+    def store(self, name, source, size=None):
+        """从文件对象写入缓存对象，已存在时跳过"""
+        path = self._path(name)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = os.path.join(os.path.dirname(path), f".tmp-{uuid.uuid4().hex}")
+        try:
+            with open(temp_path, "wb") as f:
+                shutil.copyfileobj(source, f, 1024 * 1024)
+            written = os.path.getsize(temp_path)
+            if size is not None and written != size:
+                raise IOError(f"写入缓存的大小不匹配 ({written} != {size})")
+            os.chmod(temp_path, 0o444)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        self._after_store(written)
+
+    def _after_store(self, nbytes):
+        if not self.max_bytes:
+            return
+        with self._lock:
+            self._puts_since_scan += 1
+            if self._approx_bytes is not None:
+                self._approx_bytes += nbytes
+            # 其他节点也在写入，定期重新扫描
+            need_scan = (self._approx_bytes is None or self._approx_bytes > self.max_bytes
+                         or self._puts_since_scan >= 50)
+        if need_scan:
+            self.evict()
+
+    def evict(self):
+        """按最近使用时间淘汰对象，直到总大小降到max_bytes的90%以下，返回淘汰的字节数"""
+        entries = []
+        now = time.time()
+        for dirpath, _, filenames in os.walk(self.objects_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if filename.startswith(".tmp-"):
+                    # 写入中途退出留下的临时文件
+                    if now - st.st_mtime > 24 * 3600:
+                        try:
+                            os.remove(path)
+                        except OSError:
+                            pass
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        if self.max_bytes and total > self.max_bytes:
+            target = self.max_bytes * 0.9
+            for _, size, path in sorted(entries):
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                evicted += size
+            print(f"分片缓存淘汰了 {evicted / 1024 / 1024:.1f} MB")
+
+        with self._lock:
+            self._approx_bytes = total
+            self._puts_since_scan = 0
+        return evicted
+
+class HttpCache:
+    """局域网分片缓存服务器(python shard_cache.py serve)的客户端
+
+    取得的文件按文件哈希校验后才放到下载目录；写入时带上token (服务器的SHARD_CACHE_TOKEN)。
+    """
+
+    def __init__(self, base_url, token=SHARD_CACHE_TOKEN):
+        self.base_url = base_url.rstrip("/")
+        self.token = token
+        self.session = requests.Session()
+
+    def describe(self):
+        return self.base_url
+
+    def get(self, item, local_path):
+        key = cache_key(item)
+        if not key:
+            return False
+        try:
+            response = self.session.get(f"{self.base_url}/objects/{_object_name(key)}", stream=True, timeout=30)
+        except requests.exceptions.RequestException:
+            return False
+        try:
+            if response.status_code != 200:
+                return False
+            os.makedirs(os.path.dirname(local_path) or ".", exist_ok=True)
+            part_path = local_path + ".part"
+            with open(part_path, "wb") as f:
+                for chunk in response.iter_content(chunk_size=1024 * 1024):
+                    f.write(chunk)
+            return _accept(item, part_path, local_path)
+        except (OSError, requests.exceptions.RequestException):
+            return False
+        finally:
+            response.close()
+
+    def put(self, item, local_path):
+        key = cache_key(item)
+        if not key:
+            return
+        headers = {"Content-Length": str(os.path.getsize(local_path))}
+        if self.token:
+            headers["X-Cache-Token"] = self.token
+        with open(local_path, "rb") as f:
+            response = self.session.put(
+                f"{self.base_url}/objects/{_object_name(key)}",
+                data=f,
+                headers=headers,
+                timeout=300
+            )
+        response.raise_for_status()
+
+class ShardCacheClient:
+    """下载器使用的缓存层: 下载前先查缓存，下载完成后在后台写入缓存"""
+
+    def __init__(self, backend, put_workers=2):
+        self.backend = backend
+        self.hits = 0
+        self.hit_bytes = 0
+        self._lock = threading.Lock()
+        self._put_workers = put_workers
+        self._put_executor = None
+        self._pending_puts = []
+
+    def fetch(self, item, local_path):
+        """命中缓存时把文件放到local_path并返回True"""
+        try:
+            hit = self.backend.get(item, local_path)
+        except Exception as e:
+            print(f"读取分片缓存出错: {str(e)}")
+            hit = False
+        if hit:
+            with self._lock:
+                self.hits += 1
+                self.hit_bytes += item.get("size") or 0
+            print(f"分片缓存命中: {item.get('name')}")
+        return hit
+
+    def populate(self, item, local_path):
+        """在后台把下载完成的文件写入缓存，不阻塞下载线程"""
+        with self._lock:
+            if self._put_executor is None:
+                self._put_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self._put_workers, thread_name_prefix="shard-cache-put"
+                )
+            self._pending_puts.append(self._put_executor.submit(self._put, item, local_path))
+
+    def _put(self, item, local_path):
+        try:
+            self.backend.put(item, local_path)
+        except Exception as e:
+            print(f"写入分片缓存出错: {item.get('name')}: {str(e)}")
+
+    def wait(self):
+        """等待后台写入全部完成"""
+        with self._lock:
+            pending, self._pending_puts = self._pending_puts, []
+        for future in pending:
+            future.result()
+
+    def wrap(self, download_fn):
+        """包装download_fn(item, local_path): 先查缓存，下载成功后写入缓存"""
+        def cached_download(item, local_path):
+            if self.fetch(item, local_path):
+                return True
+            success = download_fn(item, local_path)
+            if success:
+                self.populate(item, local_path)
+            return success
+        return cached_download
+
+def open_shard_cache(spec, max_bytes=None):
+    """根据配置创建缓存层: 目录路径或http(s)://缓存服务器地址，为空时返回None"""
+    if not spec:
+        return None
+    if spec.startswith(("http://", "https://")):
+        return ShardCacheClient(HttpCache(spec))
+    return ShardCacheClient(DirectoryCache(spec, max_bytes))
+
+def _make_handler(cache, token=""):
+    """token为空时只接受本机的写入"""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _object_name(self):
+            parts = self.path.split("?", 1)[0].strip("/").split("/")
+            if len(parts) != 2 or parts[0] != "objects" or len(parts[1]) != 64:
+                return None
+            return parts[1]
+
+        def _reply(self, status):
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_GET(self):
+            name = self._object_name()
+            path = cache.open_object(name) if name else None
+            if not path:
+                self._reply(404)
+                return
+            with open(path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(size))
+                self.end_headers()
+                # 用sendfile直接从页缓存发送，局域网内可以跑满带宽
+                self.wfile.flush()
+                self.connection.sendfile(f)
+
+        def do_HEAD(self):
+            name = self._object_name()
+            path = cache.open_object(name) if name else None
+            if not path:
+                self._reply(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Length", str(os.path.getsize(path)))
+            self.end_headers()
+
+        def _may_write(self):
+            if token:
+                return hmac.compare_digest(self.headers.get("X-Cache-Token", ""), token)
+            return self.client_address[0] in _LOOPBACK_HOSTS
+
+        def do_PUT(self):
+            if not self._may_write():
+                self.close_connection = True
+                self._reply(403)
+                return
+            name = self._object_name()
+            length = int(self.headers.get("Content-Length", "-1"))
+            if not name or length < 0:
+                self._reply(400)
+                return
+            try:
+                cache.store(name, _LimitedReader(self.rfile, length), length)
+            except Exception:
+                self.close_connection = True
+                self._reply(500)
+                return
+            self._reply(201)
+
+    return Handler
+
+class _LimitedReader:
+    """只读取请求体中的length字节"""
+
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.remaining = length
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b""
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.stream.read(size)
+        self.remaining -= len(data)
+        return data
+
+def main():
+    parser = argparse.ArgumentParser(description="分片缓存: 在局域网内提供缓存服务，或清理共享缓存目录")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve = subparsers.add_parser("serve", help="启动HTTP缓存服务器")
+    serve.add_argument("--root", required=True, help="缓存目录")
+    serve.add_argument("--host", default="127.0.0.1", help="监听地址，局域网内共享时用 0.0.0.0")
+    serve.add_argument("--port", type=int, default=8765)
+    serve.add_argument("--token", default=SHARD_CACHE_TOKEN,
+                       help="写入密钥 (默认SHARD_CACHE_TOKEN)，没有时只接受本机写入")
+    serve.add_argument("--max-bytes", default="500G", help="缓存容量上限，例如 500G")
+
+    prune = subparsers.add_parser("prune", help="按容量上限淘汰最久未使用的对象")
+    prune.add_argument("--root", required=True, help="缓存目录")
+    prune.add_argument("--max-bytes", default="500G", help="缓存容量上限，例如 500G")
+
+    args = parser.parse_args()
+    max_bytes = int(parse_rate(args.max_bytes) or 0) or None
+    cache = DirectoryCache(args.root, max_bytes)
+
+    if args.command == "prune":
+        evicted = cache.evict()
+        print(f"已淘汰 {evicted / 1024 / 1024:.1f} MB")
+        return
+
+    server = ThreadingHTTPServer((args.host, args.port), _make_handler(cache, args.token))
+    server.daemon_threads = True
+    print(f"分片缓存服务器: http://{args.host}:{server.server_port}/ (目录: {args.root})")
+    if not args.token and args.host not in _LOOPBACK_HOSTS:
+        print("没有设置写入密钥 (--token 或 SHARD_CACHE_TOKEN)，其他节点只能读取，不能写入缓存")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
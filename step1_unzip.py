@@ -1,7 +1,22 @@
 import os
+import sys
+import glob
+import errno
 import tarfile
+import threading
+import time
+import zlib
+import concurrent.futures
 
 PROCESSED_FILE_RECORD = "unziped_record.txt"
+# 按8MB的大块顺序读取tar文件和复制文件内容
+READ_BUFFER_SIZE = 8 * 1024 * 1024
+# 文件内容的复制方式: read为普通读写，sendfile/copy_file_range由内核直接在文件之间复制，auto依次尝试
+COPY_MODES = ("read", "sendfile", "copy_file_range", "auto")
+# 内核复制不支持时(例如跨文件系统或旧内核)的错误码，遇到后改用普通读写
+_UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF}
+_unsupported_modes = set()
+_record_lock = threading.Lock()
 
 def load_processed_files(record_file):
     """
@@ -16,13 +31,178 @@ def save_processed_file(record_file, file_path):
     """
     保存已处理的 tar 文件路径到记录文件。
     """
-    with open(record_file, 'a') as f:
-        f.write(file_path + '\n')
+    with _record_lock:
+        with open(record_file, 'a') as f:
+            f.write(file_path + '\n')
 
-def extract_tar_files_in_batches(directory, batch_size=5, record_file=PROCESSED_FILE_RECORD):
+class DiskLimits:
+    """按磁盘限制解压的并发数
+
+    每个源磁盘同时读取read_workers个tar文件，每个目标磁盘同时写入write_workers个tar文件，
+    磁盘按st_dev区分 (同一磁盘上的多个输出目录共用一个限制)。
+    bucket为rate_limiter.TokenBucket时按它限制总的写入速度，给同一台机器上的下载留出磁盘带宽。
+    """
+
+    def __init__(self, read_workers=1, write_workers=1, bucket=None):
+        self.read_workers = read_workers
+        self.write_workers = write_workers
+        self.bucket = bucket
+        self._lock = threading.Lock()
+        self._readers = {}
+        self._writers = {}
+
+    def _semaphore(self, table, path, limit):
+        device = os.stat(path).st_dev
+        with self._lock:
+            if device not in table:
+                table[device] = threading.BoundedSemaphore(limit)
+            return table[device]
+
+    def reading(self, path):
+        return self._semaphore(self._readers, path, self.read_workers)
+
+    def writing(self, directory):
+        return self._semaphore(self._writers, directory, self.write_workers)
+
+    def throttle(self, nbytes):
+        if self.bucket is not None:
+            delay = self.bucket.reserve(nbytes)
+            if delay > 0:
+                time.sleep(delay)
+
+def choose_output_directory(tar_path, output_directories):
+    """按tar文件名的哈希在多个输出目录中选择一个，同一个文件每次都解压到同一个位置"""
+    if isinstance(output_directories, str):
+        return output_directories
+    index = zlib.crc32(os.path.basename(tar_path).encode("utf-8")) % len(output_directories)
+    return output_directories[index]
+
+# "data" 过滤器拒绝指向输出目录之外的链接、设备文件等 (Python 3.11.4+)
+if hasattr(tarfile, "data_filter"):
+    _EXTRACT_FILTER = {"filter": "data"}
+    _FILTER_ERRORS = (tarfile.FilterError,)
+else:
+    _EXTRACT_FILTER = {}
+    _FILTER_ERRORS = ()
+
+def _member_path(output_directory, name):
+    """成员在输出目录中的路径，绝对路径或跳出输出目录的成员返回None
+
+    用realpath解析已经解压出来的符号链接，防止先解压链接 d -> /somewhere
+    再通过 d/file 写到输出目录之外。
+    """
+    root = os.path.realpath(output_directory)
+    target = os.path.realpath(os.path.join(root, name))
+    if os.path.isabs(name) or not target.startswith(root + os.sep):
+        return None
+    return target
+
+def _kernel_copy(mode, src_fd, offset, size, dst_fd, limits):
+    copied = 0
+    while copied < size:
+        count = min(READ_BUFFER_SIZE, size - copied)
+        if mode == "copy_file_range":
+            n = os.copy_file_range(src_fd, dst_fd, count, offset + copied)
+        else:
+            n = os.sendfile(dst_fd, src_fd, offset + copied, count)
+        if n == 0:
+            raise tarfile.ReadError("tar文件意外结束")
+        copied += n
+        if limits is not None:
+            limits.throttle(n)
+
+def _copy_payload(src, offset, size, out, copy_mode="read", limits=None):
+    """把tar文件中[offset, offset + size)的内容写入out"""
+    if copy_mode == "auto":
+        modes = ["copy_file_range", "sendfile"]
+    elif copy_mode == "read":
+        modes = []
+    else:
+        modes = [copy_mode]
+    for mode in modes:
+        if mode in _unsupported_modes or not hasattr(os, mode):
+            continue
+        try:
+            _kernel_copy(mode, src.fileno(), offset, size, out.fileno(), limits)
+            return
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+            print(f"{mode} 不可用 ({e.strerror})，改用其他复制方式")
+            _unsupported_modes.add(mode)
+            out.seek(0)
+            out.truncate()
+
+    src.seek(offset)
+    remaining = size
+    while remaining:
+        chunk = src.read(min(READ_BUFFER_SIZE, remaining))
+        if not chunk:
+            raise tarfile.ReadError("tar文件意外结束")
+        out.write(chunk)
+        remaining -= len(chunk)
+        if limits is not None:
+            limits.throttle(len(chunk))
+
+def extract_tar(tar_path, output_directory, copy_mode="read", limits=None, index=None):
+    """
+    解压一个 tar 文件，返回写入的字节数。
+    普通文件的内容直接从 tar 中的位置复制到目标文件，目录和链接等其他成员交给 tarfile 处理。
+    index (tar_index.TarIndex) 不为空时顺便记录每个成员的偏移，之后可以不解压直接读取。
+    """
+    written = 0
+    # 内核复制时不经过Python的缓冲区，不需要大的读缓冲
+    buffering = READ_BUFFER_SIZE if copy_mode == "read" else -1
+    with open(tar_path, "rb", buffering=buffering) as f:
+        if hasattr(os, "posix_fadvise"):
+            # 提示内核按顺序预读
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        with tarfile.open(fileobj=f, mode="r:") as tar:
+            for member in tar:
+                if not member.isreg() or member.issparse():
+                    try:
+                        tar.extract(member, path=output_directory, **_EXTRACT_FILTER)
+                    except _FILTER_ERRORS as e:
+                        print(f"跳过不安全的成员: {member.name} ({e})")
+                    continue
+                target = _member_path(output_directory, member.name)
+                if target is None:
+                    print(f"跳过不安全的路径: {member.name}")
+                    continue
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                with open(target, "wb") as out:
+                    _copy_payload(f, member.offset_data, member.size, out, copy_mode, limits)
+                tar.chmod(member, target)
+                tar.utime(member, target)
+                written += member.size
+            if index is not None:
+                index.record_file(tar_path, tar.getmembers())
+    return written
+
+def _interleave(tar_paths, output_directories):
+    """轮流排列写入不同输出目录的文件，避免所有线程都在等待同一个磁盘"""
+    groups = {}
+    for tar_path in tar_paths:
+        groups.setdefault(choose_output_directory(tar_path, output_directories), []).append(tar_path)
+    ordered = []
+    for i in range(max((len(group) for group in groups.values()), default=0)):
+        ordered.extend(group[i] for group in groups.values() if i < len(group))
+    return ordered
+
+def extract_tar_files_in_batches(directory, batch_size=5, record_file=PROCESSED_FILE_RECORD, output_directory=None,
+                                 journal=None, limits=None, copy_mode="read", index=None):
     """
     批量解压目录中的 .tar 文件，带有检查点机制，避免重复解压已处理的文件。
+    output_directory 为解压位置，默认解压到 tar 文件所在的目录；为列表时按文件名哈希分散到多个目录(磁盘)。
+    最多同时解压 batch_size 个文件，limits (DiskLimits) 限制每个磁盘的读写并发，默认每个磁盘同时只读写一个文件。
+    journal 为下载器的运行日志 (run_journal.RunJournal) 时，解压完成的文件标记为 extracted。
+    下载中的文件以 .part 结尾，完成后才改名为 .tar，所以不会读到不完整的文件。
     """
+    if output_directory is None:
+        output_directory = directory
+    if limits is None:
+        limits = DiskLimits()
+
     # 加载已经处理的文件
     processed_files = load_processed_files(record_file)
 
@@ -34,37 +214,119 @@ def extract_tar_files_in_batches(directory, batch_size=5, record_file=PROCESSED_
         print(f"目录 {directory} 中没有新的 tar 文件。")
         return
 
-    # 分批处理文件
-    for i in range(0, total_files, batch_size):
-        batch_files = tar_files[i:i+batch_size]
-        print(f"正在解压批次 {i//batch_size + 1}: {batch_files}")
-        
-        for tar_file in batch_files:
-            tar_path = os.path.join(directory, tar_file)
+    tar_paths = _interleave([os.path.join(directory, f) for f in tar_files], output_directory)
+    print(f"正在解压 {total_files} 个文件 (同时最多 {batch_size} 个)")
+
+    def extract_one(tar_path):
+        target = choose_output_directory(tar_path, output_directory)
+        os.makedirs(target, exist_ok=True)
+        # 先取得读再取得写，所有线程按同样的顺序等待，不会互相卡住
+        with limits.reading(tar_path), limits.writing(target):
+            start = time.time()
+            written = extract_tar(tar_path, target, copy_mode, limits, index)
+        return target, written, time.time() - start
+
+    done = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, batch_size),
+                                               thread_name_prefix="extract") as executor:
+        futures = {executor.submit(extract_one, tar_path): tar_path for tar_path in tar_paths}
+        for future in concurrent.futures.as_completed(futures):
+            tar_path = futures[future]
+            tar_file = os.path.basename(tar_path)
+            done += 1
             try:
-                with tarfile.open(tar_path, 'r') as tar:
-                    tar.extractall(path=directory)
-                print(f"成功解压 {tar_file}。")
+                target, written, elapsed = future.result()
+                speed = written / 1024 / 1024 / elapsed if elapsed > 0 else 0
+                print(f"成功解压 {tar_file} -> {target} ({speed:.1f} MB/秒, {done}/{total_files})。")
                 # 记录已处理的文件，使用完整路径
                 save_processed_file(record_file, tar_path)
+                if journal is not None:
+                    journal.mark_path(tar_path, "extracted")
             except Exception as e:
                 print(f"解压 {tar_file} 时出错: {e}")
 
-def process_directories(base_directory, batch_size=5):
+def process_directories(base_directory, batch_size=5, sources=None, journal=None, output_roots=None,
+                        limits=None, copy_mode="read", index=None):
     """
     处理 train, test 和 valid 目录，并解压其中的 tar 文件。
+    sources 为 {子目录: [目录或通配符, ...]}，用于直接处理下载器写入的位置
+    (例如 downloads/batch_*)，解压结果放到对应的子目录中，不需要先把 tar 文件移动过去。
+    output_roots 为多个输出根目录 (例如不同的NVMe盘) 时，解压结果按文件名哈希分散到 <根目录>/<子目录>。
     """
+    sources = sources or {}
+    options = dict(batch_size=batch_size, journal=journal, limits=limits or DiskLimits(), copy_mode=copy_mode,
+                   index=index)
     for sub_dir in ['train', 'test', 'valid']:
         full_path = os.path.join(base_directory, sub_dir)
+        if output_roots:
+            output = [os.path.join(root, sub_dir) for root in output_roots]
+        else:
+            output = full_path
         if os.path.isdir(full_path):
             print(f"正在处理目录: {full_path}")
-            extract_tar_files_in_batches(full_path, batch_size=batch_size)
-        else:
+            extract_tar_files_in_batches(full_path, output_directory=output, **options)
+        elif not sources.get(sub_dir):
             print(f"目录 {full_path} 未找到。")
 
+        for pattern in sources.get(sub_dir, []):
+            for source_dir in sorted(glob.glob(pattern)):
+                if not os.path.isdir(source_dir) or os.path.abspath(source_dir) == os.path.abspath(full_path):
+                    continue
+                print(f"正在处理目录: {source_dir} -> {output}")
+                extract_tar_files_in_batches(source_dir, output_directory=output, **options)
+
+def parse_sources(args):
+    """解析 --source=train:downloads/batch_* 形式的参数"""
+    sources = {}
+    for arg in args:
+        if arg.startswith("--source="):
+            sub_dir, _, pattern = arg.split("=", 1)[1].partition(":")
+            if sub_dir not in ('train', 'test', 'valid') or not pattern:
+                raise ValueError(f"无效的 --source 参数: {arg}，格式为 --source=train:<目录或通配符>")
+            sources.setdefault(sub_dir, []).append(pattern)
+    return sources
+
 if __name__ == "__main__":
-    # 替换为你的基础目录路径
-    base_dir = "./"
+    # 基础目录路径，默认为当前目录；可以用 --source=train:downloads/batch_* 直接处理下载位置的 tar 文件
+    # --journal=downloads/journal.db 会在下载器的运行日志中把解压完成的文件标记为 extracted
+    # --output-root=/nvme1/a_t5 --output-root=/nvme2/a_t5 把解压结果分散到多个磁盘
+    # --parallel=8 同时解压的文件数，--read-workers=2 --write-workers=2 每个磁盘同时读/写的文件数
+    # --write-limit=300M 限制总写入速度，--copy=auto 用 copy_file_range/sendfile 复制文件内容
+    # --index=downloads/tar_index.db 解压时记录每个成员的偏移 (见 tar_index.py)
+    positional = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    base_dir = positional[0] if positional else "./"
+    journal = None
+    output_roots = []
+    parallel = 5
+    read_workers = write_workers = 1
+    bucket = None
+    copy_mode = "read"
+    index = None
+    for arg in sys.argv[1:]:
+        name, _, value = arg.partition("=")
+        if name == "--journal":
+            from run_journal import RunJournal
+            journal = RunJournal(value)
+        elif name == "--output-root":
+            output_roots.append(value)
+        elif name == "--parallel":
+            parallel = int(value)
+        elif name == "--read-workers":
+            read_workers = int(value)
+        elif name == "--write-workers":
+            write_workers = int(value)
+        elif name == "--write-limit":
+            from rate_limiter import TokenBucket, parse_rate
+            bucket = TokenBucket(parse_rate(value))
+        elif name == "--copy":
+            if value not in COPY_MODES:
+                raise ValueError(f"无效的 --copy 参数: {value}，可选: {', '.join(COPY_MODES)}")
+            copy_mode = value
+        elif name == "--index":
+            from tar_index import TarIndex
+            index = TarIndex(value)
     
-    process_directories(base_dir)
+    process_directories(base_dir, batch_size=parallel, sources=parse_sources(sys.argv[1:]), journal=journal,
+                        output_roots=output_roots, limits=DiskLimits(read_workers, write_workers, bucket),
+                        copy_mode=copy_mode, index=index)
     
\ No newline at end of file
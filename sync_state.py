@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+import threading
+import time
+
+class SyncState:
+    """本地同步状态数据库
+
+    记录每个远程项目上次同步时的eTag/cTag、大小和修改时间，以及每个同步根目录的
+    delta链接。增量同步时只需比较这些元数据，不必重新下载或逐个比对文件内容。
+    """
+
+    def __init__(self, db_path):
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS items (
+                item_id TEXT PRIMARY KEY,
+                root_key TEXT NOT NULL,
+                name TEXT,
+                local_path TEXT,
+                etag TEXT,
+                ctag TEXT,
+                size INTEGER,
+                last_modified TEXT,
+                synced_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS idx_items_root ON items(root_key);
+            CREATE TABLE IF NOT EXISTS delta_links (
+                root_key TEXT PRIMARY KEY,
+                delta_link TEXT
+            );
+        """)
+        self._conn.commit()
+
+    def close(self):
+        """关闭数据库连接"""
+        with self._lock:
+            self._conn.close()
+
+    def get(self, item_id):
+        """获取项目的同步记录，不存在时返回None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT item_id, root_key, name, local_path, etag, ctag, size, last_modified, synced_at "
+                "FROM items WHERE item_id = ?",
+                (item_id,)
+            ).fetchone()
+
+        if not row:
+            return None
+        keys = ["item_id", "root_key", "name", "local_path", "etag", "ctag", "size", "last_modified", "synced_at"]
+        return dict(zip(keys, row))
+
+    def is_unchanged(self, item, local_path):
+        """判断远程项目自上次同步以来是否未发生变化
+
+        cTag只在内容变化时更新，优先使用；没有cTag时退回到eTag。
+        同时要求大小、修改时间一致，且本地文件仍然存在、大小正确。
+        """
+        record = self.get(item["id"])
+        if not record or record["local_path"] != local_path:
+            return False
+
+        if item.get("cTag") and record["ctag"]:
+            if item["cTag"] != record["ctag"]:
+                return False
+        elif item.get("eTag") != record["etag"]:
+            return False
+
+        if item.get("size") != record["size"]:
+            return False
+        if item.get("lastModifiedDateTime") != record["last_modified"]:
+            return False
+
+        try:
+            return os.path.getsize(local_path) == record["size"]
+        except OSError:
+            return False
+
+    def needs_download(self, item, local_path, root_key):
+        """判断项目是否需要传输
+
+        首次同步已有的本地镜像时，没有记录但本地文件大小与远程一致的项目直接登记为已同步，
+        避免把整个镜像重新下载一遍。
+        """
+        if self.is_unchanged(item, local_path):
+            return False
+
+        if self.get(item["id"]) is None:
+            try:
+                if os.path.getsize(local_path) == item.get("size"):
+                    self.mark_synced(item, local_path, root_key)
+                    return False
+            except OSError:
+                pass
+
+        return True
+
+    def mark_synced(self, item, local_path, root_key):
+        """记录项目已经同步到本地"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO items "
+                "(item_id, root_key, name, local_path, etag, ctag, size, last_modified, synced_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    item["id"], root_key, item.get("name"), local_path,
+                    item.get("eTag"), item.get("cTag"), item.get("size"),
+                    item.get("lastModifiedDateTime"), time.time()
+                )
+            )
+            self._conn.commit()
+
+    def remove(self, item_id):
+        """删除项目的同步记录"""
+        with self._lock:
+            self._conn.execute("DELETE FROM items WHERE item_id = ?", (item_id,))
+            self._conn.commit()
+
+    def items_under(self, root_key):
+        """返回某个同步根目录下所有已记录的项目"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT item_id, name, local_path, size FROM items WHERE root_key = ?",
+                (root_key,)
+            ).fetchall()
+        return [
+            {"item_id": item_id, "name": name, "local_path": local_path, "size": size}
+            for item_id, name, local_path, size in rows
+        ]
+
+    def get_delta_link(self, root_key):
+        """获取同步根目录上次保存的delta链接"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT delta_link FROM delta_links WHERE root_key = ?",
+                (root_key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_delta_link(self, root_key, delta_link):
+        """保存同步根目录最新的delta链接"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO delta_links (root_key, delta_link) VALUES (?, ?)",
+                (root_key, delta_link)
+            )
+            self._conn.commit()
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import fnmatch
+import glob
+import mmap
+import os
+import sqlite3
+import sys
+import tarfile
+import threading
+import time
+
+from config import TAR_INDEX_FILE
+
+class TarIndex:
+    """tar分片的成员索引 (SQLite WAL)
+
+    记录每个 .tar 文件中每个普通文件成员的数据偏移和大小，下游任务只需要少量音频时
+    可以直接按位置读取，不用解压整个分片，也不会产生数百万个小文件。
+    分片的大小和修改时间也保存下来，文件被替换后索引自动视为过期。
+    """
+
+    def __init__(self, db_path=TAR_INDEX_FILE):
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS shards (
+                shard_id INTEGER PRIMARY KEY,
+                source TEXT UNIQUE NOT NULL,
+                size INTEGER,
+                mtime_ns INTEGER,
+                etag TEXT,
+                indexed_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS members (
+                shard_id INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                offset INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                mtime INTEGER,
+                PRIMARY KEY (shard_id, name)
+            );
+            CREATE INDEX IF NOT EXISTS idx_members_name ON members(name);
+        """)
+        self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _shard(self, source):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT shard_id, size, mtime_ns, etag FROM shards WHERE source = ?", (source,)
+            ).fetchone()
+
+    def is_current(self, tar_path):
+        """索引中的记录与文件当前的大小和修改时间一致时返回True"""
+        row = self._shard(os.path.abspath(tar_path))
+        if not row:
+            return False
+        st = os.stat(tar_path)
+        return row[1] == st.st_size and row[2] == st.st_mtime_ns
+
+    def record(self, source, members, size=None, mtime_ns=None, etag=None):
+        """替换一个分片的成员记录，members为TarInfo列表 (只记录普通文件)"""
+        rows = [(m.name, m.offset_data, m.size, int(m.mtime)) for m in members if m.isreg() and not m.issparse()]
+        with self._lock:
+            conn = self._conn
+            with conn:
+                conn.execute(
+                    "INSERT INTO shards (source, size, mtime_ns, etag, indexed_at) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(source) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns, "
+                    "etag = excluded.etag, indexed_at = excluded.indexed_at",
+                    (source, size, mtime_ns, etag, time.time())
+                )
+                shard_id = conn.execute("SELECT shard_id FROM shards WHERE source = ?", (source,)).fetchone()[0]
+                conn.execute("DELETE FROM members WHERE shard_id = ?", (shard_id,))
+                # 同名成员以最后一个为准，和解压的结果一致
+                conn.executemany(
+                    "INSERT OR REPLACE INTO members (shard_id, name, offset, size, mtime) VALUES (?, ?, ?, ?, ?)",
+                    [(shard_id,) + row for row in rows]
+                )
+        return len(rows)
+
+    def record_file(self, tar_path, members):
+        """记录本地tar文件的成员 (例如step1_unzip.py解压时顺便记录)"""
+        st = os.stat(tar_path)
+        return self.record(os.path.abspath(tar_path), members, st.st_size, st.st_mtime_ns)
+
+    def build(self, tar_path, force=False):
+        """扫描tar文件的头部建立索引 (只读取每个成员的头部，跳过文件内容)
+
+        返回记录的成员数，索引已是最新时返回None。
+        """
+        if not force and self.is_current(tar_path):
+            return None
+        with tarfile.open(tar_path, "r:") as tar:
+            members = tar.getmembers()
+        return self.record_file(tar_path, members)
+
+    def cached_members(self, source, size=None, etag=None):
+        """索引中大小和eTag都一致的分片成员 (用于远程分片)，没有或已过期时返回None"""
+        row = self._shard(source)
+        if not row or row[1] != size or row[3] != etag:
+            return None
+        return self.members(source)
+
+    def members(self, source, pattern=None):
+        """分片中的成员 [(name, offset, size), ...]，pattern为通配符时只返回匹配的成员"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT m.name, m.offset, m.size FROM members m JOIN shards s ON s.shard_id = m.shard_id "
+                "WHERE s.source = ? ORDER BY m.offset",
+                (source,)
+            ).fetchall()
+        if pattern:
+            rows = [row for row in rows if fnmatch.fnmatchcase(row[0], pattern)]
+        return rows
+
+    def find(self, pattern):
+        """在所有分片中查找成员，返回 [(source, name, offset, size), ...]"""
+        if any(c in pattern for c in "*?["):
+            sql = "WHERE m.name GLOB ?"
+        else:
+            sql = "WHERE m.name = ?"
+        with self._lock:
+            return self._conn.execute(
+                "SELECT s.source, m.name, m.offset, m.size FROM members m JOIN shards s ON s.shard_id = m.shard_id "
+                f"{sql} ORDER BY s.source, m.offset",
+                (pattern,)
+            ).fetchall()
+
+    def open(self, tar_path, use_mmap=False):
+        """打开分片用于按成员读取，索引不存在或已过期时先重新建立"""
+        if not self.is_current(tar_path):
+            self.build(tar_path, force=True)
+        return ShardReader(tar_path, self.members(os.path.abspath(tar_path)), use_mmap)
+
+class ShardReader:
+    """按索引从tar文件中读取成员，不解压
+
+    默认用pread读取，线程之间可以共用同一个ShardReader；use_mmap=True时映射整个文件，
+    view()可以零复制地返回成员内容。
+    """
+
+    def __init__(self, tar_path, members, use_mmap=False):
+        self.tar_path = tar_path
+        self._members = {name: (offset, size) for name, offset, size in members}
+        self._fd = os.open(tar_path, os.O_RDONLY)
+        self._mmap = None
+        if use_mmap and os.fstat(self._fd).st_size > 0:
+            self._mmap = mmap.mmap(self._fd, 0, access=mmap.ACCESS_READ)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def names(self):
+        return list(self._members)
+
+    def __contains__(self, name):
+        return name in self._members
+
+    def _locate(self, name):
+        if name not in self._members:
+            raise KeyError(f"{self.tar_path} 中没有成员: {name}")
+        return self._members[name]
+
+    def read(self, name):
+        """返回成员的内容 (bytes)"""
+        offset, size = self._locate(name)
+        if self._mmap is not None:
+            return self._mmap[offset:offset + size]
+        chunks = []
+        while size > 0:
+            chunk = os.pread(self._fd, size, offset)
+            if not chunk:
+                raise EOFError(f"{self.tar_path} 比索引中记录的短，请重新建立索引")
+            chunks.append(chunk)
+            offset += len(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    def view(self, name):
+        """返回成员内容的memoryview (需要use_mmap=True)，用完后调用release()"""
+        if self._mmap is None:
+            raise ValueError("view() 需要用 use_mmap=True 打开分片")
+        offset, size = self._locate(name)
+        return memoryview(self._mmap)[offset:offset + size]
+
+def _expand(paths):
+    """展开命令行中的tar文件、目录和通配符"""
+    tar_paths = []
+    for path in paths:
+        for match in sorted(glob.glob(path)) or [path]:
+            if os.path.isdir(match):
+                tar_paths.extend(sorted(os.path.join(match, f) for f in os.listdir(match) if f.endswith(".tar")))
+            else:
+                tar_paths.append(match)
+    return tar_paths
+
+def main():
+    parser = argparse.ArgumentParser(description="tar分片成员索引: 不解压直接读取分片中的文件")
+    parser.add_argument("--index", default=TAR_INDEX_FILE, help="索引数据库")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build = subparsers.add_parser("build", help="为tar文件建立索引")
+    build.add_argument("paths", nargs="+", help="tar文件、目录或通配符")
+    build.add_argument("--force", action="store_true", help="重新建立已是最新的索引")
+
+    ls = subparsers.add_parser("ls", help="列出分片中的成员")
+    ls.add_argument("tar_path")
+    ls.add_argument("pattern", nargs="?", help="只列出匹配的成员，例如 '*.flac'")
+
+    find = subparsers.add_parser("find", help="在所有已索引的分片中查找成员")
+    find.add_argument("pattern", help="成员名或通配符")
+
+    cat = subparsers.add_parser("cat", help="把成员内容输出到标准输出")
+    cat.add_argument("tar_path")
+    cat.add_argument("name")
+
+    args = parser.parse_args()
+    index = TarIndex(args.index)
+
+    if args.command == "build":
+        total = skipped = 0
+        start = time.time()
+        for tar_path in _expand(args.paths):
+            try:
+                count = index.build(tar_path, force=args.force)
+            except (OSError, tarfile.TarError) as e:
+                print(f"建立索引失败 {tar_path}: {e}")
+                continue
+            if count is None:
+                skipped += 1
+            else:
+                total += count
+                print(f"{tar_path}: {count} 个成员")
+        print(f"完成: 新索引 {total} 个成员，{skipped} 个分片已是最新 ({time.time() - start:.1f} 秒)")
+    elif args.command == "ls":
+        if not index.is_current(args.tar_path):
+            index.build(args.tar_path, force=True)
+        for name, offset, size in index.members(os.path.abspath(args.tar_path), args.pattern):
+            print(f"{offset:>14} {size:>12} {name}")
+    elif args.command == "find":
+        for source, name, offset, size in index.find(args.pattern):
+            print(f"{source}\t{name}\t{offset}\t{size}")
+    elif args.command == "cat":
+        with index.open(args.tar_path) as reader:
+            sys.stdout.buffer.write(reader.read(args.name))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import hashlib
+import hmac
+import http.client
+import json
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse, parse_qs
+
+try:
+    import fcntl
+except ImportError:
+    # Windows上没有fcntl，只能保证同一进程内的线程不冲突
+    fcntl = None
+
+from config import (
+    CLIENT_ID, CLIENT_SECRET, AUTHORITY, SCOPE, APP_SCOPE, TOKEN_CACHE_FILE,
+    TOKEN_BROKER, TOKEN_BROKER_SECRET, AUTH_INTERACTIVE
+)
+
+# 令牌离过期不足该秒数时提前刷新
+REFRESH_MARGIN = 300
+
+def token_fingerprint(token):
+    """令牌的摘要，客户端报告令牌失效时只发送摘要，不在请求中传输令牌本身"""
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()[:16]
+
+class TokenCacheFile:
+    """多个进程共用的MSAL令牌缓存文件
+
+    读写都持有旁边 .lock 文件的flock锁，写入时先写临时文件再原子重命名，进程被杀或多个进程
+    同时保存时不会留下截断的缓存。记录上次读写时文件的状态，只有其他进程改过时才重新读取。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = path + ".lock"
+        self._loaded_stat = None
+
+    @contextmanager
+    def locked(self):
+        """持有缓存文件的排他锁 (跨进程)"""
+        if fcntl is None:
+            yield
+            return
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def reload(self, cache):
+        """文件被其他进程改过时把它读入cache，需要在locked()中调用"""
+        stat = self._stat()
+        if stat is None or stat == self._loaded_stat:
+            return
+        try:
+            with open(self.path, "r") as f:
+                cache.deserialize(f.read())
+        except Exception:
+            print("令牌缓存文件无效，将创建新的缓存")
+        self._loaded_stat = stat
+
+    def save(self, cache):
+        """缓存有变化时原子地写回文件，需要在locked()中调用"""
+        if not cache.has_state_changed:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        temp_path = os.path.join(directory, f".{os.path.basename(self.path)}.{os.getpid()}.tmp")
+        # 缓存中有刷新令牌，只允许当前用户读取
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(cache.serialize())
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self._loaded_stat = self._stat()
+
+class MsalTokenProvider:
+    """在本进程中通过MSAL获取访问令牌
+
+    设置了client_secret时使用客户端凭据 (应用程序身份，不需要人工操作)；否则使用令牌缓存中的账户
+    静默获取，缓存中没有可用令牌且interactive为True时进行设备代码登录，为False时直接报错。
+    同一进程中的线程共用一个实例 (见shared_provider)，获取令牌时持有缓存文件的锁，
+    同一台机器上的多个进程依次刷新，后面的进程直接使用前一个进程刷新后写入的令牌。
+    """
+
+    def __init__(self, client_id=CLIENT_ID, authority=AUTHORITY, client_secret=CLIENT_SECRET,
+                 cache_path=TOKEN_CACHE_FILE, interactive=AUTH_INTERACTIVE):
+        self.client_id = client_id
+        self.authority = authority
+        self.client_secret = client_secret
+        self.cache_path = cache_path
+        self.interactive = interactive
+        self.app = None
+        self.token_cache = None
+        self.cache_file = TokenCacheFile(cache_path)
+        self._lock = threading.Lock()
+
+    def describe(self):
+        return "客户端凭据" if self.client_secret else f"令牌缓存 {self.cache_path}"
+
+    def _init_msal(self):
+        """创建令牌缓存和MSAL应用，msal在第一次需要令牌时才导入"""
+        from msal import PublicClientApplication, ConfidentialClientApplication, SerializableTokenCache
+
+        self.token_cache = SerializableTokenCache()
+        if self.client_secret:
+            self.app = ConfidentialClientApplication(
+                client_id=self.client_id,
+                client_credential=self.client_secret,
+                authority=self.authority,
+                token_cache=self.token_cache
+            )
+        else:
+            self.app = PublicClientApplication(
+                client_id=self.client_id,
+                authority=self.authority,
+                token_cache=self.token_cache
+            )
+
+    def get_token(self, force_refresh=False, expired_token=None):
+        """返回 (访问令牌, 过期时间戳)，force_refresh为True时不使用缓存中的访问令牌"""
+        with self._lock, self.cache_file.locked():
+            if self.app is None:
+                self._init_msal()
+            # 其他进程可能已经刷新过令牌
+            self.cache_file.reload(self.token_cache)
+            try:
+                return self._acquire(force_refresh)
+            finally:
+                # 只有缓存变化时才写回
+                self.cache_file.save(self.token_cache)
+
+    def _evict_app_tokens(self):
+        """删除缓存中本应用的访问令牌
+
+        acquire_token_for_client 会直接返回缓存中未过期的令牌，且不支持force_refresh，
+        所以强制刷新时先删掉缓存的令牌，让它重新向服务器申请。
+        """
+        access_token = self.token_cache.CredentialType.ACCESS_TOKEN
+        # 新版msal用search代替find；search持有缓存锁，先转成列表再删除
+        lookup = getattr(self.token_cache, "search", None) or self.token_cache.find
+        for entry in list(lookup(access_token, target=APP_SCOPE, query={"client_id": self.client_id})):
+            self.token_cache.remove_at(entry)
+
+    def _acquire(self, force_refresh):
+        if self.client_secret:
+            if force_refresh:
+                self._evict_app_tokens()
+            result = self.app.acquire_token_for_client(scopes=APP_SCOPE)
+        else:
+            result = None
+            accounts = self.app.get_accounts()
+            if accounts:
+                # 尝试使用缓存的令牌 (过期时用刷新令牌静默获取)
+                result = self.app.acquire_token_silent(SCOPE, account=accounts[0], force_refresh=force_refresh)
+            if not result:
+                if not self.interactive:
+                    raise Exception(
+                        f"{self.cache_path} 中没有可用的令牌，且已禁用交互式登录 (AUTH_INTERACTIVE=0)。"
+                        "请设置 CLIENT_SECRET、TOKEN_BROKER，或在一台机器上登录后共享令牌缓存"
+                    )
+                # 需要交互式登录
+                flow = self.app.initiate_device_flow(scopes=SCOPE)
+                if "user_code" not in flow:
+                    raise Exception("无法创建设备流: " + json.dumps(flow, indent=4))
+
+                print(flow["message"])
+
+                # 等待用户完成登录
+                result = self.app.acquire_token_by_device_flow(flow)
+
+        if "access_token" not in result:
+            raise Exception("无法获取访问令牌: " + json.dumps(result, indent=4))
+
+        return result["access_token"], time.time() + int(result.get("expires_in", 3600))
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """通过Unix套接字发送HTTP请求 (令牌代理和下载控制接口的客户端)"""
+
+    def __init__(self, socket_path, timeout):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+class BrokerClient:
+    """从令牌代理 (python token_broker.py serve) 获取访问令牌
+
+    address为 unix:///路径 或 http://主机:端口。客户端从不登录，也不读写令牌缓存文件，
+    令牌的获取和刷新都由代理集中完成。
+    """
+
+    def __init__(self, address, secret=TOKEN_BROKER_SECRET, timeout=30):
+        self.address = address
+        self.secret = secret
+        self.timeout = timeout
+
+    def describe(self):
+        return f"令牌代理 {self.address}"
+
+    def _connect(self):
+        parsed = urlparse(self.address)
+        if parsed.scheme == "unix":
+            return UnixHTTPConnection(parsed.path, self.timeout)
+        if parsed.scheme == "http":
+            return http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=self.timeout)
+        raise ValueError(f"无效的令牌代理地址: {self.address} (应为 unix:///路径 或 http://主机:端口)")
+
+    def get_token(self, force_refresh=False, expired_token=None):
+        path = "/token"
+        if force_refresh and expired_token:
+            path += f"?expired={token_fingerprint(expired_token)}"
+        headers = {"X-Broker-Secret": self.secret} if self.secret else {}
+        conn = self._connect()
+        try:
+            conn.request("GET", path, headers=headers)
+            response = conn.getresponse()
+            body = response.read()
+        except OSError as e:
+            raise Exception(f"无法连接令牌代理 {self.address}: {e}")
+        finally:
+            conn.close()
+        if response.status != 200:
+            raise Exception(f"令牌代理返回错误 {response.status}: {body.decode('utf-8', 'replace')}")
+        result = json.loads(body)
+        return result["access_token"], result["expires_on"]
+
+_shared_providers = {}
+_shared_providers_lock = threading.Lock()
+
+def shared_provider(cache_path=TOKEN_CACHE_FILE):
+    """同一进程中使用同一个令牌缓存文件的下载器共用一个MsalTokenProvider (内存中的缓存也共用)"""
+    key = os.path.abspath(cache_path)
+    with _shared_providers_lock:
+        if key not in _shared_providers:
+            _shared_providers[key] = MsalTokenProvider(cache_path=cache_path)
+        return _shared_providers[key]
+
+def make_token_provider():
+    """按配置选择令牌来源: 设置了TOKEN_BROKER时使用令牌代理，否则在本进程中登录"""
+    if TOKEN_BROKER:
+        return BrokerClient(TOKEN_BROKER)
+    return shared_provider()
+
+class TokenBroker:
+    """集中获取和刷新访问令牌，供多个节点和进程使用
+
+    所有客户端共用同一个令牌，离过期不足REFRESH_MARGIN秒时由后台线程提前刷新；
+    客户端报告令牌失效 (401) 时，只有报告的正是当前令牌才会强制刷新，多个客户端同时报告也只刷新一次。
+    """
+
+    def __init__(self, provider):
+        self.provider = provider
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_on = 0
+        self._stop = threading.Event()
+
+    def get_token(self, expired=None):
+        with self._lock:
+            stale = self._token is None or self._expires_on - REFRESH_MARGIN <= time.time()
+            if expired and self._token and expired == token_fingerprint(self._token):
+                stale = True
+            if stale:
+                self._token, self._expires_on = self.provider.get_token(force_refresh=self._token is not None)
+            return self._token, self._expires_on
+
+    def _refresh_loop(self):
+        while not self._stop.is_set():
+            with self._lock:
+                wait = self._expires_on - REFRESH_MARGIN - time.time()
+            if wait > 0:
+                self._stop.wait(min(wait, 60))
+                continue
+            try:
+                self.get_token()
+            except Exception as e:
+                print(f"刷新令牌失败，60秒后重试: {e}")
+                self._stop.wait(60)
+
+    def start_refresher(self):
+        threading.Thread(target=self._refresh_loop, name="token-refresh", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+def _make_handler(broker, secret):
+    from http.server import BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def _reply(self, status, payload):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            parsed = urlparse(self.path)
+            if parsed.path != "/token":
+                self._reply(404, {"error": "not found"})
+                return
+            if secret and not hmac.compare_digest(self.headers.get("X-Broker-Secret", ""), secret):
+                self._reply(403, {"error": "forbidden"})
+                return
+            expired = parse_qs(parsed.query).get("expired", [None])[0]
+            try:
+                token, expires_on = broker.get_token(expired)
+            except Exception as e:
+                self._reply(503, {"error": str(e)})
+                return
+            self._reply(200, {"access_token": token, "expires_on": expires_on})
+
+    return Handler
+
+def _make_server(args, handler):
+    if args.socket:
+        import socketserver
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = socketserver.ThreadingUnixStreamServer(args.socket, handler)
+        # 只有当前用户可以连接
+        os.chmod(args.socket, 0o600)
+        return server, f"unix://{os.path.abspath(args.socket)}"
+    from http.server import ThreadingHTTPServer
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+    return server, f"http://{args.host}:{server.server_port}"
+
+def main():
+    parser = argparse.ArgumentParser(description="令牌代理: 集中登录和刷新访问令牌，集群节点不需要人工登录")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve = subparsers.add_parser("serve", help="启动令牌代理")
+    serve.add_argument("--socket", help="Unix套接字路径 (同一台机器上的进程使用)")
+    serve.add_argument("--host", default="127.0.0.1", help="TCP监听地址 (其他节点访问时改为0.0.0.0并设置密钥)")
+    serve.add_argument("--port", type=int, default=8766)
+    serve.add_argument("--secret", default=TOKEN_BROKER_SECRET, help="客户端需要提供的密钥 (默认TOKEN_BROKER_SECRET)")
+
+    check = subparsers.add_parser("token", help="按当前配置获取一次令牌，检查登录是否可用")
+    check.add_argument("--force-refresh", action="store_true")
+
+    args = parser.parse_args()
+
+    if args.command == "token":
+        provider = make_token_provider()
+        token, expires_on = provider.get_token(force_refresh=args.force_refresh)
+        print(f"已从{provider.describe()}获取令牌: {token[:10]}...{token[-10:]}，"
+              f"{(expires_on - time.time()) / 60:.0f} 分钟后过期")
+        return
+
+    if not args.socket and args.host not in ("127.0.0.1", "localhost", "::1") and not args.secret:
+        parser.error("在非本机地址上提供令牌时必须设置 --secret 或 TOKEN_BROKER_SECRET")
+    # 代理自己总是在本进程中登录，避免TOKEN_BROKER指向自己
+    broker = TokenBroker(MsalTokenProvider())
+    # 启动时先登录一次，需要设备代码登录时在这里完成，之后客户端请求不会等待人工操作
+    token, expires_on = broker.get_token()
+    print(f"已通过{broker.provider.describe()}获取令牌，{(expires_on - time.time()) / 60:.0f} 分钟后过期")
+    broker.start_refresher()
+
+    server, address = _make_server(args, _make_handler(broker, args.secret))
+    server.daemon_threads = True
+    print(f"令牌代理: {address}  (客户端设置 TOKEN_BROKER={address})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        broker.stop()
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+if __name__ == "__main__":
+    main()